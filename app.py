@@ -3,9 +3,20 @@ import sys
 
 import fire
 import gradio as gr
+from fastapi.responses import JSONResponse
 
 from llama_lora.globals import Global
-from llama_lora.models import prepare_base_model
+from llama_lora.models import (
+    prepare_base_model, start_inference_worker_pool, get_model, get_tokenizer,
+    collect_blob_store_garbage)
+from llama_lora.lib.generation_scheduler import GenerationScheduler
+from llama_lora.lib.get_device import get_device
+from llama_lora.lib.torch_compile import (
+    is_compile_supported, enable_persistent_compile_cache)
+from llama_lora.utils.model_cache import ModelCache
+from llama_lora.utils.lru_cache import LRUCache
+from llama_lora.utils.model_preloader import (
+    parse_model_specs, start_preloading, get_readiness)
 from llama_lora.ui.main_page import main_page, get_page_title, main_page_custom_css
 from llama_lora.utils.data import init_data_dir
 
@@ -21,6 +32,29 @@ def main(
     share: bool = False,
     skip_loading_base_model: bool = False,
     load_8bit: bool = False,
+    cpu_quantize: bool = False,
+    cpu_quantize_skip_modules: str = "",
+    model_cache_device_budget_gb: float = 0,
+    model_cache_cpu_budget_gb: float = 0,
+    model_cache_disk_budget_gb: float = 0,
+    load_with_safetensors: bool = False,
+    parallel_weight_loading_workers: int = 0,
+    torch_compile: bool = True,
+    compile_input_length_buckets: str = "",
+    merge_lora_models: bool = False,
+    max_attached_lora_models: int = 4,
+    merged_models_cache_budget_gb: float = 0,
+    dedupe_lora_models: bool = False,
+    stream_layers_from_disk: bool = False,
+    resident_layers: int = 2,
+    layer_read_ahead: int = 1,
+    continuous_batching: bool = False,
+    max_batch_size: int = 8,
+    prompt_prefix_cache_budget_gb: float = 0,
+    inference_workers: int = 0,
+    inference_workers_lora_model: str = "",
+    preload_models: str = "",
+    preload_tokenizers: str = "",
     ui_show_sys_info: bool = True,
     ui_dev_mode: bool = False,
     wandb_api_key: str = "",
@@ -35,6 +69,33 @@ def main(
     :param server_name: Allows to listen on all interfaces by providing '0.0.0.0'.
     :param share: Create a public Gradio URL.
 
+    :param cpu_quantize: When running on CPU, quantize the linear layers of base models to int8 dynamically. LoRA layers are kept in float32.
+    :param cpu_quantize_skip_modules: Names of linear modules to keep in full precision with `cpu_quantize`, seperated by ",". LoRA models can only be used if the modules they target are listed here. Defaults to 'q_proj,k_proj,v_proj,o_proj,lm_head'.
+
+    :param model_cache_device_budget_gb: Memory budget (in GB) for keeping models on the GPU (or in RAM if running on CPU). If not set, only one base model is kept loaded.
+    :param model_cache_cpu_budget_gb: Memory budget (in GB) for keeping models evicted from the GPU in CPU RAM.
+    :param model_cache_disk_budget_gb: Disk budget (in GB) for keeping evicted models under `{data_dir}/model_cache`.
+
+    :param load_with_safetensors: Convert model and LoRA weights to safetensors once (under `{data_dir}/safetensors_models`, or next to local LoRA weights) and memory-map them on load, to speed up loading and reduce peak memory usage.
+    :param parallel_weight_loading_workers: Read the shards of sharded base model checkpoints with this number of threads concurrently. Disabled if less than 2.
+    :param torch_compile: Compile models with torch.compile (requires PyTorch 2).
+    :param compile_input_length_buckets: Input lengths, seperated by ",", that prompts will be left-padded to for compiled models, so that each length is only compiled once. The compiled model will be warmed up over these lengths after it's loaded, and compile artifacts will be cached under `{data_dir}/torch_compile_cache`. For example: '64,128,256,512'.
+    :param merge_lora_models: Merge LoRA weights into the base model for faster inference. Merged models are cached under `{data_dir}/merged_models`. Not supported with `load_8bit`.
+    :param max_attached_lora_models: The max number of LoRA models to keep attached to a loaded base model. The least recently used ones are detached first, also when the base model would not fit in `model_cache_device_budget_gb` otherwise.
+    :param merged_models_cache_budget_gb: Disk budget (in GB) for cached merged models. Unlimited if not set.
+    :param dedupe_lora_models: After training, move the weights of the LoRA model and its checkpoints into a content-addressed store under `{data_dir}/blobs`, so that identical tensors are stored only once. The model directories keep `*.blobs.json` manifests in place of the weight files. Blobs that are no longer used by any model are removed on startup and after training.
+    :param stream_layers_from_disk: Keep the weights of decoder layers on disk and load them right before they run, to run base models that do not fit in memory at the cost of latency. Checkpoints are converted to safetensors under `{data_dir}/safetensors_models` first if needed. LoRA models are not supported in this mode.
+    :param resident_layers: With `stream_layers_from_disk`, the max number of decoder layers to keep loaded at a time.
+    :param layer_read_ahead: With `stream_layers_from_disk`, the number of following layers to read in the background while a layer runs.
+    :param continuous_batching: Run the generations of concurrent requests together in one shared decode loop, admitting new requests and retiring finished ones at every step. Requests with beam search are run on their own.
+    :param max_batch_size: With `continuous_batching`, the max number of requests to generate for together. This is also the number of requests handled concurrently.
+    :param prompt_prefix_cache_budget_gb: Memory budget (in GB) for caching the KV of the constant start of prompts (such as the preamble of prompt templates) for each model and template, so that only the rest of each prompt is prefilled. Only used for generations without beam search that are not run with `continuous_batching` or `inference_workers`. Disabled if not set.
+    :param inference_workers: Serve inference of the base model with this number of worker processes (CPU only). The model is loaded once and its weights are shared between the workers, and up to this number of requests are handled concurrently.
+    :param inference_workers_lora_model: A LoRA model to merge into the model served by the inference workers. Other LoRA models are still served in the main process.
+
+    :param preload_models: Models to load in the background after startup, in priority order, seperated by ",". LoRA models are specified as `base_model//lora_model`. For example: 'decapoda-research/llama-7b-hf//alpaca-lora-7b,decapoda-research/llama-7b-hf'. Set a large enough `model_cache_device_budget_gb` to keep them all loaded, models that do not fit along with the ones before them are skipped and loaded on demand. The load progress is served at `/readiness`, which responds with 503 until all of them are loaded.
+    :param preload_tokenizers: Tokenizers to load in the background after startup, seperated by ",". The tokenizers of `preload_models` are loaded as well.
+
     :param wandb_api_key: The API key for Weights & Biases. Setting either this or `wandb_project` will enable Weights & Biases.
     :param wandb_project: The default project name for Weights & Biases. Setting either this or `wandb_api_key` will enable Weights & Biases.
     '''
@@ -63,6 +124,43 @@ def main(
 
     Global.data_dir = os.path.abspath(data_dir)
     Global.load_8bit = load_8bit
+    Global.cpu_quantize = cpu_quantize
+    if cpu_quantize_skip_modules:
+        if isinstance(cpu_quantize_skip_modules, str):
+            cpu_quantize_skip_modules = cpu_quantize_skip_modules.split(',')
+        Global.cpu_quantize_skip_modules = [
+            name.strip() for name in cpu_quantize_skip_modules]
+
+    Global.load_with_safetensors = load_with_safetensors
+    Global.parallel_weight_loading_workers = parallel_weight_loading_workers
+    Global.torch_compile = torch_compile
+    if compile_input_length_buckets:
+        if isinstance(compile_input_length_buckets, str):
+            compile_input_length_buckets = compile_input_length_buckets.split(',')
+        Global.compile_input_length_buckets = [
+            int(length) for length in compile_input_length_buckets]
+    if torch_compile and is_compile_supported():
+        enable_persistent_compile_cache(
+            os.path.join(Global.data_dir, "torch_compile_cache"))
+    Global.merge_lora_models = merge_lora_models
+    Global.max_attached_lora_models = max_attached_lora_models
+    Global.merged_models_cache_max_bytes = gb_to_bytes(
+        merged_models_cache_budget_gb)
+    Global.dedupe_lora_models = dedupe_lora_models
+    Global.stream_layers_from_disk = stream_layers_from_disk
+    Global.resident_layers = resident_layers
+    Global.layer_read_ahead = layer_read_ahead
+    Global.prompt_prefix_cache_max_bytes = gb_to_bytes(
+        prompt_prefix_cache_budget_gb)
+
+    Global.loaded_models = ModelCache(
+        device=get_device(),
+        max_device_bytes=gb_to_bytes(model_cache_device_budget_gb),
+        max_device_items=None if model_cache_device_budget_gb else 1,
+        max_cpu_bytes=gb_to_bytes(model_cache_cpu_budget_gb),
+        disk_dir=os.path.join(Global.data_dir, "model_cache") if model_cache_disk_budget_gb else None,
+        max_disk_bytes=gb_to_bytes(model_cache_disk_budget_gb),
+    )
 
     if len(wandb_api_key) > 0:
         Global.enable_wandb = True
@@ -76,14 +174,57 @@ def main(
 
     os.makedirs(data_dir, exist_ok=True)
     init_data_dir()
-
-    if (not skip_loading_base_model) and (not ui_dev_mode):
+    # Blobs of LoRA models that have been deleted since the last run.
+    collect_blob_store_garbage()
+
+    preload_model_specs = parse_model_specs(preload_models or [])
+    if isinstance(preload_tokenizers, str):
+        preload_tokenizers = preload_tokenizers.split(',')
+    preload_tokenizer_names = []
+    for name in list(preload_tokenizers or []) + [base_model_name for base_model_name, _ in preload_model_specs]:
+        name = name.strip()
+        if name and name not in preload_tokenizer_names:
+            preload_tokenizer_names.append(name)
+    if len(preload_tokenizer_names) > 1:
+        Global.loaded_tokenizers = LRUCache(len(preload_tokenizer_names))
+
+    if continuous_batching and not ui_dev_mode:
+        Global.generation_scheduler = GenerationScheduler(
+            load_model_fn=lambda model_key: get_model(*model_key),
+            tokenizer_fn=lambda model_key: get_tokenizer(model_key[0]),
+            max_batch_size=max_batch_size)
+
+    if inference_workers > 0 and not ui_dev_mode:
+        # The main process does not keep its own copy of the base model.
+        start_inference_worker_pool(
+            base_model, inference_workers_lora_model, inference_workers)
+    elif (not skip_loading_base_model) and (not ui_dev_mode) and (not preload_model_specs):
         prepare_base_model(base_model)
 
+    if (preload_model_specs or preload_tokenizer_names) and not ui_dev_mode:
+        start_preloading(preload_model_specs, preload_tokenizer_names)
+
     with gr.Blocks(title=get_page_title(), css=main_page_custom_css()) as demo:
         main_page()
 
-    demo.queue(concurrency_count=1).launch(server_name=server_name, share=share)
+    concurrency_count = max(
+        inference_workers, max_batch_size if continuous_batching else 1, 1)
+    demo.queue(concurrency_count=concurrency_count).launch(
+        server_name=server_name, share=share, prevent_thread_lock=True)
+    demo.server_app.add_api_route("/readiness", readiness, methods=["GET"])
+    demo.block_thread()
+
+
+def readiness():
+    readiness = get_readiness()
+    return JSONResponse(
+        readiness, status_code=200 if readiness['ready'] else 503)
+
+
+def gb_to_bytes(gb):
+    if not gb:
+        return None
+    return int(gb * (1024 ** 3))
 
 
 if __name__ == "__main__":
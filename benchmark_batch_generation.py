@@ -0,0 +1,74 @@
+import time
+
+import fire
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+from llama_lora.lib.get_device import get_device
+from llama_lora.lib.inference import generate, generate_batch
+
+
+def main(
+    base_model: str = "HuggingFaceM4/tiny-random-LlamaForCausalLM",
+    prompt_count: int = 64,
+    max_new_tokens: int = 32,
+    max_batch_tokens: int = 4096,
+    max_batch_size: int = 32,
+):
+    '''
+    Compare the throughput of generating for many prompts one by one and with
+    `generate_batch`. Runs on the device that the app would use (set
+    CUDA_VISIBLE_DEVICES="" to benchmark on CPU).
+
+    :param base_model: The model to benchmark with. Defaults to a tiny randomly initialized LLaMA model.
+    :param prompt_count: The number of prompts to generate for.
+    :param max_new_tokens: The number of tokens to generate for each prompt.
+    '''
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    model = AutoModelForCausalLM.from_pretrained(base_model)
+    model.to(get_device())
+    model.eval()
+
+    prompts = [
+        f"Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n### Instruction:\nCount to {i} in {' '.join(['words'] * (i % 16))}.\n\n### Response:\n"
+        for i in range(prompt_count)]
+    # Greedy decoding without an EOS, so that both ways generate the same
+    # number of tokens.
+    generation_config = GenerationConfig(
+        do_sample=False, num_beams=1, eos_token_id=None,
+        min_new_tokens=max_new_tokens)
+
+    start_time = time.time()
+    for prompt in prompts:
+        for _ in generate(
+            model=model,
+            tokenizer=tokenizer,
+            prompt=prompt,
+            generation_config=generation_config,
+            max_new_tokens=max_new_tokens,
+        ):
+            pass
+    sequential_time = time.time() - start_time
+
+    start_time = time.time()
+    generate_batch(
+        model=model,
+        tokenizer=tokenizer,
+        prompts=prompts,
+        generation_config=generation_config,
+        max_new_tokens=max_new_tokens,
+        max_batch_tokens=max_batch_tokens,
+        max_batch_size=max_batch_size,
+    )
+    batched_time = time.time() - start_time
+
+    generated_tokens = prompt_count * max_new_tokens
+    print(f"Device: {get_device()}")
+    print(f"Sequential: {generated_tokens / sequential_time:.1f} tokens/s ({sequential_time:.2f}s)")
+    print(f"Batched:    {generated_tokens / batched_time:.1f} tokens/s ({batched_time:.2f}s)")
+    print(f"Speedup:    {sequential_time / batched_time:.2f}x")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import subprocess
+
+import fire
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+from llama_lora.lib.cpu_quantization import (
+    DEFAULT_SKIP_MODULES, quantize_model_for_cpu)
+from llama_lora.lib.inference import generate
+from llama_lora.lib.load_profiler import get_memory_usage, format_bytes
+
+
+def main(
+    base_model: str = "HuggingFaceM4/tiny-random-LlamaForCausalLM",
+    max_new_tokens: int = 64,
+    runs: int = 3,
+    threads: int = 0,
+    mode: str = "",
+):
+    '''
+    Compare the generation speed and memory usage of a base model on CPU in
+    float32 and with `cpu_quantize` (int8 dynamic quantization). Each mode
+    runs in its own process, so that their RSS can be compared.
+
+    :param base_model: The model to benchmark with. Defaults to a tiny randomly initialized LLaMA model.
+    :param max_new_tokens: The number of tokens to generate in each run.
+    :param runs: The number of generations to average over.
+    :param threads: The number of threads for PyTorch to use. Defaults to PyTorch's default.
+    :param mode: Only run this mode ("float32" or "int8") in the current process.
+    '''
+    if not mode:
+        for mode in ["float32", "int8"]:
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__),
+                f"--base_model={base_model}",
+                f"--max_new_tokens={max_new_tokens}",
+                f"--runs={runs}",
+                f"--threads={threads}",
+                f"--mode={mode}",
+            ], check=True)
+        return
+
+    if threads:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+
+    rss_before_load = get_memory_usage()['rss']
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    if mode == "int8":
+        model = quantize_model_for_cpu(model, DEFAULT_SKIP_MODULES)
+    model.eval()
+    memory_usage = get_memory_usage()
+
+    prompt = "Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n### Instruction:\nTell me about alpacas.\n\n### Response:\n"
+    # Greedy decoding without an EOS, so that each run generates the same
+    # number of tokens.
+    generation_config = GenerationConfig(
+        do_sample=False, num_beams=1, eos_token_id=None,
+        min_new_tokens=max_new_tokens)
+
+    start_time = time.time()
+    for _ in range(runs):
+        for _ in generate(
+            model=model,
+            tokenizer=tokenizer,
+            prompt=prompt,
+            generation_config=generation_config,
+            max_new_tokens=max_new_tokens,
+        ):
+            pass
+    elapsed_time = time.time() - start_time
+
+    print(f"{mode}:")
+    print(f"  Generation: {runs * max_new_tokens / elapsed_time:.1f} tokens/s")
+    print(f"  RSS after load: {format_bytes(memory_usage['rss'])} (+{format_bytes(memory_usage['rss'] - rss_before_load)} for the model)")
+    print(f"  Peak RSS: {format_bytes(get_memory_usage()['peak_rss'])}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
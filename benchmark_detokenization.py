@@ -0,0 +1,57 @@
+import time
+
+import fire
+from transformers import AutoTokenizer
+
+from llama_lora.lib.incremental_detokenizer import IncrementalDetokenizer
+
+
+def main(
+    tokenizer_name: str = "HuggingFaceM4/tiny-random-LlamaForCausalLM",
+    token_count: int = 4096,
+    report_every: int = 512,
+):
+    '''
+    Compare the per-token cost of decoding a streamed output by decoding the
+    whole sequence for every new token, and with `IncrementalDetokenizer`.
+
+    :param tokenizer_name: The tokenizer to benchmark with.
+    :param token_count: The length of the simulated output, in tokens.
+    :param report_every: Report the average per-token decode time of every this many tokens.
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    text = "Héllo wörld, ça va? 你好，世界！ The quick brown fox jumps over the lazy dog. 🦙🦙 "
+    token_ids = []
+    while len(token_ids) < token_count:
+        token_ids += tokenizer.encode(text, add_special_tokens=False)
+    token_ids = token_ids[:token_count]
+
+    full_times = []
+    for i in range(1, len(token_ids) + 1):
+        start_time = time.perf_counter()
+        full_output = tokenizer.decode(token_ids[:i], skip_special_tokens=True)
+        full_times.append(time.perf_counter() - start_time)
+
+    incremental_times = []
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    incremental_output = ""
+    for i in range(1, len(token_ids) + 1):
+        start_time = time.perf_counter()
+        incremental_output += detokenizer.decode(
+            token_ids[:i], final=i == len(token_ids))
+        incremental_times.append(time.perf_counter() - start_time)
+
+    print(f"{'Tokens':>12}  {'Full decode':>14}  {'Incremental':>14}")
+    for start in range(0, len(token_ids), report_every):
+        end = min(start + report_every, len(token_ids))
+        full_time = sum(full_times[start:end]) / (end - start)
+        incremental_time = sum(incremental_times[start:end]) / (end - start)
+        print(
+            f"{start + 1:>5}-{end:<6}  {full_time * 1e6:>11.1f} us  {incremental_time * 1e6:>11.1f} us")
+    print(f"Total: {sum(full_times):.3f}s vs {sum(incremental_times):.3f}s")
+    print(f"Outputs match: {incremental_output == full_output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,81 @@
+import os
+import time
+import tempfile
+
+import fire
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from llama_lora.lib.get_device import get_device
+from llama_lora.lib.load_profiler import (
+    get_memory_usage, reset_peak_memory_usage, format_bytes)
+from llama_lora.lib.parallel_weight_loading import load_sharded_model_in_parallel
+
+
+def main(
+    model_dir: str = "",
+    workers: str = "2,4,8",
+    num_layers: int = 16,
+    hidden_size: int = 1024,
+    max_shard_size: str = "100MB",
+    safe_serialization: bool = True,
+):
+    '''
+    Compare the time and peak RSS of loading a sharded checkpoint with
+    `from_pretrained` and with parallel weight loading.
+
+    :param model_dir: A sharded checkpoint to load. If not set, a randomly initialized LLaMA model is saved as one in a temporary directory.
+    :param workers: Numbers of workers to benchmark parallel loading with, seperated by ",".
+    :param num_layers: The number of layers of the generated model.
+    :param hidden_size: The hidden size of the generated model.
+    :param max_shard_size: The max shard size of the generated checkpoint.
+    :param safe_serialization: Save the generated checkpoint as safetensors.
+    '''
+    if isinstance(workers, str):
+        workers = workers.split(',')
+    workers = [int(n) for n in workers]
+    device = get_device()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if not model_dir:
+            model_dir = temp_dir
+            config = LlamaConfig(
+                hidden_size=hidden_size,
+                intermediate_size=hidden_size * 8 // 3,
+                num_hidden_layers=num_layers,
+                num_attention_heads=max(hidden_size // 128, 1))
+            LlamaForCausalLM(config).save_pretrained(
+                model_dir,
+                max_shard_size=max_shard_size,
+                safe_serialization=safe_serialization)
+            shard_count = len([
+                name for name in os.listdir(model_dir)
+                if name.endswith((".safetensors", ".bin"))])
+            print(f"Saved a random model with {shard_count} shards to {model_dir}.")
+
+        def benchmark(name, load_fn):
+            reset_peak_memory_usage()
+            start_time = time.time()
+            model = load_fn()
+            elapsed_time = time.time() - start_time
+            print(
+                f"{name}: {elapsed_time:.2f}s, peak RSS {format_bytes(get_memory_usage()['peak_rss'])}")
+            del model
+
+        benchmark("from_pretrained", lambda: AutoModelForCausalLM.from_pretrained(
+            model_dir,
+            torch_dtype=torch.float16,
+            low_cpu_mem_usage=True,
+            device_map={"": 0 if device == "cuda" else device}))
+
+        for max_workers in workers:
+            benchmark(f"parallel ({max_workers} workers)", lambda: load_sharded_model_in_parallel(
+                AutoModelForCausalLM,
+                model_dir,
+                device=0 if device == "cuda" else device,
+                torch_dtype=torch.float16,
+                max_workers=max_workers))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
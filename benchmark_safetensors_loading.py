@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+import fire
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from llama_lora.lib.load_profiler import get_memory_usage, format_bytes
+from llama_lora.lib.safetensors_utils import (
+    convert_model_dir_to_safetensors, convert_file_to_safetensors,
+    load_safetensors_file)
+
+
+def main(
+    model_dir: str = "",
+    num_layers: int = 8,
+    hidden_size: int = 1024,
+    lora_r: int = 8,
+    lora_target_modules: str = "q_proj,v_proj",
+    runs: int = 3,
+    mode: str = "",
+):
+    '''
+    Compare the cold load time and peak RSS of a base model (a small randomly
+    initialized LLaMA model) and of a LoRA model, from pickled `.bin`
+    weights (before `load_with_safetensors`) and from memory-mapped
+    safetensors weights (after). Each load runs in a fresh process, with the
+    weight files dropped from the page cache beforehand where possible.
+
+    :param model_dir: A directory to save the generated models in. If not set, a temporary directory is used.
+    :param num_layers: The number of layers of the base model.
+    :param hidden_size: The hidden size of the base model.
+    :param lora_r: The rank of the generated LoRA model.
+    :param lora_target_modules: The modules that the generated LoRA model targets, seperated by ",".
+    :param runs: The number of loads to average over.
+    :param mode: Only load with this mode ("base:bin", "base:safetensors", "lora:bin" or "lora:safetensors") from `model_dir` once, in the current process.
+    '''
+    if mode:
+        benchmark(model_dir, mode)
+        return
+
+    if isinstance(lora_target_modules, str):
+        lora_target_modules = lora_target_modules.split(',')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_dir = model_dir or temp_dir
+        save_models(
+            model_dir, num_layers, hidden_size, lora_r, lora_target_modules)
+
+        for mode in ["base:bin", "base:safetensors", "lora:bin", "lora:safetensors"]:
+            load_times = []
+            peak_rss = []
+            for _ in range(runs):
+                output = subprocess.run([
+                    sys.executable, os.path.abspath(__file__),
+                    f"--model_dir={model_dir}",
+                    f"--mode={mode}",
+                ], check=True, capture_output=True, text=True).stdout
+                load_time, rss = output.strip().splitlines()[-1].split()
+                load_times.append(float(load_time))
+                peak_rss.append(int(rss))
+            print(f"{mode}:")
+            print(f"  Cold load: {sum(load_times) / runs * 1000:.1f}ms")
+            print(f"  Peak RSS: {format_bytes(max(peak_rss))}")
+
+
+def save_models(model_dir, num_layers, hidden_size, lora_r, lora_target_modules):
+    base_model_dir = os.path.join(model_dir, "base_model")
+    config = LlamaConfig(
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 8 // 3,
+        num_hidden_layers=num_layers,
+        num_attention_heads=max(hidden_size // 128, 1))
+    LlamaForCausalLM(config).half().save_pretrained(
+        base_model_dir, safe_serialization=False)
+    convert_model_dir_to_safetensors(
+        base_model_dir, os.path.join(model_dir, "base_model_safetensors"))
+
+    lora_model_dir = os.path.join(model_dir, "lora_model")
+    os.makedirs(lora_model_dir, exist_ok=True)
+    state_dict = {}
+    for i in range(num_layers):
+        for module in lora_target_modules:
+            prefix = f"base_model.model.model.layers.{i}.self_attn.{module}"
+            state_dict[f"{prefix}.lora_A.weight"] = torch.randn(
+                lora_r, hidden_size)
+            state_dict[f"{prefix}.lora_B.weight"] = torch.randn(
+                hidden_size, lora_r)
+    weights_path = os.path.join(lora_model_dir, "adapter_model.bin")
+    torch.save(state_dict, weights_path)
+    convert_file_to_safetensors(
+        weights_path, os.path.join(lora_model_dir, "adapter_model.safetensors"))
+
+    print(f"Saved random models to {model_dir}.")
+
+
+def benchmark(model_dir, mode):
+    target, weights_format = mode.split(":")
+
+    if target == "base":
+        path = os.path.join(
+            model_dir,
+            "base_model_safetensors" if weights_format == "safetensors" else "base_model")
+
+        def load():
+            model = AutoModelForCausalLM.from_pretrained(
+                path, torch_dtype=torch.float16, low_cpu_mem_usage=True)
+            # Memory-mapped weights are only read when they are used.
+            for param in model.parameters():
+                param.sum()
+            return model
+    else:
+        path = os.path.join(
+            model_dir, "lora_model", f"adapter_model.{weights_format}")
+
+        def load():
+            if weights_format == "safetensors":
+                weights = load_safetensors_file(path)
+            else:
+                weights = torch.load(path, map_location="cpu")
+            for tensor in weights.values():
+                tensor.sum()
+            return weights
+
+    drop_from_page_cache(path)
+
+    start_time = time.time()
+    loaded = load()
+    load_time = time.time() - start_time
+    del loaded
+
+    print(load_time, get_memory_usage()['peak_rss'])
+
+
+def drop_from_page_cache(path):
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    for file_path in paths:
+        if not os.path.isfile(file_path):
+            continue
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except (AttributeError, OSError):
+            # Not supported on this platform, the load might be warm.
+            pass
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
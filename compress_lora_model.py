@@ -0,0 +1,156 @@
+import os
+import json
+
+import fire
+import torch
+from peft import PeftModel, set_peft_model_state_dict
+from peft.mapping import MODEL_TYPE_TO_PEFT_MODEL_MAPPING
+
+from llama_lora.globals import Global
+from llama_lora.models import (
+    get_new_base_model, get_tokenizer, get_peft_model_name_or_path,
+    load_lora_model_weights, clear_cache)
+from llama_lora.lib.get_device import get_device
+from llama_lora.lib.lora_compression import (
+    COMPRESSED_WEIGHTS_NAME, COMPRESSION_DTYPES,
+    save_compressed_lora_weights, decompress_lora_tensors,
+    get_layer_output_deltas)
+
+
+def main(
+    lora_model: str = "",
+    data_dir: str = "",
+    dtype: str = "int8",
+    output_name: str = "",
+    base_model: str = "",
+    probe_prompts: str = "",
+):
+    '''
+    Export a LoRA model with its weights stored in lower precision, as a new
+    LoRA model in the data directory. The output difference between the
+    original and the compressed weights is recorded in
+    `compression_report.json`.
+
+    :param lora_model: (required) The name of the LoRA model in the data directory, or a LoRA model on Hugging Face.
+    :param data_dir: (required) The path to the data directory.
+    :param dtype: The precision to store the weights in, one of 'float16', 'bfloat16' or 'int8' (with a scale per output channel).
+    :param output_name: The name of the exported LoRA model. Defaults to '<lora_model>-<dtype>'.
+    :param base_model: The base model to check the output difference with. If not set, only the output difference of each LoRA layer on random inputs is checked.
+    :param probe_prompts: Prompts to check the output difference with, seperated by "|". Requires `base_model`.
+    '''
+
+    data_dir = data_dir or os.environ.get("LLAMA_LORA_DATA_DIR", "")
+    assert (
+        lora_model
+    ), "Please specify a --lora_model, e.g. --lora_model='alpaca-lora-7b'"
+    assert (
+        data_dir
+    ), "Please specify a --data_dir, e.g. --data_dir='./data'"
+    assert (
+        dtype in COMPRESSION_DTYPES
+    ), f"--dtype must be one of {', '.join(COMPRESSION_DTYPES)}"
+
+    Global.data_dir = os.path.abspath(data_dir)
+
+    peft_model_name_or_path = get_peft_model_name_or_path(lora_model)
+    config, weights = load_lora_model_weights(peft_model_name_or_path)
+
+    output_name = output_name or f"{lora_model.rstrip('/').split('/')[-1]}-{dtype}"
+    output_dir = os.path.join(Global.data_dir, "lora_models", output_name)
+    assert (
+        not os.path.exists(output_dir)
+    ), f"The output directory already exists. ({output_dir})"
+    os.makedirs(output_dir)
+
+    config.save_pretrained(output_dir)
+    weights_path = os.path.join(output_dir, COMPRESSED_WEIGHTS_NAME)
+    tensors = save_compressed_lora_weights(weights, weights_path, dtype)
+    compressed_weights = decompress_lora_tensors(tensors)
+
+    layer_output_deltas = get_layer_output_deltas(weights, compressed_weights)
+    report = {
+        'lora_model': lora_model,
+        'dtype': dtype,
+        'original_size': sum(
+            t.numel() * t.element_size() for t in weights.values()),
+        'compressed_size': os.path.getsize(weights_path),
+        'max_layer_output_delta': max(layer_output_deltas.values(), default=0.0),
+        'mean_layer_output_delta': sum(layer_output_deltas.values()) / max(len(layer_output_deltas), 1),
+        'layer_output_deltas': layer_output_deltas,
+    }
+
+    if base_model and probe_prompts:
+        if isinstance(probe_prompts, str):
+            probe_prompts = probe_prompts.split('|')
+        report['probe'] = get_probe_output_deltas(
+            base_model, config, weights, compressed_weights, probe_prompts)
+
+    source_info_path = os.path.join(
+        Global.data_dir, "lora_models", lora_model, "info.json")
+    info = {}
+    if os.path.isfile(source_info_path):
+        with open(source_info_path, "r") as f:
+            info = json.load(f)
+        # The exported weights are stored locally.
+        info.pop("load_from_hf", None)
+        info.pop("hf_model_name", None)
+    info['compressed_from'] = lora_model
+    info['compression_dtype'] = dtype
+    with open(os.path.join(output_dir, "info.json"), "w") as f:
+        json.dump(info, f, indent=2)
+
+    with open(os.path.join(output_dir, "compression_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"Saved {output_name}: {report['original_size'] / (1024 ** 2):.2f} MB -> {report['compressed_size'] / (1024 ** 2):.2f} MB, max layer output delta {report['max_layer_output_delta']:.2e}.")
+    if 'probe' in report:
+        print(
+            f"Probe: max logit delta {report['probe']['max_logit_delta']:.4f}, top-1 agreement {report['probe']['top1_agreement']:.2%}.")
+
+
+def get_probe_output_deltas(base_model, config, weights, compressed_weights, prompts):
+    device = get_device()
+    tokenizer = get_tokenizer(base_model)
+    model = get_new_base_model(base_model)
+    peft_model_class = MODEL_TYPE_TO_PEFT_MODEL_MAPPING.get(
+        config.task_type, PeftModel)
+    peft_model = peft_model_class(model, config)
+    peft_model.eval()
+
+    def get_logits(state_dict):
+        set_peft_model_state_dict(peft_model, state_dict)
+        logits = []
+        with torch.no_grad():
+            for prompt in prompts:
+                input_ids = tokenizer(
+                    prompt, return_tensors="pt").input_ids.to(device)
+                logits.append(
+                    peft_model(input_ids=input_ids).logits.float().cpu())
+        return logits
+
+    logits = get_logits(weights)
+    compressed_logits = get_logits(compressed_weights)
+
+    max_logit_delta = 0.0
+    matched_tokens = 0
+    total_tokens = 0
+    for original, compressed in zip(logits, compressed_logits):
+        max_logit_delta = max(
+            max_logit_delta, (original - compressed).abs().max().item())
+        matched_tokens += (original.argmax(-1) ==
+                           compressed.argmax(-1)).sum().item()
+        total_tokens += original.shape[1]
+
+    del peft_model, model
+    clear_cache()
+
+    return {
+        'prompts': prompts,
+        'max_logit_delta': max_logit_delta,
+        'top1_agreement': matched_tokens / max(total_tokens, 1),
+    }
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -7,7 +7,11 @@ from numba import cuda
 import nvidia_smi
 
 from .utils.lru_cache import LRUCache
+from .utils.model_cache import ModelCache
+from .utils.key_lock import KeyLock, SharedKeyLock
 from .lib.finetune import train
+from .lib.get_device import get_device
+from .lib.cpu_quantization import DEFAULT_SKIP_MODULES as DEFAULT_CPU_QUANTIZE_SKIP_MODULES
 
 
 class Global:
@@ -15,6 +19,18 @@ class Global:
 
     data_dir: str = ""
     load_8bit: bool = False
+    cpu_quantize: bool = False
+    cpu_quantize_skip_modules: List[str] = DEFAULT_CPU_QUANTIZE_SKIP_MODULES
+    load_with_safetensors: bool = False
+    parallel_weight_loading_workers: int = 0
+    torch_compile: bool = True
+    compile_input_length_buckets: List[int] = []
+    merge_lora_models: bool = False
+    merged_models_cache_max_bytes: Optional[int] = None
+    dedupe_lora_models: bool = False
+    stream_layers_from_disk: bool = False
+    resident_layers: int = 2
+    layer_read_ahead: int = 1
 
     default_base_model_name: str = ""
     base_model_name: str = ""
@@ -28,13 +44,26 @@ class Global:
     # Training Control
     should_stop_training = False
 
-    # Generation Control
-    should_stop_generating = False
-    generation_force_stopped_at = None
-
     # Model related
-    loaded_models = LRUCache(1)
+    loaded_models = ModelCache(device=get_device(), max_device_items=1)
     loaded_tokenizers = LRUCache(1)
+    lora_model_load_stats: Dict[str, Dict[str, Any]] = {}
+    prefetched_lora_model: Optional[Tuple[str, Any, Any]] = None
+    lora_model_prefetch_generation = 0
+    merged_model_cache: Any = None
+    last_model_load_profile: Optional[Dict[str, Any]] = None
+    model_load_lock = KeyLock()
+    model_usage_lock = SharedKeyLock()
+    attached_lora_models: Dict[str, Any] = {}
+    max_attached_lora_models: int = 4
+    inference_worker_pool: Any = None
+    generation_scheduler: Any = None
+    prompt_prefix_cache_max_bytes: Optional[int] = None
+    prompt_prefix_cache: Any = None
+    preload_status: Dict[str, Any] = {}
+    lora_model_registry: Any = None
+    blob_store: Any = None
+    inference_worker_pool_model: Optional[Tuple[str, Optional[str]]] = None
     new_base_model_that_is_ready_to_be_used = None
     name_of_new_base_model_that_is_ready_to_be_used = None
 
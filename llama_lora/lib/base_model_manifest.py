@@ -0,0 +1,80 @@
+"""
+Manifests recording how a base model was successfully loaded (the model class
+and flags that worked, and the resolved local snapshot path), so that later
+loads can skip the trial-and-error and the Hub resolution.
+"""
+
+import os
+import re
+import json
+
+from .safetensors_utils import get_files_signature
+
+
+def get_manifest_path(manifests_dir, model_name):
+    file_name = re.sub(r"[^A-Za-z0-9_.-]", "--", model_name.strip("/"))
+    return os.path.join(manifests_dir, f"{file_name}.json")
+
+
+def read_manifest(manifests_dir, model_name):
+    manifest_path = get_manifest_path(manifests_dir, model_name)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if not is_snapshot_unchanged(manifest):
+        print(
+            f"The snapshot of {model_name} has changed, ignoring its load manifest.")
+        remove_manifest(manifests_dir, model_name)
+        return None
+
+    return manifest
+
+
+def write_manifest(manifests_dir, model_name, model_class_name, from_tf, snapshot_path):
+    os.makedirs(manifests_dir, exist_ok=True)
+    manifest = {
+        'model_name': model_name,
+        'model_class': model_class_name,
+        'from_tf': from_tf,
+        'snapshot_path': snapshot_path,
+        'snapshot_commit': get_snapshot_commit(snapshot_path),
+        'snapshot_files': get_files_signature(snapshot_path),
+    }
+    manifest_path = get_manifest_path(manifests_dir, model_name)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def remove_manifest(manifests_dir, model_name):
+    manifest_path = get_manifest_path(manifests_dir, model_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def is_snapshot_unchanged(manifest):
+    snapshot_path = manifest.get('snapshot_path')
+    if not snapshot_path or not os.path.isdir(snapshot_path):
+        return False
+    if get_snapshot_commit(snapshot_path) != manifest.get('snapshot_commit'):
+        return False
+    return get_files_signature(snapshot_path) == manifest.get('snapshot_files')
+
+
+def get_snapshot_commit(snapshot_path):
+    # For models in the Hugging Face cache (".../snapshots/<commit>"), returns
+    # the commit that "refs/main" points to, which changes when a newer
+    # revision has been downloaded.
+    snapshots_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    if os.path.basename(snapshots_dir) != "snapshots":
+        return None
+    ref_path = os.path.join(os.path.dirname(snapshots_dir), "refs", "main")
+    try:
+        with open(ref_path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
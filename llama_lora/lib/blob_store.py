@@ -0,0 +1,187 @@
+"""
+A content-addressed store for model weights. Each tensor is stored once under
+the hash of its content, and model directories keep small manifests
+(`<file>.blobs.json`) that map tensor names to blobs in place of the weight
+files.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import save as save_safetensors_bytes, load_file, save_file
+
+MANIFEST_SUFFIX = ".blobs.json"
+WEIGHTS_FILE_NAMES = [
+    "adapter_model.bin",
+    "adapter_model.safetensors",
+    "pytorch_model.bin",
+]
+
+
+class BlobStore:
+    def __init__(self, blobs_dir, max_cached_bytes=1024 ** 3):
+        self.blobs_dir = blobs_dir
+        self.max_cached_bytes = max_cached_bytes
+
+        # Tensors already loaded in this process, by hash.
+        self.tensor_cache = OrderedDict()
+        self.tensor_cache_bytes = 0
+        self.lock = threading.RLock()
+        # Held while blobs are added or removed, so that garbage collection
+        # won't remove the blobs of a manifest that is being written.
+        self.write_lock = threading.Lock()
+
+    def put_tensor(self, tensor):
+        data = save_safetensors_bytes({'tensor': tensor.contiguous()})
+        blob_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_blob_path(blob_hash)
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, blob_path)
+        return blob_hash
+
+    def get_tensor(self, blob_hash):
+        with self.lock:
+            tensor = self.tensor_cache.get(blob_hash)
+            if tensor is not None:
+                self.tensor_cache.move_to_end(blob_hash)
+                return tensor
+
+        tensor = load_file(self.get_blob_path(blob_hash))['tensor']
+
+        with self.lock:
+            size = tensor.numel() * tensor.element_size()
+            if size <= self.max_cached_bytes:
+                self.tensor_cache[blob_hash] = tensor
+                self.tensor_cache_bytes += size
+                while self.tensor_cache_bytes > self.max_cached_bytes:
+                    _, evicted = self.tensor_cache.popitem(last=False)
+                    self.tensor_cache_bytes -= evicted.numel() * evicted.element_size()
+        return tensor
+
+    def get_blob_path(self, blob_hash):
+        return os.path.join(
+            self.blobs_dir, blob_hash[:2], f"{blob_hash}.safetensors")
+
+    def dedupe_file(self, path):
+        '''
+        Moves the tensors of a weights file into the store and replaces the
+        file with a manifest. Returns the number of bytes freed.
+        '''
+        if path.endswith(".safetensors"):
+            state_dict = load_file(path)
+        else:
+            state_dict = torch.load(path, map_location="cpu")
+
+        with self.write_lock:
+            manifest = {
+                'format': "safetensors" if path.endswith(".safetensors") else "pt",
+                'tensors': {
+                    name: self.put_tensor(tensor)
+                    for name, tensor in state_dict.items()},
+            }
+            del state_dict
+
+            tmp_manifest_path = path + MANIFEST_SUFFIX + ".tmp"
+            with open(tmp_manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_manifest_path, path + MANIFEST_SUFFIX)
+
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
+    def dedupe_model_dir(self, model_dir):
+        '''
+        Dedupes the weights files of a model directory and its checkpoints.
+        '''
+        freed_bytes = 0
+        for path in _get_weights_file_paths(model_dir):
+            if os.path.isfile(path):
+                freed_bytes += self.dedupe_file(path)
+        return freed_bytes
+
+    def load_state_dict(self, path):
+        '''
+        Loads the tensors of a weights file from its manifest.
+        '''
+        with open(path + MANIFEST_SUFFIX, "r") as f:
+            manifest = json.load(f)
+        return {
+            name: self.get_tensor(blob_hash)
+            for name, blob_hash in manifest['tensors'].items()}
+
+    def materialize_file(self, path):
+        '''
+        Writes back a weights file from its manifest, for consumers that need
+        the actual file (e.g. resuming training).
+        '''
+        if os.path.isfile(path) or not has_manifest(path):
+            return
+        with open(path + MANIFEST_SUFFIX, "r") as f:
+            manifest = json.load(f)
+        state_dict = self.load_state_dict(path)
+        tmp_path = path + ".tmp"
+        if manifest['format'] == "safetensors":
+            save_file(state_dict, tmp_path, metadata={'format': 'pt'})
+        else:
+            torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+
+    def materialize_model_dir(self, model_dir):
+        for path in _get_weights_file_paths(model_dir):
+            self.materialize_file(path)
+
+    def collect_garbage(self, roots):
+        '''
+        Removes blobs that are not referenced by any manifest under `roots`.
+        Returns the number of bytes freed.
+        '''
+        with self.write_lock:
+            return self._collect_garbage(roots)
+
+    def _collect_garbage(self, roots):
+        freed_bytes = 0
+        if not os.path.isdir(self.blobs_dir):
+            return freed_bytes
+
+        referenced_hashes = set()
+        for root in roots:
+            for dir_path, _, file_names in os.walk(root):
+                for file_name in file_names:
+                    if not file_name.endswith(MANIFEST_SUFFIX):
+                        continue
+                    with open(os.path.join(dir_path, file_name), "r") as f:
+                        referenced_hashes.update(
+                            json.load(f)['tensors'].values())
+
+        for dir_path, _, file_names in os.walk(self.blobs_dir):
+            for file_name in file_names:
+                blob_hash = file_name.split(".")[0]
+                if blob_hash in referenced_hashes:
+                    continue
+                path = os.path.join(dir_path, file_name)
+                freed_bytes += os.path.getsize(path)
+                os.remove(path)
+        return freed_bytes
+
+
+def has_manifest(path):
+    return os.path.isfile(path + MANIFEST_SUFFIX)
+
+
+def _get_weights_file_paths(model_dir):
+    dirs = [model_dir] + [
+        os.path.join(model_dir, name) for name in sorted(os.listdir(model_dir))
+        if name.startswith("checkpoint-")]
+    return [
+        os.path.join(dir_path, file_name)
+        for dir_path in dirs
+        for file_name in WEIGHTS_FILE_NAMES]
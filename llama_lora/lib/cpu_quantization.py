@@ -0,0 +1,47 @@
+"""
+Dynamic int8 quantization of linear layers for inference on CPUs.
+"""
+
+import torch
+
+# LoRA adapters can only be attached to modules that are still nn.Linear, so
+# the modules commonly targeted by LoRA are kept in full precision, together
+# with the LM head, which is sensitive to quantization.
+DEFAULT_SKIP_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "lm_head"]
+
+
+def get_linear_module_names_to_quantize(model, skip_modules):
+    return {
+        name for name, module in model.named_modules()
+        if type(module) == torch.nn.Linear
+        and name.split(".")[-1] not in skip_modules
+    }
+
+
+def quantize_model_for_cpu(model, skip_modules=DEFAULT_SKIP_MODULES):
+    '''
+    Replaces the linear layers of the model, except for `skip_modules`, with
+    dynamically quantized int8 ones. The model must be in float32.
+    '''
+    module_names = get_linear_module_names_to_quantize(model, skip_modules)
+    if not module_names:
+        return model
+
+    print(f"Quantizing {len(module_names)} linear layers to int8...")
+    return torch.quantization.quantize_dynamic(
+        model, module_names, dtype=torch.qint8, inplace=True)
+
+
+def is_cpu_quantized_model(model):
+    return any(
+        hasattr(module, "_packed_params") for module in model.modules())
+
+
+def get_packed_params_size_in_bytes(module):
+    if not hasattr(module, "_packed_params"):
+        return 0
+    size = 0
+    for tensor in module._packed_params._weight_bias():
+        if tensor is not None:
+            size += tensor.numel() * tensor.element_size()
+    return size
@@ -1,5 +1,4 @@
 import os
-import sys
 import importlib
 from typing import Any, List
 
@@ -17,6 +16,8 @@ from peft import (
 )
 from transformers import LlamaForCausalLM, LlamaTokenizer
 
+from .torch_compile import compile_model
+
 
 def train(
     # model/data params
@@ -302,8 +303,7 @@ def train(
         )
     ).__get__(model, type(model))
 
-    if torch.__version__ >= "2" and sys.platform != "win32":
-        model = torch.compile(model)
+    model = compile_model(model)
 
     train_output = trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
@@ -0,0 +1,410 @@
+"""
+A scheduler that owns the model and runs the generations of all concurrent
+requests in one shared decode loop (continuous batching).
+
+Each new request is prefilled on its own, then its KV cache is left-padded
+and merged into the running batch. Every step decodes one token for each row
+of the batch, and rows that are done are retired right away. Rows are only
+batched with others using the same model (base model and LoRA model); when
+requests for another model are waiting, the batch is drained and the model
+is switched.
+"""
+
+import time
+import queue
+import threading
+import traceback
+from contextlib import contextmanager
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .get_device import get_device
+from .incremental_detokenizer import IncrementalDetokenizer
+from .inference import _prepare_generation_config_for_tokenizer
+from .torch_compile import get_uncompiled_forward
+
+_DONE = object()
+
+
+class _Request:
+    def __init__(
+            self, model_key, input_ids, generation_config, max_new_tokens,
+            eos_token_ids, should_stop):
+        self.model_key = model_key
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = eos_token_ids
+        self.should_stop = should_stop
+        self.logits_processor = _get_logits_processor(generation_config)
+        self.generated_token_count = 0
+        self.output_queue = queue.Queue()
+
+
+class GenerationScheduler:
+    def __init__(self, load_model_fn, tokenizer_fn, max_batch_size=8):
+        '''
+        `load_model_fn(model_key)` returns the model for a model key, and
+        `tokenizer_fn(model_key)` returns its tokenizer.
+        '''
+        self.load_model_fn = load_model_fn
+        self.tokenizer_fn = tokenizer_fn
+        self.max_batch_size = max_batch_size
+        self.device = get_device()
+
+        self.pending_requests = []
+        self.active_requests = []
+        self.model_key = None
+        self.model = None
+        self.past_key_values = None
+        self.attention_mask = None
+
+        self.condition = threading.Condition()
+        self.model_lock = threading.Lock()
+        self.exclusive_waiters = 0
+
+        self.stats = {
+            'steps': 0,
+            'generated_tokens': 0,
+            'admitted_requests': 0,
+            'max_batch_size_reached': 0,
+            'busy_time': 0.0,
+        }
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def generate(
+            self,
+            model_key,
+            prompt,
+            generation_config,
+            max_new_tokens,
+            stream_output=False,
+            stream_text_deltas=False,
+            should_stop=None):
+        '''
+        Same as `lib.inference.generate`, but runs in the shared decode loop.
+        `should_stop` is checked at every step to cancel the generation.
+        Beam search is not supported.
+        '''
+        tokenizer = self.tokenizer_fn(model_key)
+        skip_special_tokens = _prepare_generation_config_for_tokenizer(
+            generation_config, tokenizer)
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+
+        eos_token_ids = generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = tokenizer.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+
+        request = _Request(
+            model_key, input_ids, generation_config, max_new_tokens,
+            set(t for t in eos_token_ids if t is not None), should_stop)
+        with self.condition:
+            self.pending_requests.append(request)
+            self.condition.notify_all()
+
+        detokenizer = IncrementalDetokenizer(
+            tokenizer, skip_special_tokens=skip_special_tokens)
+        decoded_output = ""
+
+        def decode_new_tokens(output, final=False):
+            nonlocal decoded_output
+            delta = detokenizer.decode(output, final=final)
+            decoded_output += delta
+            return delta if stream_text_deltas else decoded_output
+
+        output = input_ids
+        while True:
+            item = request.output_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            output = item
+            if stream_output:
+                yield decode_new_tokens(output), output, False
+
+        yield decode_new_tokens(output, final=True), output, True
+
+    @contextmanager
+    def exclusive(self):
+        '''
+        Waits for the running generations to finish and pauses the decode
+        loop, so that the caller can use (or switch) the model directly.
+        '''
+        with self.condition:
+            self.exclusive_waiters += 1
+            while self.active_requests:
+                self.condition.wait()
+        try:
+            with self.model_lock:
+                # The model might be changed by the caller.
+                self.model_key = None
+                self.model = None
+                yield
+        finally:
+            with self.condition:
+                self.exclusive_waiters -= 1
+                self.condition.notify_all()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['active_requests'] = len(self.active_requests)
+        stats['pending_requests'] = len(self.pending_requests)
+        return stats
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.active_requests and (self.exclusive_waiters or not self.pending_requests):
+                    self.condition.wait()
+
+            with self.model_lock:
+                start_time = time.time()
+                try:
+                    if not self.exclusive_waiters:
+                        self._admit_requests()
+                    if self.active_requests:
+                        self._step()
+                except Exception as e:
+                    traceback.print_exc()
+                    self._fail_active_requests(e)
+                self.stats['busy_time'] += time.time() - start_time
+
+            with self.condition:
+                self.condition.notify_all()
+
+    def _admit_requests(self):
+        with self.condition:
+            if not self.active_requests and self.pending_requests:
+                # Switch to the model of the oldest waiting request.
+                model_key = self.pending_requests[0].model_key
+                if model_key != self.model_key:
+                    self.model_key = model_key
+                    self.model = None
+
+            requests = []
+            for request in list(self.pending_requests):
+                if len(self.active_requests) + len(requests) >= self.max_batch_size:
+                    break
+                if request.model_key == self.model_key:
+                    self.pending_requests.remove(request)
+                    requests.append(request)
+
+        if not requests:
+            return
+
+        if self.model is None:
+            try:
+                model = self.load_model_fn(self.model_key)
+            except Exception as e:
+                for request in requests:
+                    request.output_queue.put(e)
+                    request.output_queue.put(_DONE)
+                return
+            # Batch shapes change at every step, which would make a compiled
+            # model recompile over and over.
+            self.model = get_uncompiled_forward(model)
+
+        for request in requests:
+            try:
+                self._prefill(request)
+            except Exception as e:
+                traceback.print_exc()
+                request.output_queue.put(e)
+                request.output_queue.put(_DONE)
+
+        if len(self.active_requests) >= self.max_batch_size:
+            self.stats['max_batch_size_reached'] += 1
+
+    def _prefill(self, request):
+        input_ids = request.input_ids[None].to(self.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        self.stats['admitted_requests'] += 1
+
+        token_id = self._sample(request, outputs.logits[0, -1])
+        self._append_token(request, token_id)
+        if self._is_finished(request, token_id):
+            self._finish(request)
+            return
+
+        attention_mask = torch.ones(
+            (1, input_ids.shape[1]), dtype=torch.long, device=self.device)
+        if not self.active_requests:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+        else:
+            # Left-pad the shorter side, so that the last positions line up.
+            length = self.attention_mask.shape[1]
+            new_length = attention_mask.shape[1]
+            if new_length < length:
+                past_key_values = _pad_past_left(
+                    past_key_values, length - new_length)
+                attention_mask = _pad_mask_left(
+                    attention_mask, length - new_length)
+            elif new_length > length:
+                self.past_key_values = _pad_past_left(
+                    self.past_key_values, new_length - length)
+                self.attention_mask = _pad_mask_left(
+                    self.attention_mask, new_length - length)
+            self.past_key_values = tuple(
+                tuple(torch.cat([a, b], dim=0) for a, b in zip(layer, new_layer))
+                for layer, new_layer in zip(self.past_key_values, past_key_values))
+            self.attention_mask = torch.cat(
+                [self.attention_mask, attention_mask], dim=0)
+        self.active_requests.append(request)
+
+    def _step(self):
+        input_ids = torch.tensor(
+            [[request.input_ids[-1].item()] for request in self.active_requests],
+            dtype=torch.long, device=self.device)
+        attention_mask = torch.cat([
+            self.attention_mask,
+            torch.ones((len(self.active_requests), 1), dtype=torch.long, device=self.device),
+        ], dim=1)
+        position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.past_key_values,
+                use_cache=True)
+        self.past_key_values = _to_legacy_cache(outputs.past_key_values)
+        self.attention_mask = attention_mask
+        self.stats['steps'] += 1
+
+        finished_rows = []
+        for row, request in enumerate(self.active_requests):
+            token_id = self._sample(request, outputs.logits[row, -1])
+            self._append_token(request, token_id)
+            if self._is_finished(request, token_id):
+                finished_rows.append(row)
+
+        if finished_rows:
+            self._retire_rows(finished_rows)
+
+    def _retire_rows(self, rows):
+        keep_rows = [
+            row for row in range(len(self.active_requests)) if row not in rows]
+        for row in rows:
+            self._finish(self.active_requests[row])
+        self.active_requests = [self.active_requests[row] for row in keep_rows]
+
+        if not keep_rows:
+            self.past_key_values = None
+            self.attention_mask = None
+            return
+
+        index = torch.tensor(keep_rows, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop the leading columns that are padding for all remaining rows.
+        first_column = int((attention_mask.sum(dim=0) > 0).nonzero()[0].item())
+        self.attention_mask = attention_mask[:, first_column:]
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, index)[:, :, first_column:] for t in layer)
+            for layer in self.past_key_values)
+
+    def _sample(self, request, logits):
+        scores = request.logits_processor(
+            request.input_ids[None].to(self.device), logits[None].float())
+        if request.generation_config.do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            return torch.multinomial(probs, num_samples=1)[0, 0].item()
+        return scores[0].argmax().item()
+
+    def _append_token(self, request, token_id):
+        request.input_ids = torch.cat(
+            [request.input_ids, torch.tensor([token_id], dtype=request.input_ids.dtype)])
+        request.generated_token_count += 1
+        self.stats['generated_tokens'] += 1
+        request.output_queue.put(request.input_ids)
+
+    def _is_finished(self, request, token_id):
+        if token_id in request.eos_token_ids:
+            return True
+        if request.generated_token_count >= request.max_new_tokens:
+            return True
+        if request.should_stop and request.should_stop():
+            return True
+        return False
+
+    def _finish(self, request):
+        request.output_queue.put(_DONE)
+
+    def _fail_active_requests(self, e):
+        for request in self.active_requests:
+            request.output_queue.put(e)
+            request.output_queue.put(_DONE)
+        self.active_requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+
+def format_generation_scheduler_stats(stats):
+    average_batch_size = \
+        stats['generated_tokens'] / stats['steps'] if stats['steps'] else 0
+    tokens_per_second = \
+        stats['generated_tokens'] / stats['busy_time'] if stats['busy_time'] else 0
+    return ", ".join([
+        f"{stats['active_requests']} active",
+        f"{stats['pending_requests']} pending",
+        f"{stats['admitted_requests']} served",
+        f"avg batch {average_batch_size:.1f}",
+        f"{tokens_per_second:.1f} tokens/s",
+    ])
+
+
+def _get_logits_processor(generation_config):
+    processors = LogitsProcessorList()
+    if generation_config.repetition_penalty and generation_config.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(
+            penalty=generation_config.repetition_penalty))
+    if generation_config.do_sample:
+        if generation_config.temperature and generation_config.temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(
+                generation_config.temperature))
+        if generation_config.top_k:
+            processors.append(TopKLogitsWarper(top_k=generation_config.top_k))
+        if generation_config.top_p is not None and generation_config.top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=generation_config.top_p))
+    return processors
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _pad_past_left(past_key_values, padding_length):
+    return tuple(
+        tuple(
+            torch.cat([
+                torch.zeros(
+                    (t.shape[0], t.shape[1], padding_length, t.shape[3]),
+                    dtype=t.dtype, device=t.device),
+                t], dim=2)
+            for t in layer)
+        for layer in past_key_values)
+
+
+def _pad_mask_left(attention_mask, padding_length):
+    return torch.cat([
+        torch.zeros(
+            (attention_mask.shape[0], padding_length),
+            dtype=attention_mask.dtype, device=attention_mask.device),
+        attention_mask], dim=1)
@@ -0,0 +1,65 @@
+"""
+Decodes a growing sequence of token IDs into text a few tokens at a time,
+instead of decoding the whole sequence again for each new token.
+
+Each step decodes a small window of tokens: a few tokens whose text has
+already been returned, for context, followed by the new tokens. The context
+is needed because tokenizers such as SentencePiece decode a token
+differently depending on what comes before it (a word-start token only gets
+its leading space when it is not the first token of the decoded sequence).
+When the new tokens end in the middle of a multi-byte character (the window
+decodes to a trailing "�"), nothing is returned until the rest of the
+bytes arrive.
+"""
+
+# The number of already-returned tokens to decode along with the new ones.
+CONTEXT_TOKENS = 5
+
+
+class IncrementalDetokenizer:
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+
+        self.token_ids = []
+        # Tokens in [prefix_offset, read_offset) have been returned, and are
+        # decoded as the context of the new tokens.
+        self.prefix_offset = 0
+        # Tokens from read_offset on have not been returned yet.
+        self.read_offset = 0
+
+    def decode(self, token_ids, final=False):
+        '''
+        Takes the whole sequence of token IDs so far (which must start with
+        the sequence of the previous call) and returns the text of the tokens
+        that are new since the last returned text. With `final`, text that is
+        held back because of an incomplete character is returned as well.
+        '''
+        new_token_ids = token_ids[len(self.token_ids):]
+        if hasattr(new_token_ids, "tolist"):
+            new_token_ids = new_token_ids.tolist()
+        self.token_ids.extend(new_token_ids)
+
+        if self.read_offset >= len(self.token_ids):
+            return ""
+
+        prefix_text = self._decode(
+            self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        if len(new_text) <= len(prefix_text) and not final:
+            # Such as special tokens that are skipped.
+            return ""
+        if new_text.endswith("�") and not final:
+            return ""
+
+        self.prefix_offset = max(
+            self.read_offset, len(self.token_ids) - CONTEXT_TOKENS)
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+    def _decode(self, token_ids):
+        if not token_ids:
+            return ""
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens)
@@ -1,8 +1,13 @@
+import time
+
 import torch
 import transformers
 
 from .get_device import get_device
+from .incremental_detokenizer import IncrementalDetokenizer
 from .streaming_generation_utils import Iteratorize, Stream
+from .torch_compile import get_bucketed_length
+
 
 def generate(
     # model
@@ -14,14 +19,43 @@ def generate(
     max_new_tokens,
     stopping_criteria=[],
     # output options
-    stream_output=False
+    stream_output=False,
+    # yield only the text generated since the previous yield, instead of the
+    # whole decoded output
+    stream_text_deltas=False,
+    # left-pad the input to one of these lengths, to bound the number of
+    # input shapes a compiled model sees
+    input_length_buckets=None,
+    # reuse the KV of `prompt_prefix`, the constant start of the prompt, from
+    # `prefix_cache` (a `PromptPrefixCache`), with `prefix_cache_key` being
+    # (base model, LoRA model, template)
+    prompt_prefix=None,
+    prefix_cache=None,
+    prefix_cache_key=None,
 ):
     device = get_device()
+    start_time = time.time()
 
     inputs = tokenizer(prompt, return_tensors="pt")
-    input_ids = inputs["input_ids"].to(device)
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    padding_length = 0
+    if input_length_buckets:
+        padding_length = get_bucketed_length(
+            input_ids.shape[1], input_length_buckets) - input_ids.shape[1]
+    if padding_length > 0:
+        pad_token_id = tokenizer.pad_token_id or 0
+        input_ids = torch.cat([
+            torch.full((1, padding_length), pad_token_id, dtype=input_ids.dtype),
+            input_ids], dim=1)
+        attention_mask = torch.cat([
+            torch.zeros((1, padding_length), dtype=attention_mask.dtype),
+            attention_mask], dim=1)
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
     generate_params = {
         "input_ids": input_ids,
+        "attention_mask": attention_mask,
         "generation_config": generation_config,
         "return_dict_in_generate": True,
         "output_scores": True,
@@ -29,25 +63,46 @@ def generate(
         "stopping_criteria": transformers.StoppingCriteriaList() + stopping_criteria
     }
 
-    skip_special_tokens = True
+    # Only greedy search and sampling run with the batch of one that the
+    # cached KV is for.
+    prefix_cache_hit = None
+    if prefix_cache and prompt_prefix and padding_length == 0 and (generation_config.num_beams or 1) == 1:
+        past_key_values, hit = prefix_cache.get_past_key_values(
+            model,
+            input_ids,
+            tokenizer(prompt_prefix)["input_ids"],
+            prefix_cache_key)
+        if past_key_values is not None:
+            generate_params["past_key_values"] = past_key_values
+            prefix_cache_hit = hit
 
-    if '/dolly' in tokenizer.name_or_path:
-        # dolly has additional_special_tokens as ['### End', '### Instruction:', '### Response:'], skipping them will break the prompter's reply extraction.
-        skip_special_tokens = False
-        # Ensure generation stops once it generates "### End"
-        end_key_token_id = tokenizer.encode("### End")
-        end_key_token_id = end_key_token_id[0]  # 50277
-        if isinstance(generate_params['generation_config'].eos_token_id, str):
-            generate_params['generation_config'].eos_token_id = [generate_params['generation_config'].eos_token_id]
-        elif not generate_params['generation_config'].eos_token_id:
-            generate_params['generation_config'].eos_token_id = []
-        generate_params['generation_config'].eos_token_id.append(end_key_token_id)
+    def record_time_to_first_token():
+        nonlocal prefix_cache_hit
+        if prefix_cache_hit is None:
+            return
+        prefix_cache.record_time_to_first_token(
+            prefix_cache_key[-1], time.time() - start_time, prefix_cache_hit)
+        prefix_cache_hit = None
+
+    skip_special_tokens = _prepare_generation_config_for_tokenizer(
+        generation_config, tokenizer)
 
     if stream_output:
         # Stream the reply 1 token at a time.
         # This is based on the trick of using 'stopping_criteria' to create an iterator,
         # from https://github.com/oobabooga/text-generation-webui/blob/ad37f396fc8bcbab90e11ecf17c56c97bfbd4a9c/modules/text_generation.py#L216-L243.
         generation_output = None
+        # Only the new tokens are decoded for each step, so the cost of
+        # decoding stays flat as the output grows.
+        detokenizer = IncrementalDetokenizer(
+            tokenizer, skip_special_tokens=skip_special_tokens)
+        decoded_output = ""
+
+        def decode_new_tokens(output, final=False):
+            nonlocal decoded_output
+            delta = detokenizer.decode(output, final=final)
+            decoded_output += delta
+            return delta if stream_text_deltas else decoded_output
 
         def generate_with_callback(callback=None, **kwargs):
             nonlocal generation_output
@@ -65,22 +120,137 @@ def generate(
 
         with generate_with_streaming(**generate_params) as generator:
             for output in generator:
-                decoded_output = tokenizer.decode(output, skip_special_tokens=skip_special_tokens)
-                yield decoded_output, output, False
+                output = output[padding_length:]
+                record_time_to_first_token()
+                yield decode_new_tokens(output), output, False
                 if output[-1] in [tokenizer.eos_token_id]:
                     break
 
         if generation_output:
-            output = generation_output.sequences[0]
-            decoded_output = tokenizer.decode(output, skip_special_tokens=skip_special_tokens)
-            yield decoded_output, output, True
+            output = generation_output.sequences[0][padding_length:]
+            yield decode_new_tokens(output, final=True), output, True
 
         return  # early return for stream_output
 
     # Without streaming
+    if prefix_cache_hit is not None:
+        # Stopping criteria are checked after each new token, so this is
+        # called once the first token is generated.
+        def record_time_to_first_token_criteria(input_ids, score, **kwargs):
+            record_time_to_first_token()
+            return False
+
+        generate_params["stopping_criteria"].insert(
+            0, record_time_to_first_token_criteria)
+
     with torch.no_grad():
         generation_output = model.generate(**generate_params)
-    output = generation_output.sequences[0]
+    output = generation_output.sequences[0][padding_length:]
     decoded_output = tokenizer.decode(output, skip_special_tokens=skip_special_tokens)
     yield decoded_output, output, True
     return
+
+
+def generate_batch(
+    # model
+    model,
+    tokenizer,
+    # input
+    prompts,
+    generation_config,
+    max_new_tokens,
+    stopping_criteria=[],
+    # micro-batching
+    max_batch_tokens=4096,
+    max_batch_size=32,
+):
+    '''
+    Generates for a list of prompts in left-padded micro-batches, each
+    holding at most `max_batch_tokens` tokens (padded input plus
+    `max_new_tokens`, for each beam) and `max_batch_size` prompts. Returns
+    `(decoded_output, output)` for each prompt, in the order of `prompts`.
+    '''
+    device = get_device()
+    skip_special_tokens = _prepare_generation_config_for_tokenizer(
+        generation_config, tokenizer)
+    pad_token_id = tokenizer.pad_token_id or 0
+    num_beams = generation_config.num_beams or 1
+
+    encoded_prompts = [
+        tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+        for prompt in prompts]
+    # Prompts of similar lengths are batched together to reduce padding.
+    order = sorted(
+        range(len(prompts)), key=lambda i: len(encoded_prompts[i]))
+
+    results = [None] * len(prompts)
+    for batch_indices in _get_micro_batches(
+            order, encoded_prompts, max_new_tokens, num_beams,
+            max_batch_tokens, max_batch_size):
+        batch_length = max(len(encoded_prompts[i]) for i in batch_indices)
+        input_ids = torch.full(
+            (len(batch_indices), batch_length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(
+            (len(batch_indices), batch_length), dtype=torch.long)
+        for row, i in enumerate(batch_indices):
+            length = len(encoded_prompts[i])
+            input_ids[row, batch_length - length:] = encoded_prompts[i]
+            attention_mask[row, batch_length - length:] = 1
+
+        with torch.no_grad():
+            generation_output = model.generate(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                generation_config=generation_config,
+                return_dict_in_generate=True,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=pad_token_id,
+                stopping_criteria=transformers.StoppingCriteriaList() + stopping_criteria)
+
+        for row, i in enumerate(batch_indices):
+            padding_length = batch_length - len(encoded_prompts[i])
+            output = generation_output.sequences[row][padding_length:]
+            decoded_output = tokenizer.decode(
+                output, skip_special_tokens=skip_special_tokens)
+            results[i] = (decoded_output, output)
+
+    return results
+
+
+def _get_micro_batches(
+        order, encoded_prompts, max_new_tokens, num_beams,
+        max_batch_tokens, max_batch_size):
+    batch = []
+    batch_length = 0
+    for i in order:
+        length = max(batch_length, len(encoded_prompts[i]))
+        tokens = (len(batch) + 1) * (length + max_new_tokens) * num_beams
+        if batch and (tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            yield batch
+            batch = []
+            length = len(encoded_prompts[i])
+        batch.append(i)
+        batch_length = length
+    if batch:
+        yield batch
+
+
+def _prepare_generation_config_for_tokenizer(generation_config, tokenizer):
+    '''
+    Returns whether special tokens should be skipped when decoding.
+    '''
+    skip_special_tokens = True
+
+    if '/dolly' in tokenizer.name_or_path:
+        # dolly has additional_special_tokens as ['### End', '### Instruction:', '### Response:'], skipping them will break the prompter's reply extraction.
+        skip_special_tokens = False
+        # Ensure generation stops once it generates "### End"
+        end_key_token_id = tokenizer.encode("### End")
+        end_key_token_id = end_key_token_id[0]  # 50277
+        if isinstance(generation_config.eos_token_id, str):
+            generation_config.eos_token_id = [generation_config.eos_token_id]
+        elif not generation_config.eos_token_id:
+            generation_config.eos_token_id = []
+        generation_config.eos_token_id.append(end_key_token_id)
+
+    return skip_special_tokens
@@ -0,0 +1,215 @@
+"""
+Serves generation requests with multiple worker processes sharing the same
+model weights.
+
+The parent process moves the weights of a loaded model into shared memory,
+and each worker process builds an empty model skeleton and points its
+parameters at those shared tensors, so N workers don't need N copies of the
+model in RAM.
+"""
+
+import os
+import queue
+import itertools
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from transformers import GenerationConfig
+
+from .inference import generate
+
+# The number of recently cancelled requests that are remembered, so that
+# cancelled requests still waiting in the task queue are skipped.
+CANCELLED_REQUEST_IDS_SIZE = 256
+
+
+class InferenceWorkerPool:
+    def __init__(self, model, tokenizer, num_workers, threads_per_worker=None):
+        if threads_per_worker is None:
+            threads_per_worker = max((os.cpu_count() or 1) // num_workers, 1)
+
+        model.eval()
+        model.share_memory()
+        # Tensors in shared memory are sent to the workers as handles, not
+        # copied.
+        self.state_dict = model.state_dict()
+
+        ctx = mp.get_context("spawn")
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.current_request_ids = ctx.Array('q', [-1] * num_workers)
+        self.cancel_flags = ctx.Array('b', [0] * num_workers)
+        self.cancelled_request_ids = ctx.Array(
+            'q', [-1] * CANCELLED_REQUEST_IDS_SIZE)
+        self.cancelled_request_count = 0
+
+        self.request_ids = itertools.count()
+        self.request_queues = {}
+        self.request_queues_lock = threading.Lock()
+
+        self.workers = []
+        for worker_index in range(num_workers):
+            worker = ctx.Process(
+                target=_worker_main,
+                args=(
+                    worker_index,
+                    type(model),
+                    model.config,
+                    self.state_dict,
+                    tokenizer,
+                    threads_per_worker,
+                    self.task_queue,
+                    self.result_queue,
+                    self.current_request_ids,
+                    self.cancel_flags,
+                    self.cancelled_request_ids,
+                ),
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.dispatcher_thread = threading.Thread(
+            target=self._dispatch_results, daemon=True)
+        self.dispatcher_thread.start()
+
+        print(
+            f"Started {num_workers} inference workers with {threads_per_worker} threads each.")
+
+    def generate(
+            self,
+            prompt,
+            generation_config,
+            max_new_tokens,
+            stream_output=False,
+            stream_text_deltas=False,
+            should_stop=None):
+        '''
+        Same as `lib.inference.generate`, but runs on one of the workers.
+        `should_stop` is polled to cancel the generation. The generation is
+        also cancelled if the caller stops consuming it before it completes.
+        '''
+        request_id = next(self.request_ids)
+        request_queue = queue.Queue()
+        with self.request_queues_lock:
+            self.request_queues[request_id] = request_queue
+
+        completed = False
+        try:
+            self.task_queue.put((
+                request_id,
+                prompt,
+                generation_config.to_dict(),
+                max_new_tokens,
+                stream_output,
+                stream_text_deltas))
+
+            while True:
+                if should_stop and should_stop():
+                    return
+                try:
+                    result = request_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                decoded_output, output, completed, error = result
+                if error:
+                    completed = True
+                    raise ValueError(error)
+                yield decoded_output, torch.tensor(output), completed
+                if completed:
+                    return
+        finally:
+            if not completed:
+                self._cancel(request_id)
+            with self.request_queues_lock:
+                self.request_queues.pop(request_id, None)
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+
+    def _cancel(self, request_id):
+        # Remembered first, so that a worker picking up the request now
+        # either sees it here or gets its cancel flag set below.
+        with self.cancelled_request_ids.get_lock():
+            self.cancelled_request_ids[
+                self.cancelled_request_count % CANCELLED_REQUEST_IDS_SIZE] = request_id
+            self.cancelled_request_count += 1
+        for worker_index in range(len(self.workers)):
+            if self.current_request_ids[worker_index] == request_id:
+                self.cancel_flags[worker_index] = 1
+
+    def _dispatch_results(self):
+        while True:
+            request_id, *result = self.result_queue.get()
+            with self.request_queues_lock:
+                request_queue = self.request_queues.get(request_id)
+            if request_queue:
+                request_queue.put(result)
+
+
+def _worker_main(
+        worker_index,
+        model_class,
+        config,
+        state_dict,
+        tokenizer,
+        threads_per_worker,
+        task_queue,
+        result_queue,
+        current_request_ids,
+        cancel_flags,
+        cancelled_request_ids):
+    from accelerate import init_empty_weights
+    from accelerate.utils import set_module_tensor_to_device
+
+    torch.set_num_threads(threads_per_worker)
+
+    with init_empty_weights():
+        model = model_class(config)
+    for name, tensor in state_dict.items():
+        # Parameters are pointed at the shared tensors without copying them.
+        set_module_tensor_to_device(model, name, "cpu", value=tensor)
+    model.tie_weights()
+    model.eval()
+
+    def should_stop(input_ids, score, **kwargs):
+        return bool(cancel_flags[worker_index])
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+
+        request_id, prompt, generation_config, max_new_tokens, stream_output, stream_text_deltas = task
+        current_request_ids[worker_index] = request_id
+        cancel_flags[worker_index] = 0
+        if request_id in cancelled_request_ids[:]:
+            # Cancelled while waiting in the queue.
+            current_request_ids[worker_index] = -1
+            continue
+
+        try:
+            for (decoded_output, output, completed) in generate(
+                model=model,
+                tokenizer=tokenizer,
+                prompt=prompt,
+                generation_config=GenerationConfig(**generation_config),
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=[should_stop],
+                stream_output=stream_output,
+                stream_text_deltas=stream_text_deltas,
+            ):
+                result_queue.put(
+                    (request_id, decoded_output, output.tolist(), completed, None))
+                if cancel_flags[worker_index]:
+                    break
+        except Exception as e:
+            traceback.print_exc()
+            result_queue.put((request_id, None, None, True, str(e)))
+        finally:
+            current_request_ids[worker_index] = -1
@@ -0,0 +1,233 @@
+"""
+Runs models that don't fit in memory by keeping the weights of most decoder
+layers on disk, memory-mapped from safetensors files, and loading each layer
+right before it runs.
+
+Only a bounded number of layers are resident at a time. While a layer runs,
+the next layers are read ahead on a background thread.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from transformers import AutoConfig
+
+SAFETENSORS_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+
+
+class LayerStreamer:
+    def __init__(
+            self,
+            layers,
+            layer_prefixes,
+            weight_files,
+            device,
+            torch_dtype,
+            max_resident_layers=2,
+            read_ahead=1):
+        self.layers = layers
+        self.layer_prefixes = layer_prefixes
+        self.weight_files = weight_files
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.max_resident_layers = max(max_resident_layers, 1)
+        self.read_ahead = read_ahead
+
+        self.file_handles = {}
+        self.resident_layers = OrderedDict()
+        self.pending_layers = {}
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.stats = {
+            'layer_loads': 0,
+            'read_ahead_hits': 0,
+            'load_time': 0.0,
+            'wait_time': 0.0,
+        }
+
+        # Names of the tensors of each layer in the checkpoint, relative to
+        # the layer.
+        self.layer_tensor_names = []
+        for prefix in layer_prefixes:
+            self.layer_tensor_names.append([
+                name for name in weight_files.keys() if name.startswith(prefix)])
+
+        for index, layer in enumerate(layers):
+            layer.register_forward_pre_hook(self._get_pre_hook(index))
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def _get_pre_hook(self, index):
+        def pre_hook(module, args):
+            self._ensure_resident(index)
+            for i in range(1, self.read_ahead + 1):
+                self._schedule_read(
+                    (index + i) % len(self.layers))
+        return pre_hook
+
+    def _ensure_resident(self, index):
+        with self.lock:
+            if index in self.resident_layers:
+                self.resident_layers.move_to_end(index)
+                return
+            future = self.pending_layers.pop(index, None)
+
+        start_time = time.time()
+        if future:
+            tensors = future.result()
+            self.stats['read_ahead_hits'] += 1
+        else:
+            tensors = self._read_layer(index)
+        self.stats['wait_time'] += time.time() - start_time
+
+        with self.lock:
+            layer = self.layers[index]
+            prefix = self.layer_prefixes[index]
+            for name, tensor in tensors.items():
+                set_module_tensor_to_device(
+                    layer, name[len(prefix):], self.device, value=tensor,
+                    dtype=self.torch_dtype if tensor.is_floating_point() else None)
+            self.resident_layers[index] = True
+            self.stats['layer_loads'] += 1
+
+            while len(self.resident_layers) > self.max_resident_layers:
+                evicted_index, _ = self.resident_layers.popitem(last=False)
+                self._release_layer(evicted_index)
+
+    def _schedule_read(self, index):
+        with self.lock:
+            if index in self.resident_layers or index in self.pending_layers:
+                return
+            self.pending_layers[index] = self.executor.submit(
+                self._read_layer, index)
+
+    def _read_layer(self, index):
+        start_time = time.time()
+        tensors = {}
+        for name in self.layer_tensor_names[index]:
+            tensors[name] = self._get_file_handle(
+                self.weight_files[name]).get_tensor(name)
+        self.stats['load_time'] += time.time() - start_time
+        return tensors
+
+    def _release_layer(self, index):
+        layer = self.layers[index]
+        prefix = self.layer_prefixes[index]
+        for name in self.layer_tensor_names[index]:
+            set_module_tensor_to_device(layer, name[len(prefix):], "meta")
+
+    def _get_file_handle(self, path):
+        with self.lock:
+            handle = self.file_handles.get(path)
+            if handle is None:
+                handle = self.file_handles[path] = safe_open(
+                    path, framework="pt", device="cpu")
+            return handle
+
+
+def load_model_with_layer_streaming(
+        model_class,
+        model_dir,
+        device,
+        torch_dtype=None,
+        max_resident_layers=2,
+        read_ahead=1,
+        trust_remote_code=False):
+    '''
+    Loads a model from a safetensors checkpoint in `model_dir`, with only
+    the weights outside of the decoder layers loaded into memory.
+    '''
+    weight_files = get_weight_files(model_dir)
+
+    config = AutoConfig.from_pretrained(
+        model_dir, trust_remote_code=trust_remote_code)
+    with init_empty_weights():
+        model = model_class.from_config(
+            config, trust_remote_code=trust_remote_code)
+
+    layers_name, layers = find_decoder_layers(model)
+    layer_prefixes = [f"{layers_name}.{i}." for i in range(len(layers))]
+    expected_keys = set(model.state_dict().keys())
+
+    file_handles = {}
+    for name, path in weight_files.items():
+        if name not in expected_keys:
+            continue
+        if any(name.startswith(prefix) for prefix in layer_prefixes):
+            continue
+        if path not in file_handles:
+            file_handles[path] = safe_open(path, framework="pt", device="cpu")
+        tensor = file_handles[path].get_tensor(name)
+        set_module_tensor_to_device(
+            model, name, device, value=tensor,
+            dtype=torch_dtype if tensor.is_floating_point() else None)
+    del file_handles
+
+    # Buffers that are not in the checkpoint (such as the non-persistent
+    # rotary embedding caches, also the ones in the decoder layers) are
+    # created on the CPU, and will never be loaded or released by the
+    # streamer.
+    for name, buffer in list(model.named_buffers()):
+        if name in weight_files:
+            continue
+        set_module_tensor_to_device(model, name, device, value=buffer)
+
+    model.tie_weights()
+    model.eval()
+
+    model.layer_streamer = LayerStreamer(
+        layers,
+        layer_prefixes,
+        weight_files,
+        device=device,
+        torch_dtype=torch_dtype,
+        max_resident_layers=max_resident_layers,
+        read_ahead=read_ahead)
+    return model
+
+
+def is_layer_streamed_model(model):
+    return hasattr(model, "layer_streamer")
+
+
+def get_weight_files(model_dir):
+    '''
+    Returns `{tensor_name: file_path}` of a safetensors checkpoint.
+    '''
+    index_path = os.path.join(model_dir, SAFETENSORS_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        return {
+            name: os.path.join(model_dir, file_name)
+            for name, file_name in index['weight_map'].items()}
+
+    path = os.path.join(model_dir, SAFETENSORS_WEIGHTS_NAME)
+    if not os.path.isfile(path):
+        raise ValueError(f"{model_dir} has no safetensors weights.")
+    with safe_open(path, framework="pt", device="cpu") as f:
+        return {name: path for name in f.keys()}
+
+
+def find_decoder_layers(model):
+    '''
+    Returns the name and the module of the largest `ModuleList` in the model,
+    which is the stack of decoder layers in decoder-only models.
+    '''
+    candidates = [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(module, torch.nn.ModuleList) and len(module) > 0]
+    if not candidates:
+        raise ValueError("Cannot find the decoder layers of the model.")
+    return max(candidates, key=lambda c: len(c[1]))
@@ -0,0 +1,221 @@
+"""
+Records the time taken and the memory usage of each phase of a model load.
+The peak memory usage of each phase is sampled while the phase runs.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import torch
+
+_current = threading.local()
+
+
+class LoadProfiler:
+    # How often the memory usage is sampled while there are open phases.
+    sample_interval = 0.01
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self.depth = 0
+
+        # Peaks are sampled for each open phase instead of resetting the
+        # process-wide peak counters, which would overwrite the peaks of the
+        # outer phases and of loads on other threads.
+        self.open_phases = []
+        self.lock = threading.Lock()
+        self.sampler_thread = None
+        self.sampler_stopped = threading.Event()
+
+    @contextmanager
+    def phase(self, phase_name):
+        peaks = {'peak_rss': None, 'peak_cuda_memory': None}
+        with self.lock:
+            self.open_phases.append(peaks)
+        self._sample()
+        self._start_sampler()
+        start_time = time.time()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self._sample()
+            with self.lock:
+                self.open_phases.remove(peaks)
+            # Phases are appended when they end, so nested phases come before
+            # the phase they are in.
+            self.phases.append({
+                'phase': phase_name,
+                'depth': self.depth,
+                'duration': time.time() - start_time,
+                **get_memory_usage(),
+                **peaks,
+            })
+
+    def _start_sampler(self):
+        if self.sampler_thread:
+            return
+
+        def sample():
+            while not self.sampler_stopped.wait(self.sample_interval):
+                self._sample()
+
+        self.sampler_thread = threading.Thread(target=sample, daemon=True)
+        self.sampler_thread.start()
+
+    def _sample(self):
+        usage = get_memory_usage()
+        rss = usage['rss'] if usage['rss'] is not None else usage['peak_rss']
+        with self.lock:
+            for peaks in self.open_phases:
+                peaks['peak_rss'] = _max(peaks['peak_rss'], rss)
+                peaks['peak_cuda_memory'] = _max(
+                    peaks['peak_cuda_memory'], usage['cuda_memory'])
+
+    def finish(self):
+        self.finished_at = time.time()
+        self.sampler_stopped.set()
+
+    def get_total_time(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'total_time': self.get_total_time(),
+            'phases': self.phases,
+        }
+
+    def format_summary(self):
+        lines = [f"Loaded {self.name} in {self.get_total_time():.2f}s:"]
+        for phase in self.phases:
+            indent = "  " * (phase['depth'] + 1)
+            line = f"{indent}{phase['phase']}: {phase['duration']:.2f}s, peak RSS {format_bytes(phase['peak_rss'])}"
+            if phase.get('peak_cuda_memory') is not None:
+                line += f", peak CUDA memory {format_bytes(phase['peak_cuda_memory'])}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile_load(name, on_finish=None):
+    '''
+    Starts profiling a load on the current thread. Loads started inside of
+    another one are recorded as part of the outer one, and `on_finish` is
+    only called for the outermost load.
+    '''
+    profiler = getattr(_current, 'profiler', None)
+    if profiler:
+        yield profiler
+        return
+
+    profiler = _current.profiler = LoadProfiler(name)
+    try:
+        yield profiler
+    finally:
+        _current.profiler = None
+        profiler.finish()
+
+    if on_finish:
+        on_finish(profiler)
+
+
+@contextmanager
+def load_phase(phase_name):
+    '''
+    Records a phase of the load being profiled on the current thread, if any.
+    '''
+    profiler = getattr(_current, 'profiler', None)
+    if not profiler:
+        yield
+        return
+
+    with profiler.phase(phase_name):
+        yield
+
+
+def append_load_record(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def format_load_summary(record, max_phases=3):
+    '''
+    Formats the total time of a load record and its slowest top-level phases
+    in one line.
+    '''
+    phases = sorted(
+        [phase for phase in record['phases'] if phase.get('depth', 0) == 0],
+        key=lambda phase: phase['duration'], reverse=True)
+    summary = f"{record['name']} in {record['total_time']:.1f}s"
+    if phases:
+        summary += " (" + ", ".join(
+            f"{phase['phase']} {phase['duration']:.1f}s"
+            for phase in phases[:max_phases]) + ")"
+    return summary
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def reset_peak_memory_usage():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        # Resets the peak RSS (VmHWM) of the process, Linux only.
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except Exception:
+        pass
+
+
+def get_memory_usage():
+    usage = {
+        'rss': None,
+        'peak_rss': None,
+        'cuda_memory': None,
+        'peak_cuda_memory': None,
+    }
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage['rss'] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    usage['peak_rss'] = int(line.split()[1]) * 1024
+    except Exception:
+        try:
+            import resource
+            # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            usage['peak_rss'] = max_rss if sys.platform == "darwin" else max_rss * 1024
+        except Exception:
+            pass
+
+    if torch.cuda.is_available():
+        usage['cuda_memory'] = torch.cuda.memory_allocated()
+        usage['peak_cuda_memory'] = torch.cuda.max_memory_allocated()
+
+    return usage
+
+
+def format_bytes(size):
+    if size is None:
+        return "N/A"
+    return f"{size / (1024 ** 3):.2f} GB"
@@ -0,0 +1,107 @@
+"""
+Combines multiple LoRA models into one with weights, e.g.
+"lora-a:0.7+lora-b:0.3".
+
+The combined LoRA model concatenates the ranks of its parts, so its output is
+exactly the weighted sum of theirs: `sum(w_i * s_i * B_i @ A_i) = B @ A`, with
+`A = [A_1; A_2; ...]` and `B = [w_1 * s_1 * B_1, w_2 * s_2 * B_2, ...]`,
+where `s_i` is the scaling (`lora_alpha / r`) of each part.
+"""
+
+import re
+import copy
+import hashlib
+
+import torch
+
+SPEC_ITEM_PATTERN = re.compile(r"^(.+):(-?[0-9]*\.?[0-9]+)$")
+
+
+def parse_lora_composition_spec(spec):
+    '''
+    Returns a list of `(lora_model_name, weight)`, or None if `spec` is not a
+    composition of LoRA models.
+    '''
+    if not spec or ("+" not in spec and not SPEC_ITEM_PATTERN.match(spec)):
+        return None
+
+    items = []
+    for part in spec.split("+"):
+        part = part.strip()
+        if not part:
+            continue
+        match = SPEC_ITEM_PATTERN.match(part)
+        if match:
+            items.append((match.group(1).strip(), float(match.group(2))))
+        else:
+            items.append((part, 1.0))
+    return items
+
+
+def get_lora_composition_key(items, model_hashes):
+    h = hashlib.sha256()
+    for (name, weight), model_hash in zip(items, model_hashes):
+        h.update(f"{name}:{weight!r}:{model_hash}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def compose_lora_weights(parts):
+    '''
+    `parts` is a list of `(config, weights, weight)`. Returns the config and
+    weights of the combined LoRA model.
+    '''
+    base_config = parts[0][0]
+    for config, _, _ in parts[1:]:
+        if config.fan_in_fan_out != base_config.fan_in_fan_out or config.task_type != base_config.task_type:
+            raise ValueError(
+                "Only LoRA models with the same task type and fan_in_fan_out can be combined.")
+
+    layer_names = []
+    for _, weights, _ in parts:
+        for key in weights.keys():
+            if ".lora_A" in key:
+                layer_name = key.split(".lora_A")[0]
+                if layer_name not in layer_names:
+                    layer_names.append(layer_name)
+
+    composed_weights = {}
+    for layer_name in layer_names:
+        key_a = _find_key(parts, layer_name, "lora_A")
+        key_b = _find_key(parts, layer_name, "lora_B")
+        in_features = next(
+            w[key_a].shape[1] for _, w, _ in parts if key_a in w)
+        out_features = next(
+            w[key_b].shape[0] for _, w, _ in parts if key_b in w)
+
+        a_blocks = []
+        b_blocks = []
+        for config, weights, weight in parts:
+            if key_a in weights:
+                scaling = config.lora_alpha / config.r
+                a_blocks.append(weights[key_a].float())
+                b_blocks.append(weights[key_b].float() * (weight * scaling))
+            else:
+                # This part does not target the layer.
+                a_blocks.append(torch.zeros(config.r, in_features))
+                b_blocks.append(torch.zeros(out_features, config.r))
+
+        composed_weights[key_a] = torch.cat(a_blocks, dim=0).contiguous()
+        composed_weights[key_b] = torch.cat(b_blocks, dim=1).contiguous()
+
+    # Scaling is folded into lora_B, so lora_alpha == r gives a scaling of 1.
+    composed_config = copy.deepcopy(base_config)
+    composed_config.r = sum(config.r for config, _, _ in parts)
+    composed_config.lora_alpha = composed_config.r
+    composed_config.target_modules = sorted(set(
+        module for config, _, _ in parts for module in config.target_modules))
+    composed_config.lora_dropout = 0.0
+    return composed_config, composed_weights
+
+
+def _find_key(parts, layer_name, lora_name):
+    prefix = f"{layer_name}.{lora_name}"
+    for _, weights, _ in parts:
+        for key in weights.keys():
+            if key.startswith(prefix):
+                return key
+    raise ValueError(f"{prefix} is missing.")
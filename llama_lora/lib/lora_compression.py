@@ -0,0 +1,92 @@
+"""
+Stores LoRA weights in lower precision: fp16, bf16, or int8 with a float32
+scale per output channel.
+"""
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+COMPRESSED_WEIGHTS_NAME = "adapter_model.compressed.safetensors"
+COMPRESSION_DTYPES = ["float16", "bfloat16", "int8"]
+SCALE_SUFFIX = ".scale"
+
+
+def compress_lora_state_dict(state_dict, dtype):
+    if dtype not in COMPRESSION_DTYPES:
+        raise ValueError(
+            f"Unknown dtype: {dtype}. Expects one of {', '.join(COMPRESSION_DTYPES)}.")
+
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().float()
+        if dtype == "int8" and tensor.dim() == 2:
+            # Rows are the output channels of both lora_A ([r, in]) and
+            # lora_B ([out, r]).
+            scale = tensor.abs().amax(dim=1, keepdim=True) / 127
+            scale = torch.where(scale == 0, torch.ones_like(scale), scale)
+            tensors[name] = torch.round(tensor / scale).clamp(-127, 127).to(torch.int8).contiguous()
+            tensors[name + SCALE_SUFFIX] = scale.contiguous()
+        elif dtype == "bfloat16":
+            tensors[name] = tensor.bfloat16().contiguous()
+        else:
+            tensors[name] = tensor.half().contiguous()
+    return tensors
+
+
+def decompress_lora_tensors(tensors, dtype=torch.float32):
+    state_dict = {}
+    for name, tensor in tensors.items():
+        if name.endswith(SCALE_SUFFIX):
+            continue
+        scale = tensors.get(name + SCALE_SUFFIX)
+        if scale is not None:
+            state_dict[name] = (tensor.float() * scale).to(dtype)
+        else:
+            state_dict[name] = tensor.to(dtype)
+    return state_dict
+
+
+def save_compressed_lora_weights(state_dict, path, dtype):
+    tensors = compress_lora_state_dict(state_dict, dtype)
+    save_file(tensors, path, metadata={
+        'format': 'pt',
+        'lora_compression': dtype,
+    })
+    return tensors
+
+
+def load_compressed_lora_weights(path, dtype=torch.float32):
+    tensors = {}
+    with safe_open(path, framework="pt", device="cpu") as f:
+        for name in f.keys():
+            tensors[name] = f.get_tensor(name)
+    return decompress_lora_tensors(tensors, dtype)
+
+
+def get_layer_output_deltas(state_dict, compressed_state_dict, probe_count=64, seed=0):
+    '''
+    Feeds random probe inputs through each `lora_B @ lora_A` pair of the
+    original and compressed weights, and returns the relative error of the
+    outputs for each layer.
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    deltas = {}
+    for name_a, lora_a in state_dict.items():
+        if "lora_A" not in name_a:
+            continue
+        name_b = name_a.replace("lora_A", "lora_B")
+        if name_b not in state_dict:
+            continue
+        lora_a = lora_a.float()
+        lora_b = state_dict[name_b].float()
+        probes = torch.randn(
+            probe_count, lora_a.shape[1], generator=generator)
+
+        output = probes @ lora_a.T @ lora_b.T
+        compressed_output = probes @ compressed_state_dict[name_a].float().T @ compressed_state_dict[name_b].float().T
+        output_norm = output.norm().item()
+        deltas[name_a.split(".lora_A")[0]] = (
+            (output - compressed_output).norm().item() / output_norm
+            if output_norm > 0 else 0.0)
+    return deltas
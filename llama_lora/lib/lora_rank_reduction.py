@@ -0,0 +1,117 @@
+"""
+Reduces the rank of trained LoRA weights with a truncated SVD of each
+`lora_B @ lora_A` product.
+"""
+
+import time
+
+import torch
+
+
+def get_lora_weight_pairs(state_dict):
+    '''
+    Returns `{layer_name: (lora_A_key, lora_B_key)}`.
+    '''
+    pairs = {}
+    for key in state_dict.keys():
+        if ".lora_A" not in key:
+            continue
+        key_b = key.replace(".lora_A", ".lora_B")
+        if key_b in state_dict:
+            pairs[key.split(".lora_A")[0]] = (key, key_b)
+    return pairs
+
+
+def decompose_lora_weights(lora_a, lora_b):
+    '''
+    Returns `(u, s, vh)` with `u @ diag(s) @ vh == lora_b @ lora_a`, without
+    materializing the full `[out, in]` product: with `lora_b = Qb Rb` and
+    `lora_a.T = Qa Ra`, only the `[r, r]` matrix `Rb Ra.T` is decomposed.
+    '''
+    lora_a = lora_a.float()
+    lora_b = lora_b.float()
+    q_b, r_b = torch.linalg.qr(lora_b)
+    q_a, r_a = torch.linalg.qr(lora_a.T)
+    u, s, vh = torch.linalg.svd(r_b @ r_a.T)
+    return q_b @ u, s, vh @ q_a.T
+
+
+def get_rank_for_energy(s, energy_threshold):
+    energy = s.pow(2)
+    total_energy = energy.sum()
+    if total_energy == 0:
+        return 1
+    cumulative_energy = energy.cumsum(0) / total_energy
+    return int((cumulative_energy < energy_threshold).sum().item()) + 1
+
+
+def reduce_lora_rank(state_dict, lora_r, target_rank=None, energy_threshold=None):
+    '''
+    Truncates every LoRA layer to the same rank, which is `target_rank`, or
+    the smallest rank that keeps at least `energy_threshold` of the squared
+    singular values of every layer. Returns `(state_dict, rank, layer_stats)`.
+
+    The scaling of LoRA is `lora_alpha / r`, so the returned `lora_B` is
+    rescaled by `rank / lora_r` to keep the output unchanged with the same
+    `lora_alpha`.
+    '''
+    if not target_rank and not energy_threshold:
+        raise ValueError("Either target_rank or energy_threshold is required.")
+
+    pairs = get_lora_weight_pairs(state_dict)
+    decompositions = {
+        layer_name: decompose_lora_weights(state_dict[key_a], state_dict[key_b])
+        for layer_name, (key_a, key_b) in pairs.items()}
+
+    layer_stats = {}
+    for layer_name, (u, s, vh) in decompositions.items():
+        layer_stats[layer_name] = {
+            'singular_values': s.tolist(),
+        }
+        if energy_threshold:
+            layer_stats[layer_name]['rank_for_energy_threshold'] = get_rank_for_energy(
+                s, energy_threshold)
+
+    # PEFT uses one rank for all layers.
+    rank = target_rank or max(
+        stats['rank_for_energy_threshold'] for stats in layer_stats.values())
+    rank = min(rank, lora_r)
+
+    reduced_state_dict = dict(state_dict)
+    for layer_name, (key_a, key_b) in pairs.items():
+        u, s, vh = decompositions[layer_name]
+        sqrt_s = s[:rank].sqrt()
+        dtype = state_dict[key_a].dtype
+        reduced_state_dict[key_a] = (sqrt_s[:, None] * vh[:rank]).to(dtype).contiguous()
+        reduced_state_dict[key_b] = (u[:, :rank] * sqrt_s[None, :] * (rank / lora_r)).to(dtype).contiguous()
+
+        energy = s.pow(2)
+        total_energy = energy.sum().item()
+        layer_stats[layer_name]['retained_energy'] = (
+            energy[:rank].sum().item() / total_energy if total_energy > 0 else 1.0)
+
+    return reduced_state_dict, rank, layer_stats
+
+
+def get_lora_params_count(state_dict):
+    return sum(
+        state_dict[key_a].numel() + state_dict[key_b].numel()
+        for key_a, key_b in get_lora_weight_pairs(state_dict).values())
+
+
+def benchmark_lora_layers(state_dict, tokens=512, repeat=10):
+    '''
+    Returns the time (in seconds) to run all of the LoRA layers once over
+    `tokens` input tokens, on the CPU.
+    '''
+    pairs = [
+        (state_dict[key_a].float(), state_dict[key_b].float())
+        for key_a, key_b in get_lora_weight_pairs(state_dict).values()]
+    inputs = [torch.randn(tokens, lora_a.shape[1]) for lora_a, _ in pairs]
+
+    with torch.no_grad():
+        start_time = time.time()
+        for _ in range(repeat):
+            for (lora_a, lora_b), x in zip(pairs, inputs):
+                (x @ lora_a.T) @ lora_b.T
+    return (time.time() - start_time) / repeat
@@ -0,0 +1,158 @@
+"""
+A disk cache of base models with LoRA weights merged into them, keyed by the
+content hash of the base model and LoRA model weights.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import fnmatch
+import threading
+
+# "*.blobs.json" are manifests of weights deduped into the blob store.
+WEIGHTS_FILE_PATTERNS = ["*.bin", "*.safetensors", "*.pt", "*.pth", "*.blobs.json"]
+CONFIG_FILE_PATTERNS = ["config.json", "adapter_config.json"]
+
+
+class MergedModelCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.file_hashes_path = os.path.join(cache_dir, "file_hashes.json")
+        self.lock = threading.RLock()
+
+    def get_key(self, base_model_dir, lora_model_dir):
+        h = hashlib.sha256()
+        for model_dir in [base_model_dir, lora_model_dir]:
+            h.update(f"{self.get_dir_hash(model_dir)}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def get_dir_hash(self, model_dir):
+        '''
+        Returns a hash of the content of the weights and config files in
+        `model_dir`.
+        '''
+        h = hashlib.sha256()
+        for file_name, file_hash in self._get_dir_file_hashes(model_dir):
+            h.update(f"{file_name}:{file_hash}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            manifest = self._read_json(self.manifest_path)
+            entry = manifest.get(key)
+            path = os.path.join(self.cache_dir, key)
+            if not entry or not os.path.isdir(path):
+                return None
+
+            entry['last_used_at'] = time.time()
+            self._write_json(self.manifest_path, manifest)
+            return path
+
+    def put(self, key, model):
+        with self.lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, key)
+            tmp_path = path + ".tmp"
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+
+            # Saved as safetensors so that it can be memory-mapped when loaded.
+            model.save_pretrained(tmp_path, safe_serialization=True)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+
+            manifest = self._read_json(self.manifest_path)
+            manifest[key] = {
+                'size': get_dir_size(path),
+                'created_at': time.time(),
+                'last_used_at': time.time(),
+            }
+            self._write_json(self.manifest_path, manifest)
+
+            self._evict(keep_key=key)
+            return path
+
+    def _evict(self, keep_key=None):
+        if self.max_bytes is None:
+            return
+
+        manifest = self._read_json(self.manifest_path)
+        least_recently_used_keys = sorted(
+            manifest.keys(), key=lambda k: manifest[k].get('last_used_at', 0))
+        total_size = sum(entry.get('size', 0) for entry in manifest.values())
+
+        for key in least_recently_used_keys:
+            if total_size <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            print(f"Evicting merged model {key} from cache...")
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total_size -= manifest.pop(key).get('size', 0)
+
+        self._write_json(self.manifest_path, manifest)
+
+    def _get_dir_file_hashes(self, model_dir):
+        file_hashes = self._read_json(self.file_hashes_path)
+        results = []
+        changed = False
+
+        for file_name in sorted(os.listdir(model_dir)):
+            if not any(fnmatch.fnmatch(file_name, p) for p in WEIGHTS_FILE_PATTERNS + CONFIG_FILE_PATTERNS):
+                continue
+            file_path = os.path.realpath(os.path.join(model_dir, file_name))
+            stat = os.stat(file_path)
+            memo_key = f"{file_path}:{stat.st_size}:{stat.st_mtime_ns}"
+            file_hash = file_hashes.get(memo_key)
+            if not file_hash:
+                file_hash = get_file_hash(file_path)
+                file_hashes[memo_key] = file_hash
+                changed = True
+            results.append((file_name, file_hash))
+
+        if changed:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._write_json(self.file_hashes_path, file_hashes)
+
+        return results
+
+    def _read_json(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_json(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def get_file_hash(file_path):
+    # Files in the Hugging Face cache are stored as blobs named by their
+    # SHA-256, there is no need to read them again.
+    file_name = os.path.basename(file_path)
+    if re.fullmatch(r"[0-9a-f]{64}", file_name):
+        return file_name
+
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
@@ -0,0 +1,103 @@
+"""
+Loads sharded checkpoints by reading and deserializing shards concurrently,
+placing the weights of each shard into the model as soon as it's ready.
+
+At most `max_workers` shards are read ahead at a time, and each shard is
+released once its weights are placed, so the peak host memory is bounded by
+the size of that many shards (plus the model itself if it's on the CPU).
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors.torch import load_file
+from transformers import AutoConfig
+
+WEIGHTS_INDEX_NAMES = [
+    "model.safetensors.index.json",
+    "pytorch_model.bin.index.json",
+]
+
+
+def get_weights_index_path(model_dir):
+    for index_name in WEIGHTS_INDEX_NAMES:
+        index_path = os.path.join(model_dir, index_name)
+        if os.path.isfile(index_path):
+            return index_path
+    return None
+
+
+def load_sharded_model_in_parallel(
+        model_class,
+        model_dir,
+        device,
+        torch_dtype=None,
+        max_workers=4,
+        trust_remote_code=False):
+    index_path = get_weights_index_path(model_dir)
+    if not index_path:
+        raise ValueError(f"{model_dir} is not a sharded checkpoint.")
+
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    shard_names = sorted(set(index['weight_map'].values()))
+
+    config = AutoConfig.from_pretrained(
+        model_dir, trust_remote_code=trust_remote_code)
+    with init_empty_weights():
+        model = model_class.from_config(
+            config, trust_remote_code=trust_remote_code)
+    expected_keys = set(model.state_dict().keys())
+
+    def load_shard(shard_name):
+        shard_path = os.path.join(model_dir, shard_name)
+        if shard_name.endswith(".safetensors"):
+            return load_file(shard_path)
+        return torch.load(shard_path, map_location="cpu")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        remaining_shard_names = iter(shard_names)
+        pending_futures = set()
+
+        def submit_next_shard():
+            shard_name = next(remaining_shard_names, None)
+            if shard_name:
+                pending_futures.add(executor.submit(load_shard, shard_name))
+
+        for _ in range(max_workers):
+            submit_next_shard()
+
+        while pending_futures:
+            done_futures, pending_futures = wait(
+                pending_futures, return_when=FIRST_COMPLETED)
+            while done_futures:
+                future = done_futures.pop()
+                state_dict = future.result()
+                for name, tensor in state_dict.items():
+                    if name not in expected_keys:
+                        continue
+                    dtype = torch_dtype if tensor.is_floating_point() else None
+                    set_module_tensor_to_device(
+                        model, name, device, value=tensor, dtype=dtype)
+                # A finished future keeps its result, drop it so that the
+                # shard can be freed.
+                del state_dict, future
+                submit_next_shard()
+
+    model.tie_weights()
+
+    missing_keys = [
+        name for name, param in model.named_parameters()
+        if param.device.type == "meta"]
+    if missing_keys:
+        raise ValueError(
+            f"Weights of {', '.join(missing_keys[:5])}{'...' if len(missing_keys) > 5 else ''} are missing in {model_dir}.")
+
+    # Non-persistent buffers are created on the CPU.
+    model.to(device)
+    model.eval()
+    return model
@@ -0,0 +1,176 @@
+"""
+Caches the `past_key_values` of the constant start of prompts (such as the
+preamble of a prompt template), so that only the rest of each prompt has to
+be prefilled.
+
+Entries are keyed by the base model, the LoRA model, the template and the
+token IDs of the prefix, and are stored in a cache that evicts them by the
+bytes they occupy (such as `utils.model_cache.ModelCache`).
+"""
+
+import hashlib
+import threading
+
+import torch
+
+from .torch_compile import get_uncompiled_forward
+
+# The prefix cache is not used for prefixes shorter than this.
+MIN_PREFIX_TOKENS = 8
+
+
+class PromptPrefixCache:
+    def __init__(self, cache):
+        '''
+        `cache` stores the entries. It should have `get(key)`,
+        `set(key, value, size)` and `clear()`.
+        '''
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.template_stats = {}
+
+    def get_past_key_values(
+            self, model, input_ids, prefix_input_ids, key):
+        '''
+        Returns `(past_key_values, hit)`, where `past_key_values` covers all
+        but the last token of `input_ids`, so that it can be passed to
+        `model.generate` along with the whole `input_ids`. The prefix part is
+        taken from the cache if possible. Returns `(None, False)` if the
+        prefix is too short to be worth it.
+
+        `input_ids` is a batch of one, and `prefix_input_ids` are the token
+        IDs of the constant start of the prompt when it is tokenized alone.
+        '''
+        prefix_length = _get_common_prefix_length(
+            input_ids[0].tolist(), prefix_input_ids)
+        # The last token of the prefix might be tokenized differently when
+        # it is followed by the rest of the prompt, and the last token of
+        # the prompt is left for `model.generate` to run.
+        prefix_length = min(prefix_length - 1, input_ids.shape[1] - 1)
+        if prefix_length < MIN_PREFIX_TOKENS:
+            return None, False
+
+        # Prefix and suffix lengths vary by request, which would make a
+        # compiled model recompile on the request path.
+        forward = get_uncompiled_forward(model)
+
+        prefix_ids = input_ids[:, :prefix_length]
+        cache_key = _get_cache_key(key, prefix_ids)
+        prefix_past_key_values = self.cache.get(cache_key)
+        hit = prefix_past_key_values is not None
+        if not hit:
+            with torch.no_grad():
+                outputs = forward(input_ids=prefix_ids, use_cache=True)
+            prefix_past_key_values = _to_legacy_cache(outputs.past_key_values)
+            self.cache.set(
+                cache_key, prefix_past_key_values,
+                size=_get_past_key_values_size(prefix_past_key_values))
+
+        # Prefill onto a copy, so that the cached entry is never modified.
+        past_key_values = _to_cache(tuple(
+            tuple(t.clone() for t in layer)
+            for layer in prefix_past_key_values))
+        suffix_ids = input_ids[:, prefix_length:-1]
+        if suffix_ids.shape[1] > 0:
+            with torch.no_grad():
+                outputs = forward(
+                    input_ids=suffix_ids,
+                    attention_mask=torch.ones(
+                        (1, input_ids.shape[1] - 1),
+                        dtype=torch.long, device=input_ids.device),
+                    past_key_values=past_key_values,
+                    use_cache=True)
+            past_key_values = outputs.past_key_values
+
+        return past_key_values, hit
+
+    def record_time_to_first_token(self, template_name, seconds, hit):
+        with self.lock:
+            stats = self.template_stats.setdefault(template_name, {
+                'hits': 0,
+                'misses': 0,
+                'hit_time_to_first_token': 0.0,
+                'miss_time_to_first_token': 0.0,
+            })
+            if hit:
+                stats['hits'] += 1
+                stats['hit_time_to_first_token'] += seconds
+            else:
+                stats['misses'] += 1
+                stats['miss_time_to_first_token'] += seconds
+
+    def get_stats(self):
+        '''
+        Returns the average time to first token with and without a cached
+        prefix, and the time saved by the cache, for each template.
+        '''
+        with self.lock:
+            stats = {}
+            for template_name, s in self.template_stats.items():
+                avg_hit = s['hit_time_to_first_token'] / s['hits'] if s['hits'] else None
+                avg_miss = s['miss_time_to_first_token'] / s['misses'] if s['misses'] else None
+                stats[template_name] = {
+                    'hits': s['hits'],
+                    'misses': s['misses'],
+                    'avg_time_to_first_token_with_cached_prefix': avg_hit,
+                    'avg_time_to_first_token_without_cached_prefix': avg_miss,
+                    'avg_time_to_first_token_saved':
+                        avg_miss - avg_hit
+                        if avg_hit is not None and avg_miss is not None
+                        else None,
+                }
+            return stats
+
+    def clear(self):
+        self.cache.clear()
+
+
+def format_prefix_cache_stats(template_name, stats):
+    avg_hit = stats['avg_time_to_first_token_with_cached_prefix']
+    avg_miss = stats['avg_time_to_first_token_without_cached_prefix']
+    message = f"Prompt prefix cache ({template_name}): {stats['hits']} hits, {stats['misses']} misses"
+    if avg_hit is not None:
+        message += f", TTFT with cached prefix {avg_hit * 1000:.1f}ms"
+    if avg_miss is not None:
+        message += f", without {avg_miss * 1000:.1f}ms"
+    if stats['avg_time_to_first_token_saved'] is not None:
+        message += f" (saved {stats['avg_time_to_first_token_saved'] * 1000:.1f}ms)"
+    return message
+
+
+def _get_common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _get_cache_key(key, prefix_ids):
+    prefix_hash = hashlib.sha256(
+        ",".join(str(i) for i in prefix_ids[0].tolist()).encode("utf-8")
+    ).hexdigest()[:16]
+    return "prompt_prefix:" + "//".join(str(k) for k in key) + f"//{prefix_hash}"
+
+
+def _get_past_key_values_size(past_key_values):
+    return sum(
+        t.numel() * t.element_size()
+        for layer in past_key_values for t in layer)
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _to_cache(past_key_values):
+    # Newer versions of transformers expect a `Cache` object instead of
+    # tuples.
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
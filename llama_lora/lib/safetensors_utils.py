@@ -0,0 +1,119 @@
+"""
+Helpers to convert pickled PyTorch checkpoints to safetensors, which can be
+memory-mapped when loaded instead of being deserialized into fresh memory.
+"""
+
+import os
+import json
+import shutil
+import fnmatch
+
+import torch
+from safetensors.torch import save_file, load_file
+
+PYTORCH_WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+SAFETENSORS_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+CONVERSION_INFO_NAME = "safetensors_conversion.json"
+
+
+def has_safetensors_weights(model_dir):
+    return any(
+        fnmatch.fnmatch(file_name, "*.safetensors")
+        for file_name in os.listdir(model_dir))
+
+
+def convert_model_dir_to_safetensors(source_dir, target_dir):
+    '''
+    Converts a (possibly sharded) `pytorch_model.bin` checkpoint in
+    `source_dir` to safetensors in `target_dir`, along with the other files
+    needed to load it. The conversion is skipped if `target_dir` has already
+    been converted from the same source.
+    '''
+    source_dir = os.path.realpath(source_dir)
+    conversion_info = {
+        'source_dir': source_dir,
+        'source_files': get_files_signature(source_dir),
+    }
+    conversion_info_path = os.path.join(target_dir, CONVERSION_INFO_NAME)
+    if os.path.isfile(conversion_info_path):
+        with open(conversion_info_path, "r") as f:
+            if json.load(f) == conversion_info:
+                return target_dir
+
+    print(f"Converting {source_dir} to safetensors...")
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    os.makedirs(target_dir)
+
+    index_path = os.path.join(source_dir, PYTORCH_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        shard_names = sorted(set(index['weight_map'].values()))
+        shard_name_map = {
+            shard_name: get_safetensors_shard_name(shard_name)
+            for shard_name in shard_names}
+        # Convert one shard at a time to keep the peak memory usage low.
+        for shard_name in shard_names:
+            convert_file_to_safetensors(
+                os.path.join(source_dir, shard_name),
+                os.path.join(target_dir, shard_name_map[shard_name]))
+        index['weight_map'] = {
+            k: shard_name_map[v] for k, v in index['weight_map'].items()}
+        with open(os.path.join(target_dir, SAFETENSORS_WEIGHTS_INDEX_NAME), "w") as f:
+            json.dump(index, f, indent=2)
+    else:
+        convert_file_to_safetensors(
+            os.path.join(source_dir, "pytorch_model.bin"),
+            os.path.join(target_dir, "model.safetensors"))
+
+    for file_name in os.listdir(source_dir):
+        if fnmatch.fnmatch(file_name, "*.bin") or file_name == PYTORCH_WEIGHTS_INDEX_NAME:
+            continue
+        source_path = os.path.join(source_dir, file_name)
+        if os.path.isfile(source_path):
+            shutil.copy2(source_path, os.path.join(target_dir, file_name))
+
+    with open(conversion_info_path, "w") as f:
+        json.dump(conversion_info, f, indent=2)
+
+    return target_dir
+
+
+def convert_file_to_safetensors(source_path, target_path):
+    state_dict = torch.load(source_path, map_location="cpu")
+
+    # safetensors does not allow tensors sharing memory (e.g. tied weights).
+    seen_data_ptrs = set()
+    tensors = {}
+    for key, tensor in state_dict.items():
+        tensor = tensor.contiguous()
+        if tensor.data_ptr() in seen_data_ptrs:
+            tensor = tensor.clone()
+        seen_data_ptrs.add(tensor.data_ptr())
+        tensors[key] = tensor
+
+    tmp_path = target_path + ".tmp"
+    save_file(tensors, tmp_path, metadata={'format': 'pt'})
+    os.replace(tmp_path, target_path)
+    del state_dict, tensors
+
+
+def load_safetensors_file(path, device="cpu"):
+    # Tensors are memory-mapped from the file instead of being unpickled.
+    return load_file(path, device=device)
+
+
+def get_safetensors_shard_name(shard_name):
+    name = shard_name
+    if name.startswith("pytorch_model"):
+        name = "model" + name[len("pytorch_model"):]
+    return name[:-len(".bin")] + ".safetensors"
+
+
+def get_files_signature(dir_path):
+    signature = []
+    for file_name in sorted(os.listdir(dir_path)):
+        stat = os.stat(os.path.join(dir_path, file_name))
+        signature.append([file_name, stat.st_size, stat.st_mtime_ns])
+    return signature
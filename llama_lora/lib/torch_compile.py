@@ -0,0 +1,151 @@
+"""
+Helpers around torch.compile: compiling, warming up over a bounded set of
+input shapes, persisting compile artifacts and collecting compile metrics.
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+compile_stats = {
+    'compiled_models': 0,
+    'warmup_time': 0.0,
+    'warmed_up_lengths': [],
+}
+
+
+def is_compile_supported():
+    return torch.__version__ >= "2" and sys.platform != "win32"
+
+
+def compile_model(model):
+    '''
+    Compiles the forward of the model in place. Wrapping the model with
+    `torch.compile(model)` would not work for generation, since `generate`
+    of the wrapper is the one of the original model, which calls the
+    original forward.
+
+    For PEFT models, the forward of the wrapped model is compiled, since
+    `generate` of a PEFT model calls it directly instead of the forward of
+    the PEFT model.
+    '''
+    target = _get_compile_target(model)
+    if not is_compile_supported() or is_compiled_model(target):
+        return model
+    target._uncompiled_forward = target.forward
+    target.forward = torch.compile(target.forward)
+    compile_stats['compiled_models'] += 1
+    return model
+
+
+def uncompile_model(model):
+    target = _get_compile_target(model)
+    if not is_compiled_model(target):
+        return model
+    target.forward = target._uncompiled_forward
+    del target._uncompiled_forward
+    return model
+
+
+def is_compiled_model(model):
+    return "_uncompiled_forward" in vars(_get_compile_target(model))
+
+
+def get_uncompiled_forward(model):
+    '''
+    Returns a callable that runs the model without compilation, for inputs
+    of shapes that would otherwise cause a recompile each.
+    '''
+    return vars(_get_compile_target(model)).get("_uncompiled_forward", model)
+
+
+def _get_compile_target(model):
+    # LoRA layers are injected into the modules of the wrapped model, so
+    # running its forward directly still applies them.
+    get_base_model = getattr(model, "get_base_model", None)
+    if get_base_model:
+        return get_base_model()
+    return model
+
+
+def enable_persistent_compile_cache(cache_dir):
+    '''
+    Makes TorchInductor keep its compiled artifacts in `cache_dir`, so that
+    they can be reused across restarts.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+    except Exception as e:
+        print(f"Notice: cannot enable the persistent compile cache: {e}")
+
+
+def get_bucketed_length(length, buckets):
+    for bucket in sorted(buckets):
+        if bucket >= length:
+            return bucket
+    return length
+
+
+def warmup_compiled_model(model, device, pad_token_id, buckets):
+    '''
+    Runs a short generation for each input length bucket, so that the
+    compilation happens now instead of on the first user request.
+    '''
+    if not is_compiled_model(model):
+        return
+
+    for length in sorted(buckets):
+        start_time = time.time()
+        input_ids = torch.full(
+            (1, length), pad_token_id or 0, dtype=torch.long, device=device)
+        attention_mask = torch.ones_like(input_ids)
+        with torch.no_grad():
+            model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=2,
+                do_sample=False,
+                pad_token_id=pad_token_id)
+        elapsed_time = time.time() - start_time
+        compile_stats['warmup_time'] += elapsed_time
+        compile_stats['warmed_up_lengths'].append(length)
+        print(
+            f"Warmed up compiled model for input length {length} in {elapsed_time:.2f}s.")
+
+
+def format_compile_stats(stats):
+    parts = [f"{stats['compiled_models']} compiled"]
+    if 'unique_graphs' in stats:
+        parts += [
+            f"{stats['unique_graphs']} graphs",
+            f"{stats['recompiles']} recompiles",
+            f"{stats['graph_breaks']} graph breaks",
+        ]
+    parts.append(f"warmup {stats['warmup_time']:.1f}s")
+    return ", ".join(parts)
+
+
+def get_compile_stats():
+    stats = dict(compile_stats)
+    try:
+        from torch._dynamo.utils import counters
+        stats['unique_graphs'] = counters["stats"]["unique_graphs"]
+        stats['calls_captured'] = counters["stats"]["calls_captured"]
+        stats['graph_breaks'] = sum(counters["graph_break"].values())
+        stats['recompiles'] = sum(counters["recompiles"].values())
+        # Older versions of PyTorch only keep the guard failures that caused
+        # each recompile.
+        from torch._dynamo.utils import guard_failures
+        stats['recompiles'] = max(
+            stats['recompiles'],
+            sum(len(failures) for failures in guard_failures.values()))
+    except Exception:
+        pass
+    return stats
@@ -1,34 +1,122 @@
 import os
-import sys
 import gc
 import json
 import re
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 
 import torch
+from safetensors.torch import save_file
 from transformers import (
     AutoModelForCausalLM, AutoModel,
-    AutoTokenizer, LlamaTokenizer
+    AutoTokenizer, LlamaTokenizer, AutoConfig
 )
-from peft import PeftModel
+from huggingface_hub import hf_hub_download, snapshot_download, list_repo_files
+from peft import PeftModel, LoraConfig, set_peft_model_state_dict
+from peft.mapping import MODEL_TYPE_TO_PEFT_MODEL_MAPPING
+from peft.utils import WEIGHTS_NAME
+
+SAFETENSORS_WEIGHTS_NAME = "adapter_model.safetensors"
+
+MODEL_CLASSES = {
+    'AutoModelForCausalLM': AutoModelForCausalLM,
+    'AutoModel': AutoModel,
+}
 
 from .globals import Global
 from .lib.get_device import get_device
+from .lib.merged_model_cache import MergedModelCache
+from .lib.blob_store import BlobStore, MANIFEST_SUFFIX, has_manifest
+from .lib.lora_compression import COMPRESSED_WEIGHTS_NAME, load_compressed_lora_weights
+from .lib.lora_composition import (
+    parse_lora_composition_spec, get_lora_composition_key, compose_lora_weights)
+from .lib.inference_worker_pool import InferenceWorkerPool
+from .lib.prompt_prefix_cache import PromptPrefixCache
+from .lib.load_profiler import profile_load, load_phase, append_load_record
+from .lib.cpu_quantization import quantize_model_for_cpu, is_cpu_quantized_model
+from .lib.torch_compile import (
+    compile_model, is_compiled_model, warmup_compiled_model,
+    get_compile_stats, format_compile_stats)
+from .lib.base_model_manifest import (
+    read_manifest, write_manifest, remove_manifest)
+from .lib.layer_streaming import (
+    load_model_with_layer_streaming, is_layer_streamed_model)
+from .lib.parallel_weight_loading import (
+    get_weights_index_path, load_sharded_model_in_parallel)
+from .lib.safetensors_utils import (
+    has_safetensors_weights, convert_model_dir_to_safetensors,
+    convert_file_to_safetensors, load_safetensors_file)
+from .utils.model_cache import (
+    ModelCache, format_model_cache_stats, get_size_in_bytes)
 
 
 def get_new_base_model(base_model_name):
     if Global.ui_dev_mode:
         return
 
-    if Global.new_base_model_that_is_ready_to_be_used:
+    model = _take_new_base_model_that_is_ready_to_be_used(base_model_name)
+    if model:
+        return model
+
+    # Loads of the same base model are serialized so that concurrent callers
+    # don't multiply the peak memory usage.
+    with profile_load(base_model_name, on_finish=_on_model_load_profiled):
+        with Global.model_load_lock(f"base_model:{base_model_name}"):
+            return _load_new_base_model(base_model_name)
+
+
+def _take_new_base_model_that_is_ready_to_be_used(base_model_name):
+    with Global.model_load_lock("new_base_model_that_is_ready_to_be_used"):
+        if not Global.new_base_model_that_is_ready_to_be_used:
+            return None
+
+        model = None
         if Global.name_of_new_base_model_that_is_ready_to_be_used == base_model_name:
             model = Global.new_base_model_that_is_ready_to_be_used
-            Global.new_base_model_that_is_ready_to_be_used = None
-            Global.name_of_new_base_model_that_is_ready_to_be_used = None
-            return model
-        else:
-            Global.new_base_model_that_is_ready_to_be_used = None
-            Global.name_of_new_base_model_that_is_ready_to_be_used = None
+        Global.new_base_model_that_is_ready_to_be_used = None
+        Global.name_of_new_base_model_that_is_ready_to_be_used = None
+        if not model:
             clear_cache()
+        return model
+
+
+def _load_new_base_model(base_model_name):
+    model = None
+
+    manifests_dir = os.path.join(Global.data_dir, "base_model_manifests")
+    manifest = read_manifest(manifests_dir, base_model_name)
+    if manifest:
+        # Go straight to the strategy that worked last time, loading from the
+        # local snapshot without resolving the model on the Hub.
+        try:
+            model = _get_model_from_pretrained(
+                MODEL_CLASSES[manifest['model_class']],
+                _get_base_model_path_to_load(
+                    base_model_name, manifest['snapshot_path']),
+                from_tf=manifest['from_tf'])
+        except Exception as e:
+            print(
+                f"Got error while loading model {base_model_name} with its load manifest: {e}.")
+            remove_manifest(manifests_dir, base_model_name)
+
+    if not model:
+        model = _load_new_base_model_with_retries(base_model_name)
+
+    tokenizer = get_tokenizer(base_model_name)
+
+    if re.match("[^/]+/llama", base_model_name):
+        model.config.pad_token_id = tokenizer.pad_token_id = 0
+        model.config.bos_token_id = tokenizer.bos_token_id = 1
+        model.config.eos_token_id = tokenizer.eos_token_id = 2
+
+    return model
+
+
+def _load_new_base_model_with_retries(base_model_name):
+    model_name_or_path = _get_base_model_path_to_load(base_model_name)
 
     model_class = AutoModelForCausalLM
     from_tf = False
@@ -37,7 +125,7 @@ def get_new_base_model(base_model_name):
     while True:
         try:
             model = _get_model_from_pretrained(
-                model_class, base_model_name, from_tf=from_tf, force_download=force_download)
+                model_class, model_name_or_path, from_tf=from_tf, force_download=force_download)
             break
         except Exception as e:
             if 'from_tf' in str(e):
@@ -63,19 +151,53 @@ def get_new_base_model(base_model_name):
                 force_download = True
                 has_tried_force_download = True
 
-    tokenizer = get_tokenizer(base_model_name)
-
-    if re.match("[^/]+/llama", base_model_name):
-        model.config.pad_token_id = tokenizer.pad_token_id = 0
-        model.config.bos_token_id = tokenizer.bos_token_id = 1
-        model.config.eos_token_id = tokenizer.eos_token_id = 2
+    try:
+        write_manifest(
+            os.path.join(Global.data_dir, "base_model_manifests"),
+            base_model_name,
+            model_class.__name__,
+            from_tf,
+            get_model_dir(base_model_name))
+    except Exception as e:
+        print(f"Cannot write load manifest for {base_model_name}: {e}")
 
     return model
 
 
+def _get_base_model_path_to_load(base_model_name, model_dir=None):
+    if Global.load_with_safetensors:
+        return get_safetensors_model_path(base_model_name, model_dir)
+    return model_dir or base_model_name
+
+
 def _get_model_from_pretrained(model_class, model_name, from_tf=False, force_download=False):
+    with load_phase("load_weights"):
+        return _load_model_from_pretrained(
+            model_class, model_name, from_tf=from_tf, force_download=force_download)
+
+
+def _load_model_from_pretrained(model_class, model_name, from_tf=False, force_download=False):
+    # Weights are materialized directly in the dtype and on the device that
+    # the model will be used with, so there is no transient full precision
+    # copy of the model.
     device = get_device()
 
+    if Global.stream_layers_from_disk and not (Global.load_8bit or from_tf):
+        return load_model_with_layer_streaming(
+            model_class,
+            get_safetensors_model_path(model_name),
+            device=0 if device == "cuda" else device,
+            torch_dtype=_get_torch_dtype(),
+            max_resident_layers=Global.resident_layers,
+            read_ahead=Global.layer_read_ahead,
+            trust_remote_code=Global.trust_remote_code)
+
+    if Global.parallel_weight_loading_workers > 1 and not (Global.load_8bit or from_tf or force_download):
+        model = _get_model_with_parallel_weight_loading(
+            model_class, model_name, device)
+        if model:
+            return model
+
     if device == "cuda":
         return model_class.from_pretrained(
             model_name,
@@ -93,6 +215,7 @@ def _get_model_from_pretrained(model_class, model_name, from_tf=False, force_dow
             model_name,
             device_map={"": device},
             torch_dtype=torch.float16,
+            low_cpu_mem_usage=True,
             from_tf=from_tf,
             force_download=force_download,
             trust_remote_code=Global.trust_remote_code
@@ -101,6 +224,7 @@ def _get_model_from_pretrained(model_class, model_name, from_tf=False, force_dow
         return model_class.from_pretrained(
             model_name,
             device_map={"": device},
+            torch_dtype=_get_torch_dtype(),
             low_cpu_mem_usage=True,
             from_tf=from_tf,
             force_download=force_download,
@@ -108,6 +232,36 @@ def _get_model_from_pretrained(model_class, model_name, from_tf=False, force_dow
         )
 
 
+def _get_torch_dtype():
+    # Dynamic quantization works on float32 weights.
+    if is_cpu_quantize_enabled():
+        return torch.float32
+    return torch.float16
+
+
+def is_cpu_quantize_enabled():
+    return Global.cpu_quantize and get_device() == "cpu"
+
+
+def _get_model_with_parallel_weight_loading(model_class, model_name, device):
+    try:
+        model_dir = get_model_dir(model_name)
+        if not get_weights_index_path(model_dir):
+            return None
+
+        return load_sharded_model_in_parallel(
+            model_class,
+            model_dir,
+            device=0 if device == "cuda" else device,
+            torch_dtype=_get_torch_dtype(),
+            max_workers=Global.parallel_weight_loading_workers,
+            trust_remote_code=Global.trust_remote_code)
+    except Exception as e:
+        print(
+            f"Cannot load {model_name} with parallel weight loading, falling back to from_pretrained: {e}")
+        return None
+
+
 def get_tokenizer(base_model_name):
     if Global.ui_dev_mode:
         return
@@ -116,20 +270,45 @@ def get_tokenizer(base_model_name):
     if loaded_tokenizer:
         return loaded_tokenizer
 
+    with Global.model_load_lock(f"tokenizer:{base_model_name}"):
+        # Another thread might have loaded it while we were waiting.
+        loaded_tokenizer = Global.loaded_tokenizers.get(base_model_name)
+        if loaded_tokenizer:
+            return loaded_tokenizer
+
+        with profile_load(f"tokenizer:{base_model_name}", on_finish=_on_tokenizer_load_profiled):
+            return _load_tokenizer(base_model_name)
+
+
+def _load_tokenizer(base_model_name):
+    with load_phase("load_tokenizer"):
+        return _load_tokenizer_from_pretrained(base_model_name)
+
+
+def _load_tokenizer_from_pretrained(base_model_name):
+    tokenizer_name_or_path = base_model_name
+    manifest = read_manifest(
+        os.path.join(Global.data_dir, "base_model_manifests"), base_model_name)
+    if manifest:
+        tokenizer_name_or_path = manifest['snapshot_path']
+
     try:
         tokenizer = AutoTokenizer.from_pretrained(
-            base_model_name,
+            tokenizer_name_or_path,
             trust_remote_code=Global.trust_remote_code
         )
     except Exception as e:
         if 'LLaMATokenizer' in str(e):
             tokenizer = LlamaTokenizer.from_pretrained(
-                base_model_name,
+                tokenizer_name_or_path,
                 trust_remote_code=Global.trust_remote_code
             )
         else:
             raise e
 
+    # Model specific handling (e.g. for dolly) relies on the model name.
+    tokenizer.name_or_path = base_model_name
+
     Global.loaded_tokenizers.set(base_model_name, tokenizer)
 
     return tokenizer
@@ -144,101 +323,843 @@ def get_model(
     if peft_model_name == "None":
         peft_model_name = None
 
+    if peft_model_name and Global.stream_layers_from_disk:
+        raise ValueError(
+            "LoRA models are not supported with `stream_layers_from_disk`.")
+
     model_key = base_model_name
     if peft_model_name:
         model_key = f"{base_model_name}//{peft_model_name}"
 
-    loaded_model = Global.loaded_models.get(model_key)
-    if loaded_model:
-        return loaded_model
+    with profile_load(model_key, on_finish=_on_model_load_profiled):
+        if peft_model_name and Global.merge_lora_models and not Global.load_8bit:
+            with Global.model_load_lock(f"model:{model_key}"):
+                return _get_merged_model(base_model_name, peft_model_name)
 
-    peft_model_name_or_path = peft_model_name
+        # Callers asking for the same base model wait on a single in-flight
+        # load. This also serializes adapter switching, which mutates the
+        # shared model.
+        with Global.model_load_lock(f"model:{base_model_name}"):
+            return _get_model(base_model_name, peft_model_name)
 
-    if peft_model_name:
-        lora_models_directory_path = os.path.join(
-            Global.data_dir, "lora_models")
-        possible_lora_model_path = os.path.join(
-            lora_models_directory_path, peft_model_name)
-        if os.path.isdir(possible_lora_model_path):
-            peft_model_name_or_path = possible_lora_model_path
-
-            possible_model_info_json_path = os.path.join(
-                possible_lora_model_path, "info.json")
-            if os.path.isfile(possible_model_info_json_path):
-                try:
-                    with open(possible_model_info_json_path, "r") as file:
-                        json_data = json.load(file)
-                        possible_hf_model_name = json_data.get("hf_model_name")
-                        if possible_hf_model_name and json_data.get("load_from_hf"):
-                            peft_model_name_or_path = possible_hf_model_name
-                except Exception as e:
-                    raise ValueError(
-                        "Error reading model info from {possible_model_info_json_path}: {e}")
-
-    Global.loaded_models.prepare_to_set()
+
+@contextmanager
+def use_model(base_model_name, peft_model_name=None):
+    '''
+    Gets the model and keeps it as it is until the block exits. LoRA models
+    are activated on the shared base model, so callers asking for another
+    LoRA model on the same base model wait until the block exits, while
+    callers asking for the same one don't.
+    '''
+    if peft_model_name == "None":
+        peft_model_name = None
+
+    usage_key = get_model_cache_key(base_model_name, peft_model_name)
+    with Global.model_usage_lock(usage_key, peft_model_name):
+        # The generation scheduler might be using another model.
+        with pause_generation_scheduler():
+            yield get_model(base_model_name, peft_model_name)
+
+
+def get_model_cache_key(base_model_name, peft_model_name=None):
+    '''
+    Returns the key of the model in `Global.loaded_models`.
+    '''
+    if peft_model_name and Global.merge_lora_models and not Global.load_8bit:
+        # Merged models are not shared between LoRA models.
+        return f"{base_model_name}//{peft_model_name}"
+    return base_model_name
+
+
+def estimate_model_size(base_model_name, peft_model_name=None):
+    '''
+    Returns the bytes the model took the last time it was loaded, or an
+    estimate if it hasn't been loaded yet.
+    '''
+    size = Global.loaded_models.get_known_size(
+        get_model_cache_key(base_model_name, peft_model_name))
+    if size is None:
+        size = _estimate_model_size(base_model_name)
+    return size
+
+
+def _get_model(base_model_name, peft_model_name):
+    # Only the base model is cached. LoRA models are attached to the loaded
+    # base model as named adapters, so switching between LoRA models on the
+    # same base model does not reload the base model.
+    model = Global.loaded_models.get(base_model_name)
+    if not model:
+        Global.loaded_models.prepare_to_set(
+            base_model_name, estimate_model_size(base_model_name))
+        clear_cache()
+
+        model = get_new_base_model(base_model_name)
+        model = _prepare_loaded_model(model, base_model_name)
+        Global.attached_lora_models.pop(base_model_name, None)
+
+        Global.loaded_models.set(base_model_name, model)
+        clear_cache()
+
+    return _activate_lora_model(model, base_model_name, peft_model_name)
+
+
+def _get_merged_model(base_model_name, peft_model_name):
+    # In this mode, LoRA weights are merged into the base model, so there are
+    # no extra LoRA layers to run on every forward pass.
+    model_key = f"{base_model_name}//{peft_model_name}"
+    model = Global.loaded_models.get(model_key)
+    if model:
+        return model
+
+    Global.loaded_models.prepare_to_set(
+        model_key, estimate_model_size(base_model_name, peft_model_name))
     clear_cache()
 
-    model = get_new_base_model(base_model_name)
+    merged_model_cache = get_merged_model_cache()
+    peft_model_name_or_path = get_peft_model_name_or_path(peft_model_name)
+    cache_key = merged_model_cache.get_key(
+        get_model_dir(base_model_name),
+        get_model_dir(peft_model_name_or_path))
+    merged_model_path = merged_model_cache.get(cache_key)
 
-    if peft_model_name:
-        device = get_device()
-
-        if device == "cuda":
-            model = PeftModel.from_pretrained(
-                model,
-                peft_model_name_or_path,
-                torch_dtype=torch.float16,
-                # ? https://github.com/tloen/alpaca-lora/issues/21
-                device_map={'': 0},
-            )
-        elif device == "mps":
-            model = PeftModel.from_pretrained(
-                model,
-                peft_model_name_or_path,
-                device_map={"": device},
-                torch_dtype=torch.float16,
-            )
-        else:
-            model = PeftModel.from_pretrained(
-                model,
-                peft_model_name_or_path,
-                device_map={"": device},
-            )
+    if not merged_model_path:
+        print(
+            f"Merging LoRA model {peft_model_name} into {base_model_name}...")
+        model = get_new_base_model(base_model_name)
+        config, weights = _get_lora_model_weights(peft_model_name)
+        peft_model_class = MODEL_TYPE_TO_PEFT_MODEL_MAPPING.get(
+            config.task_type, PeftModel)
+        with load_phase("merge_lora_model"):
+            peft_model = peft_model_class(model, config)
+            set_peft_model_state_dict(peft_model, weights)
+            model = peft_model.merge_and_unload()
+            model.half()
+        with load_phase("save_merged_model"):
+            merged_model_path = merged_model_cache.put(cache_key, model)
+        del model, peft_model, weights
+        clear_cache()
+
+    model = _get_model_from_pretrained(AutoModelForCausalLM, merged_model_path)
+    model = _prepare_loaded_model(model, base_model_name)
+
+    Global.loaded_models.set(model_key, model)
+    clear_cache()
+
+    return model
+
+
+def _estimate_model_size(base_model_name):
+    '''
+    Estimates the bytes a base model will occupy once it's loaded, from its
+    config (assuming a LLaMA-like architecture), so that the model cache only
+    makes as much room as needed. Returns None if it can't be estimated.
 
+    The config is only read from local files (the snapshot in the load
+    manifest, or the Hugging Face cache), this never resolves the model on
+    the Hub. Once the model has been loaded, its measured size is used
+    instead.
+    '''
+    config_name_or_path = base_model_name
+    manifest = read_manifest(
+        os.path.join(Global.data_dir, "base_model_manifests"), base_model_name)
+    if manifest:
+        config_name_or_path = manifest['snapshot_path']
+
+    try:
+        config = AutoConfig.from_pretrained(
+            config_name_or_path,
+            trust_remote_code=Global.trust_remote_code,
+            local_files_only=True)
+    except Exception as e:
+        print(f"Cannot estimate the size of {base_model_name}: {e}")
+        return None
+
+    hidden_size = getattr(config, "hidden_size", None)
+    num_layers = getattr(config, "num_hidden_layers", None)
+    vocab_size = getattr(config, "vocab_size", None)
+    if not (hidden_size and num_layers and vocab_size):
+        return None
+    intermediate_size = getattr(
+        config, "intermediate_size", None) or 4 * hidden_size
+
+    # Attention projections and a gated MLP for each layer, plus the input
+    # embeddings and the LM head.
+    layer_params = 4 * hidden_size * hidden_size + \
+        3 * hidden_size * intermediate_size
+    embedding_params = 2 * vocab_size * hidden_size
+
+    if Global.stream_layers_from_disk:
+        num_layers = min(Global.resident_layers, num_layers)
+    if Global.load_8bit:
+        return num_layers * layer_params + embedding_params * 2
+    if is_cpu_quantize_enabled():
+        return num_layers * layer_params + embedding_params * 4
+    return (num_layers * layer_params + embedding_params) * 2
+
+
+def _prepare_loaded_model(model, base_model_name):
+    _set_llama_token_ids(model, base_model_name)
+
+    if is_layer_streamed_model(model):
+        # Layers are loaded in the target dtype when they are streamed in.
+        pass
+    elif is_cpu_quantize_enabled():
+        with load_phase("quantize"):
+            model = quantize_model_for_cpu(
+                model.float(), Global.cpu_quantize_skip_modules)
+    elif not Global.load_8bit:
+        with load_phase("dtype_cast"):
+            model.half()  # seems to fix bugs for some users.
+
+    model.eval()
+
+    with load_phase("compile"):
+        model = _compile_model(model)
+        _warmup_compiled_model(model, base_model_name)
+
+    return model
+
+
+def _warmup_compiled_model(model, base_model_name):
+    if Global.compile_input_length_buckets and is_compiled_model(model):
+        warmup_compiled_model(
+            model,
+            get_device(),
+            get_tokenizer(base_model_name).pad_token_id,
+            Global.compile_input_length_buckets)
+        print(f"Compile stats: {format_compile_stats(get_compile_stats())}")
+
+
+def _set_llama_token_ids(model, base_model_name):
     if re.match("[^/]+/llama", base_model_name):
         model.config.pad_token_id = get_tokenizer(
             base_model_name).pad_token_id = 0
         model.config.bos_token_id = 1
         model.config.eos_token_id = 2
 
-    if not Global.load_8bit:
-        model.half()  # seems to fix bugs for some users.
 
-    model.eval()
-    if torch.__version__ >= "2" and sys.platform != "win32":
-        model = torch.compile(model)
+def _on_model_load_profiled(profiler):
+    if not profiler.phases:
+        return
+    record = {
+        'version': Global.version,
+        'device': get_device(),
+        **profiler.to_dict(),
+    }
+    Global.last_model_load_profile = record
+    print(profiler.format_summary())
+    print(
+        f"Model cache: {format_model_cache_stats(Global.loaded_models.get_stats())}")
+    _append_load_record(record)
+
+
+def _on_tokenizer_load_profiled(profiler):
+    # Not shown as the last load, which is meant to be a model load.
+    if not profiler.phases:
+        return
+    print(profiler.format_summary())
+    _append_load_record({
+        'version': Global.version,
+        'device': get_device(),
+        **profiler.to_dict(),
+    })
+
+
+def _append_load_record(record):
+    try:
+        append_load_record(
+            os.path.join(Global.data_dir, "logs", "model_loads.jsonl"), record)
+    except Exception as e:
+        print(f"Cannot write model load record: {e}")
+
+
+def get_merged_model_cache():
+    if not Global.merged_model_cache:
+        Global.merged_model_cache = MergedModelCache(
+            os.path.join(Global.data_dir, "merged_models"),
+            max_bytes=Global.merged_models_cache_max_bytes)
+    return Global.merged_model_cache
 
-    Global.loaded_models.set(model_key, model)
-    clear_cache()
+
+def get_blob_store():
+    if not Global.blob_store:
+        Global.blob_store = BlobStore(os.path.join(Global.data_dir, "blobs"))
+    return Global.blob_store
+
+
+def collect_blob_store_garbage():
+    '''
+    Removes the blobs that are no longer used by any LoRA model, such as the
+    ones of deleted or re-trained models.
+    '''
+    freed_bytes = get_blob_store().collect_garbage(
+        [os.path.join(Global.data_dir, "lora_models")])
+    if freed_bytes:
+        print(
+            f"Removed unused blobs, freed {freed_bytes / (1024 ** 2):.2f} MB.")
+    return freed_bytes
+
+
+def get_prompt_prefix_cache():
+    '''
+    Returns None if the prompt prefix cache is not enabled.
+    '''
+    if not Global.prompt_prefix_cache_max_bytes:
+        return None
+    if not Global.prompt_prefix_cache:
+        Global.prompt_prefix_cache = PromptPrefixCache(ModelCache(
+            device=get_device(),
+            max_device_bytes=Global.prompt_prefix_cache_max_bytes))
+    return Global.prompt_prefix_cache
+
+
+def get_model_dir(model_name_or_path):
+    if os.path.isdir(model_name_or_path):
+        return model_name_or_path
+
+    with load_phase("hub_resolution"):
+        try:
+            # Avoids resolving the model on the Hub if it's already downloaded.
+            return snapshot_download(model_name_or_path, local_files_only=True)
+        except Exception:
+            # Repos might have the weights in both formats, only download one
+            # of them.
+            weights_pattern = "*.bin"
+            if any(name.endswith(".safetensors") for name in list_repo_files(model_name_or_path)):
+                weights_pattern = "*.safetensors"
+            return snapshot_download(
+                model_name_or_path,
+                allow_patterns=["*.json", weights_pattern, "*.model", "*.txt", "*.py"])
+
+
+def get_lora_adapter_name(peft_model_name):
+    # Adapter names are used as module names by PEFT, which can't contain "."
+    return re.sub(r"[^A-Za-z0-9_-]", "_", peft_model_name)
+
+
+def get_peft_model_name_or_path(peft_model_name):
+    if parse_lora_composition_spec(peft_model_name):
+        return get_composed_lora_model_path(peft_model_name)
+
+    peft_model_name_or_path = peft_model_name
+
+    lora_models_directory_path = os.path.join(
+        Global.data_dir, "lora_models")
+    possible_lora_model_path = os.path.join(
+        lora_models_directory_path, peft_model_name)
+    if os.path.isdir(possible_lora_model_path):
+        peft_model_name_or_path = possible_lora_model_path
+
+        possible_model_info_json_path = os.path.join(
+            possible_lora_model_path, "info.json")
+        if os.path.isfile(possible_model_info_json_path):
+            try:
+                with open(possible_model_info_json_path, "r") as file:
+                    json_data = json.load(file)
+                    possible_hf_model_name = json_data.get("hf_model_name")
+                    if possible_hf_model_name and json_data.get("load_from_hf"):
+                        peft_model_name_or_path = possible_hf_model_name
+            except Exception as e:
+                raise ValueError(
+                    f"Error reading model info from {possible_model_info_json_path}: {e}")
+
+    return peft_model_name_or_path
+
+
+def get_composed_lora_model_path(spec):
+    '''
+    Returns the path of the LoRA model combined from a spec like
+    "lora-a:0.7+lora-b:0.3", building it if it's not cached yet.
+    '''
+    items = parse_lora_composition_spec(spec)
+    model_paths = [get_peft_model_name_or_path(name) for name, _ in items]
+    merged_model_cache = get_merged_model_cache()
+    key = get_lora_composition_key(items, [
+        merged_model_cache.get_dir_hash(get_model_dir(path))
+        for path in model_paths])
+    composed_model_path = os.path.join(
+        Global.data_dir, "composed_lora_models", key)
+
+    with Global.model_load_lock(f"composed_lora_model:{key}"):
+        if os.path.isdir(composed_model_path):
+            return composed_model_path
+
+        print(f"Combining LoRA models {spec}...")
+        parts = []
+        for (name, weight), path in zip(items, model_paths):
+            config, weights = load_lora_model_weights(path)
+            parts.append((config, weights, weight))
+        with load_phase("compose_lora_models"):
+            config, weights = compose_lora_weights(parts)
+        del parts
+
+        tmp_path = composed_model_path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        config.save_pretrained(tmp_path)
+        save_file(
+            weights, os.path.join(tmp_path, SAFETENSORS_WEIGHTS_NAME),
+            metadata={'format': 'pt'})
+        with open(os.path.join(tmp_path, "composition.json"), "w") as f:
+            json.dump({
+                'spec': spec,
+                'lora_models': [
+                    {'name': name, 'weight': weight} for name, weight in items],
+            }, f, indent=2)
+        os.rename(tmp_path, composed_model_path)
+
+    return composed_model_path
+
+
+def load_lora_model_weights(peft_model_name_or_path):
+    config = LoraConfig.from_pretrained(peft_model_name_or_path)
+    config.inference_mode = True
+
+    weights_path = _get_lora_model_weights_path(peft_model_name_or_path)
+    if not os.path.isfile(weights_path) and has_manifest(weights_path):
+        with load_phase("weight_io"):
+            weights = get_blob_store().load_state_dict(weights_path)
+    elif weights_path.endswith(COMPRESSED_WEIGHTS_NAME):
+        with load_phase("weight_io"):
+            weights = load_compressed_lora_weights(weights_path)
+    elif weights_path.endswith(".safetensors"):
+        # Memory-mapped, there is no separate deserialization step.
+        with load_phase("weight_io"):
+            weights = load_safetensors_file(weights_path)
+    else:
+        # Reading the file separately would keep its bytes in memory along
+        # with the tensors.
+        with load_phase("weight_io_and_deserialization"):
+            weights = torch.load(weights_path, map_location="cpu")
+
+    return config, weights
+
+
+def _get_lora_model_weights_path(peft_model_name_or_path):
+    if os.path.isdir(peft_model_name_or_path):
+        compressed_weights_path = os.path.join(
+            peft_model_name_or_path, COMPRESSED_WEIGHTS_NAME)
+        safetensors_weights_path = os.path.join(
+            peft_model_name_or_path, SAFETENSORS_WEIGHTS_NAME)
+        weights_path = os.path.join(peft_model_name_or_path, WEIGHTS_NAME)
+        safetensors_weights_mtime = _get_weights_mtime(
+            safetensors_weights_path)
+        weights_mtime = _get_weights_mtime(weights_path)
+        # Compressed weights are made from `adapter_model.bin` if there is
+        # one (`adapter_model.safetensors` might be converted from it later),
+        # and are stale if the weights have been replaced since then.
+        source_weights_mtime = weights_mtime if weights_mtime is not None else safetensors_weights_mtime
+        if os.path.isfile(compressed_weights_path) and (source_weights_mtime is None or os.path.getmtime(compressed_weights_path) >= source_weights_mtime):
+            return compressed_weights_path
+        # The safetensors weights might have been converted from an older
+        # `adapter_model.bin`, which is overwritten when the model is trained
+        # again.
+        if safetensors_weights_mtime is not None and (weights_mtime is None or safetensors_weights_mtime >= weights_mtime):
+            return safetensors_weights_path
+        if has_manifest(weights_path) and not os.path.isfile(weights_path):
+            # Deduped weights are loaded from the blob store.
+            return weights_path
+        converted_weights_path = safetensors_weights_path
+    else:
+        with load_phase("hub_resolution"):
+            try:
+                weights_path = hf_hub_download(
+                    peft_model_name_or_path, WEIGHTS_NAME)
+            except Exception:
+                return hf_hub_download(
+                    peft_model_name_or_path, SAFETENSORS_WEIGHTS_NAME)
+        converted_weights_path = os.path.join(
+            _get_safetensors_models_dir(peft_model_name_or_path),
+            SAFETENSORS_WEIGHTS_NAME)
+
+    if not Global.load_with_safetensors:
+        return weights_path
+
+    try:
+        if (not os.path.isfile(converted_weights_path)) or os.path.getmtime(converted_weights_path) < os.path.getmtime(weights_path):
+            print(f"Converting {weights_path} to safetensors...")
+            os.makedirs(os.path.dirname(converted_weights_path), exist_ok=True)
+            convert_file_to_safetensors(weights_path, converted_weights_path)
+        return converted_weights_path
+    except Exception as e:
+        print(
+            f"Cannot convert {weights_path} to safetensors, will load the original weights: {e}")
+        return weights_path
+
+
+def _get_weights_mtime(weights_path):
+    '''
+    Returns the modification time of a weights file, or of its manifest if
+    it's deduped into the blob store, or None if neither exists.
+    '''
+    if os.path.isfile(weights_path):
+        return os.path.getmtime(weights_path)
+    if has_manifest(weights_path):
+        return os.path.getmtime(weights_path + MANIFEST_SUFFIX)
+    return None
+
+
+def get_safetensors_model_path(model_name_or_path, model_dir=None):
+    try:
+        model_dir = model_dir or get_model_dir(model_name_or_path)
+        if has_safetensors_weights(model_dir):
+            return model_dir
+        return convert_model_dir_to_safetensors(
+            model_dir, _get_safetensors_models_dir(model_name_or_path))
+    except Exception as e:
+        print(
+            f"Cannot convert {model_name_or_path} to safetensors, will load the original checkpoint: {e}")
+        return model_dir or model_name_or_path
+
+
+def _get_safetensors_models_dir(model_name_or_path):
+    return os.path.join(
+        Global.data_dir, "safetensors_models",
+        re.sub(r"[^A-Za-z0-9_.-]", "--", model_name_or_path.strip("/")))
+
+
+def prefetch_lora_model(base_model_name, peft_model_name):
+    '''
+    Starts loading the tokenizer and the weights of a LoRA model into CPU RAM
+    in the background, so that attaching it later will be fast. Calling this
+    again cancels the previous prefetch.
+    '''
+    if Global.ui_dev_mode:
+        return
+
+    if peft_model_name == "None":
+        peft_model_name = None
+
+    with Global.model_load_lock("prefetched_lora_model"):
+        Global.lora_model_prefetch_generation += 1
+        generation = Global.lora_model_prefetch_generation
+        # Release the weights of the previous selection.
+        Global.prefetched_lora_model = None
+
+    thread = threading.Thread(
+        target=_prefetch_lora_model,
+        args=(generation, base_model_name, peft_model_name),
+        daemon=True)
+    thread.start()
+
+
+def _prefetch_lora_model(generation, base_model_name, peft_model_name):
+    def is_cancelled():
+        return Global.lora_model_prefetch_generation != generation
+
+    try:
+        get_tokenizer(base_model_name)
+
+        if not peft_model_name or is_cancelled():
+            return
+        if get_lora_adapter_name(peft_model_name) in get_loaded_lora_model_names(base_model_name):
+            return
+
+        with Global.model_load_lock(f"lora_model_weights:{peft_model_name}"):
+            if is_cancelled():
+                return
+            start_time = time.time()
+            config, weights = load_lora_model_weights(
+                get_peft_model_name_or_path(peft_model_name))
+
+            with Global.model_load_lock("prefetched_lora_model"):
+                if is_cancelled():
+                    return
+                Global.prefetched_lora_model = (peft_model_name, config, weights)
+            print(
+                f"Prefetched LoRA model {peft_model_name} in {time.time() - start_time:.2f}s.")
+    except Exception as e:
+        print(f"Failed to prefetch LoRA model {peft_model_name}: {e}")
+
+
+def _get_lora_model_weights(peft_model_name):
+    # Waits for an in-flight prefetch of the same LoRA model to finish.
+    with Global.model_load_lock(f"lora_model_weights:{peft_model_name}"):
+        with Global.model_load_lock("prefetched_lora_model"):
+            prefetched_lora_model = Global.prefetched_lora_model
+            if prefetched_lora_model and prefetched_lora_model[0] == peft_model_name:
+                Global.prefetched_lora_model = None
+                _, config, weights = prefetched_lora_model
+                return config, weights
+
+        return load_lora_model_weights(
+            get_peft_model_name_or_path(peft_model_name))
+
+
+def get_loaded_lora_model_names(base_model_name):
+    peft_model = Global.loaded_models.peek(base_model_name)
+    if not isinstance(peft_model, PeftModel):
+        return []
+    return list(peft_model.peft_config.keys())
+
+
+def is_model_resident(base_model_name, peft_model_name=None):
+    '''
+    Returns whether the model can be used without loading anything.
+    '''
+    if peft_model_name == "None":
+        peft_model_name = None
+
+    if get_inference_worker_pool(base_model_name, peft_model_name):
+        return True
+
+    if peft_model_name and Global.merge_lora_models and not Global.load_8bit:
+        return Global.loaded_models.peek(
+            f"{base_model_name}//{peft_model_name}") is not None
+
+    if Global.loaded_models.peek(base_model_name) is None:
+        return False
+    if not peft_model_name:
+        return True
+    return get_lora_adapter_name(peft_model_name) in get_loaded_lora_model_names(base_model_name)
+
+
+def _detach_lora_model(peft_model, base_model_name, adapter_name):
+    if adapter_name not in peft_model.peft_config:
+        return False
+
+    if peft_model.active_adapter == adapter_name:
+        peft_model.base_model.disable_adapter_layers()
+
+    if hasattr(peft_model, "delete_adapter"):
+        peft_model.delete_adapter(adapter_name)
+    elif hasattr(peft_model.base_model, "delete_adapter"):
+        peft_model.base_model.delete_adapter(adapter_name)
+        del peft_model.peft_config[adapter_name]
+    else:
+        print(
+            f"Notice: the installed PEFT version does not support deleting adapters, {adapter_name} will stay loaded but inactive.")
+        return False
+
+    attached_lora_models = Global.attached_lora_models.get(
+        base_model_name, {})
+    peft_model_name = attached_lora_models.pop(adapter_name, None)
+    Global.lora_model_load_stats.pop(peft_model_name, None)
+    print(f"Detached LoRA model {peft_model_name or adapter_name} from {base_model_name}.")
+    return True
+
+
+def _detach_least_recently_used_lora_models(
+        model, base_model_name, active_adapter_name):
+    '''
+    Detaches LoRA models from the base model, least recently used first,
+    until the number of attached LoRA models is within
+    `max_attached_lora_models` and the model fits in the model cache budget.
+    '''
+    attached_lora_models = Global.attached_lora_models.get(
+        base_model_name, {})
+
+    def should_detach():
+        if len(attached_lora_models) > Global.max_attached_lora_models:
+            return True
+        return not Global.loaded_models.has_room_for(
+            base_model_name, get_size_in_bytes(model))
+
+    while should_detach():
+        adapter_names = [
+            name for name in attached_lora_models
+            if name != active_adapter_name]
+        if not adapter_names:
+            break
+        if not _detach_lora_model(model, base_model_name, adapter_names[0]):
+            # Can't be detached, stop counting it.
+            attached_lora_models.pop(adapter_names[0], None)
+
+
+def _activate_lora_model(model, base_model_name, peft_model_name):
+    peft_model = model
+
+    if not peft_model_name:
+        if isinstance(peft_model, PeftModel):
+            peft_model.base_model.disable_adapter_layers()
+        return model
+
+    adapter_name = get_lora_adapter_name(peft_model_name)
+
+    attached_lora_models = Global.attached_lora_models.setdefault(
+        base_model_name, OrderedDict())
+
+    if isinstance(peft_model, PeftModel) and adapter_name in peft_model.peft_config:
+        peft_model.base_model.enable_adapter_layers()
+        peft_model.set_adapter(adapter_name)
+        if adapter_name in attached_lora_models:
+            attached_lora_models.move_to_end(adapter_name)
+        return model
+
+    start_time = time.time()
+    with load_phase("load_lora_model_weights"):
+        config, weights = _get_lora_model_weights(peft_model_name)
+    weights_loaded_time = time.time()
+
+    if is_cpu_quantize_enabled():
+        quantized_target_modules = [
+            m for m in config.target_modules
+            if m not in Global.cpu_quantize_skip_modules]
+        if quantized_target_modules:
+            raise ValueError(
+                f"LoRA model {peft_model_name} targets modules that are quantized ({', '.join(quantized_target_modules)}). Add them to `cpu_quantize_skip_modules` to use this LoRA model.")
+
+    with load_phase("attach_lora_model"):
+        if isinstance(peft_model, PeftModel):
+            peft_model.add_adapter(adapter_name, config)
+        else:
+            peft_model_class = MODEL_TYPE_TO_PEFT_MODEL_MAPPING.get(
+                config.task_type, PeftModel)
+            # The forward of the base model stays compiled, which is the one
+            # that generation of the PEFT model runs.
+            peft_model = peft_model_class(
+                peft_model, config, adapter_name=adapter_name)
+            model = peft_model
+
+        # LoRA layers are kept in float32 on quantized models.
+        if not (Global.load_8bit or is_cpu_quantize_enabled()):
+            _cast_lora_adapter_to_half(peft_model, adapter_name)
+
+        # Weights are copied into the existing parameters of the adapter.
+        set_peft_model_state_dict(
+            peft_model, weights, adapter_name=adapter_name)
+        del weights
+
+        peft_model.base_model.enable_adapter_layers()
+        peft_model.set_adapter(adapter_name)
+        peft_model.eval()
+
+    with load_phase("compile"):
+        # The new adapter changes the modules that the compiled forward runs,
+        # compile it now instead of on the first request.
+        _warmup_compiled_model(model, base_model_name)
+    attached_lora_models[adapter_name] = peft_model_name
+    _detach_least_recently_used_lora_models(
+        model, base_model_name, adapter_name)
+    # Re-measure the size of the cached model, which now includes the adapter.
+    Global.loaded_models.set(base_model_name, model)
+
+    end_time = time.time()
+    Global.lora_model_load_stats[peft_model_name] = {
+        'base_model': base_model_name,
+        'weights_load_time': weights_loaded_time - start_time,
+        'attach_time': end_time - weights_loaded_time,
+        'total_time': end_time - start_time,
+    }
+    print(
+        f"Loaded LoRA model {peft_model_name} on {base_model_name} in {end_time - start_time:.2f}s (weights: {weights_loaded_time - start_time:.2f}s, attach: {end_time - weights_loaded_time:.2f}s).")
 
     return model
 
 
+def _cast_lora_adapter_to_half(peft_model, adapter_name):
+    # Only the parameters of the new adapter need to be cast, the base model
+    # is already in half precision.
+    for name, param in peft_model.named_parameters():
+        if f".{adapter_name}." in name and param.dtype != torch.float16:
+            param.data = param.data.half()
+
+
+def _compile_model(model):
+    if not Global.torch_compile:
+        return model
+    if is_layer_streamed_model(model):
+        # Weights of streamed layers are swapped in and out by hooks.
+        return model
+    if is_cpu_quantize_enabled() and is_cpu_quantized_model(model):
+        # Dynamically quantized layers are not supported by torch.compile.
+        return model
+    return compile_model(model)
+
+
 def prepare_base_model(base_model_name=Global.default_base_model_name):
-    Global.new_base_model_that_is_ready_to_be_used = get_new_base_model(
-        base_model_name)
-    Global.name_of_new_base_model_that_is_ready_to_be_used = base_model_name
+    model = get_new_base_model(base_model_name)
+    with Global.model_load_lock("new_base_model_that_is_ready_to_be_used"):
+        Global.new_base_model_that_is_ready_to_be_used = model
+        Global.name_of_new_base_model_that_is_ready_to_be_used = base_model_name
+
+
+def start_inference_worker_pool(base_model_name, peft_model_name, num_workers):
+    '''
+    Loads the model once, merging the LoRA model into it if given, and starts
+    `num_workers` processes that serve generations from the same weights in
+    shared memory.
+    '''
+    if get_device() != "cpu":
+        raise ValueError("Inference workers are only supported on CPU.")
+    if Global.cpu_quantize:
+        raise ValueError(
+            "Inference workers are not supported with `cpu_quantize`.")
+
+    if peft_model_name == "None":
+        peft_model_name = None
+
+    tokenizer = get_tokenizer(base_model_name)
+    model = get_new_base_model(base_model_name)
+    _set_llama_token_ids(model, base_model_name)
+
+    if peft_model_name:
+        print(
+            f"Merging LoRA model {peft_model_name} into {base_model_name} for inference workers...")
+        config, weights = _get_lora_model_weights(peft_model_name)
+        peft_model_class = MODEL_TYPE_TO_PEFT_MODEL_MAPPING.get(
+            config.task_type, PeftModel)
+        peft_model = peft_model_class(model, config)
+        set_peft_model_state_dict(peft_model, weights)
+        model = peft_model.merge_and_unload()
+        del peft_model, weights
+
+    # Half precision is slow or unsupported for many ops on CPU.
+    model.float()
+
+    Global.inference_worker_pool = InferenceWorkerPool(
+        model, tokenizer, num_workers)
+    Global.inference_worker_pool_model = (base_model_name, peft_model_name)
+    # The pool keeps the shared weights alive.
+    del model
+    clear_cache()
+
+
+def get_inference_worker_pool(base_model_name, peft_model_name):
+    '''
+    Returns the inference worker pool if it serves the given models.
+    '''
+    if not Global.inference_worker_pool:
+        return None
+    if peft_model_name == "None":
+        peft_model_name = None
+    if Global.inference_worker_pool_model != (base_model_name, peft_model_name or None):
+        return None
+    return Global.inference_worker_pool
+
+
+@contextmanager
+def pause_generation_scheduler():
+    '''
+    Waits for the generations running in the generation scheduler (if any)
+    to finish and pauses it, so that the loaded models can be used or
+    switched directly.
+    '''
+    if not Global.generation_scheduler:
+        yield
+        return
+    with Global.generation_scheduler.exclusive():
+        yield
 
 
 def clear_cache():
-    gc.collect()
+    with load_phase("clear_cache"):
+        gc.collect()
 
-    # if not shared.args.cpu: # will not be running on CPUs anyway
-    with torch.no_grad():
-        torch.cuda.empty_cache()
+        # if not shared.args.cpu: # will not be running on CPUs anyway
+        with torch.no_grad():
+            torch.cuda.empty_cache()
 
 
 def unload_models():
-    Global.loaded_models.clear()
-    Global.loaded_tokenizers.clear()
+    # The scheduler drops its reference to the model when paused.
+    with pause_generation_scheduler():
+        Global.loaded_models.clear()
+        Global.loaded_tokenizers.clear()
+        Global.attached_lora_models.clear()
+    # Models might be changed (such as LoRA models being trained again)
+    # before they are loaded next time.
+    if Global.prompt_prefix_cache:
+        Global.prompt_prefix_cache.clear()
     clear_cache()
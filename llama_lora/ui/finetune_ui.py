@@ -13,14 +13,16 @@ from transformers import TrainerCallback
 from ..globals import Global
 from ..models import (
     get_new_base_model, get_tokenizer,
-    clear_cache, unload_models)
+    clear_cache, unload_models, get_blob_store, collect_blob_store_garbage)
 from ..utils.data import (
     get_available_template_names,
     get_available_dataset_names,
     get_dataset_content,
-    get_available_lora_model_names
+    get_available_lora_model_names,
+    get_lora_model_registry
 )
 from ..utils.prompter import Prompter
+from ..lib.lora_compression import COMPRESSED_WEIGHTS_NAME
 
 
 def random_hyphenated_word():
@@ -317,10 +319,13 @@ def do_train(
             if continue_from_checkpoint:
                 resume_from_checkpoint = os.path.join(resume_from_checkpoint, continue_from_checkpoint)
                 will_be_resume_from_checkpoint_file = os.path.join(resume_from_checkpoint, "pytorch_model.bin")
+                # Deduped weights are written back for the trainer to read.
+                get_blob_store().materialize_file(will_be_resume_from_checkpoint_file)
                 if not os.path.exists(will_be_resume_from_checkpoint_file):
                     raise ValueError(f"Unable to resume from checkpoint {continue_from_model}/{continue_from_checkpoint}. Resuming is only possible from checkpoints stored locally in the data directory. Please ensure that the file '{will_be_resume_from_checkpoint_file}' exists.")
             else:
                 will_be_resume_from_checkpoint_file = os.path.join(resume_from_checkpoint, "adapter_model.bin")
+                get_blob_store().materialize_file(will_be_resume_from_checkpoint_file)
                 if not os.path.exists(will_be_resume_from_checkpoint_file):
                     raise ValueError(f"Unable to continue from model {continue_from_model}. Continuation is only possible from models stored locally in the data directory. Please ensure that the file '{will_be_resume_from_checkpoint_file}' exists.")
 
@@ -532,6 +537,24 @@ Train data (first 10):
         result_message = f"Training ended:\n{str(train_output)}\n\nLogs:\n{logs_str}"
         print(result_message)
 
+        # Compressed weights of a previous training of this model are stale.
+        compressed_weights_path = os.path.join(
+            output_dir, COMPRESSED_WEIGHTS_NAME)
+        if os.path.isfile(compressed_weights_path):
+            os.remove(compressed_weights_path)
+
+        if Global.dedupe_lora_models:
+            freed_bytes = get_blob_store().dedupe_model_dir(output_dir)
+            if continue_from_model:
+                freed_bytes += get_blob_store().dedupe_model_dir(os.path.join(
+                    Global.data_dir, "lora_models", continue_from_model))
+            print(
+                f"Deduped weights of {model_name}, freed {freed_bytes / (1024 ** 2):.2f} MB.")
+        # The blobs of the weights that were overwritten by this training.
+        collect_blob_store_garbage()
+
+        get_lora_model_registry().invalidate(model_name)
+
         del base_model
         del tokenizer
         clear_cache()
@@ -549,15 +572,11 @@ def do_abort_training():
 
 def handle_continue_from_model_change(model_name):
     try:
-        lora_models_directory_path = os.path.join(
-            Global.data_dir, "lora_models")
-        lora_model_directory_path = os.path.join(
-            lora_models_directory_path, model_name)
-        all_files = os.listdir(lora_model_directory_path)
-        checkpoints = [
-            file for file in all_files if file.startswith("checkpoint-")]
-        checkpoints = ["-"] + checkpoints
-        can_load_params = "finetune_params.json" in all_files or "finetune_args.json" in all_files
+        registry = get_lora_model_registry()
+        if model_name not in registry.get_names():
+            raise ValueError(f"LoRA model {model_name} does not exist.")
+        checkpoints = ["-"] + registry.get_checkpoint_names(model_name)
+        can_load_params = registry.has_finetune_params(model_name)
         return gr.Dropdown.update(choices=checkpoints, value="-"), gr.Button.update(visible=can_load_params), gr.Markdown.update(value="", visible=False)
     except Exception:
         pass
@@ -586,19 +605,7 @@ def handle_load_params_from_model(
     notice_message = ""
     unknown_keys = []
     try:
-        lora_models_directory_path = os.path.join(
-            Global.data_dir, "lora_models")
-        lora_model_directory_path = os.path.join(
-            lora_models_directory_path, model_name)
-
-        data = {}
-        possible_files = ["finetune_params.json", "finetune_args.json"]
-        for file in possible_files:
-            try:
-                with open(os.path.join(lora_model_directory_path, file), "r") as f:
-                    data = json.load(f)
-            except FileNotFoundError:
-                pass
+        data = get_lora_model_registry().get_finetune_params(model_name) or {}
 
         for key, value in data.items():
             if key == "max_seq_length":
@@ -8,8 +8,14 @@ import transformers
 from transformers import GenerationConfig
 
 from ..globals import Global
-from ..models import get_model, get_tokenizer, get_device
+from ..models import (
+    use_model, get_tokenizer, get_device, prefetch_lora_model,
+    get_inference_worker_pool, get_prompt_prefix_cache)
 from ..lib.inference import generate
+from ..lib.torch_compile import is_compiled_model
+from ..lib.layer_streaming import is_layer_streamed_model
+from ..lib.prompt_prefix_cache import format_prefix_cache_stats
+from ..lib.generation_scheduler import format_generation_scheduler_stats
 from ..utils.data import (
     get_available_template_names,
     get_available_lora_model_names,
@@ -35,7 +41,9 @@ def prepare_inference(lora_model_name, progress=gr.Progress(track_tqdm=True)):
 
     try:
         get_tokenizer(base_model_name)
-        get_model(base_model_name, lora_model_name)
+        if not get_inference_worker_pool(base_model_name, lora_model_name):
+            with use_model(base_model_name, lora_model_name):
+                pass
         return ("", "", gr.Textbox.update(visible=False))
 
     except Exception as e:
@@ -55,19 +63,32 @@ def do_inference(
     max_new_tokens=128,
     stream_output=False,
     show_raw=False,
+    generation_state=None,
     progress=gr.Progress(track_tqdm=True),
 ):
     base_model_name = Global.base_model_name
 
+    if generation_state is None:
+        generation_state = {}
+    # Each generation has its own cancel token, so stopping it will not stop
+    # the generations of other sessions, and a new generation will not
+    # revive a stopped one.
+    cancel_token = {'should_stop': False}
+
+    def should_stop():
+        return cancel_token['should_stop']
+
     try:
-        if Global.generation_force_stopped_at is not None:
+        force_stopped_at = generation_state.get('force_stopped_at')
+        if force_stopped_at is not None:
             required_elapsed_time_after_forced_stop = 1
             current_unix_time = time.time()
             remaining_time = required_elapsed_time_after_forced_stop - \
-                (current_unix_time - Global.generation_force_stopped_at)
+                (current_unix_time - force_stopped_at)
             if remaining_time > 0:
                 time.sleep(remaining_time)
-            Global.generation_force_stopped_at = None
+            generation_state['force_stopped_at'] = None
+        generation_state['cancel_token'] = cancel_token
 
         variables = [variable_0, variable_1, variable_2, variable_3,
                      variable_4, variable_5, variable_6, variable_7]
@@ -158,31 +179,85 @@ def do_inference(
             )
             return
 
-        tokenizer = get_tokenizer(base_model_name)
-        model = get_model(base_model_name, lora_model_name)
-
         def ui_generation_stopping_criteria(input_ids, score, **kwargs):
-            if Global.should_stop_generating:
+            if should_stop():
                 return True
             return False
 
-        Global.should_stop_generating = False
-
-        generation_args = {
-            'model': model,
-            'tokenizer': tokenizer,
-            'prompt': prompt,
-            'generation_config': generation_config,
-            'max_new_tokens': max_new_tokens,
-            'stopping_criteria': [ui_generation_stopping_criteria],
-            'stream_output': stream_output
-        }
-
-        for (decoded_output, output, completed) in generate(**generation_args):
+        def generate_with_model():
+            # The model (such as its active LoRA model) is kept as it is
+            # until the generation finishes.
+            tokenizer = get_tokenizer(base_model_name)
+            with use_model(base_model_name, lora_model_name) as model:
+                generation_args = {
+                    'model': model,
+                    'tokenizer': tokenizer,
+                    'prompt': prompt,
+                    'generation_config': generation_config,
+                    'max_new_tokens': max_new_tokens,
+                    'stopping_criteria': [ui_generation_stopping_criteria],
+                    'stream_output': stream_output,
+                    'stream_text_deltas': True,
+                    'input_length_buckets': Global.compile_input_length_buckets if is_compiled_model(model) else None,
+                }
+                prefix_cache = get_prompt_prefix_cache()
+                if prefix_cache:
+                    generation_args['prompt_prefix'] = prompter.get_constant_prefix(
+                        variables)
+                    generation_args['prefix_cache'] = prefix_cache
+                    generation_args['prefix_cache_key'] = (
+                        base_model_name, lora_model_name, prompt_template)
+                yield from generate(**generation_args)
+
+                if prefix_cache:
+                    stats = prefix_cache.get_stats().get(prompt_template)
+                    if stats:
+                        print(format_prefix_cache_stats(
+                            prompt_template, stats))
+
+                if is_layer_streamed_model(model):
+                    print(
+                        f"Layer streaming stats: {model.layer_streamer.get_stats()}")
+
+        def generate_with_scheduler():
+            scheduler = Global.generation_scheduler
+            yield from scheduler.generate(
+                (base_model_name, lora_model_name),
+                prompt=prompt,
+                generation_config=generation_config,
+                max_new_tokens=max_new_tokens,
+                stream_output=stream_output,
+                stream_text_deltas=True,
+                should_stop=should_stop)
+            print(
+                f"Generation scheduler: {format_generation_scheduler_stats(scheduler.get_stats())}")
+
+        worker_pool = get_inference_worker_pool(
+            base_model_name, lora_model_name)
+        if worker_pool:
+            generations = worker_pool.generate(
+                prompt=prompt,
+                generation_config=generation_config,
+                max_new_tokens=max_new_tokens,
+                stream_output=stream_output,
+                stream_text_deltas=True,
+                should_stop=should_stop)
+        elif Global.generation_scheduler and num_beams == 1:
+            generations = generate_with_scheduler()
+        else:
+            # Beam search is not supported by the scheduler.
+            generations = generate_with_model()
+
+        decoded_output = ""
+        response = ""
+        response_extractor = prompter.get_streaming_response_extractor()
+        for (decoded_output_delta, output, completed) in generations:
+            decoded_output += decoded_output_delta
             raw_output_str = str(output)
-            response = prompter.get_response(decoded_output)
+            response += response_extractor.feed(
+                decoded_output_delta, final=completed)
 
-            if Global.should_stop_generating:
+            if should_stop():
                 return
 
             yield (
@@ -195,7 +270,7 @@ def do_inference(
                     visible=True)
             )
 
-            if Global.should_stop_generating:
+            if should_stop():
                 # If the user stops the generation, and then clicks the
                 # generation button again, they may mysteriously landed
                 # here, in the previous, should-be-stopped generation
@@ -217,9 +292,11 @@ def do_inference(
         raise gr.Error(e)
 
 
-def handle_stop_generate():
-    Global.generation_force_stopped_at = time.time()
-    Global.should_stop_generating = True
+def handle_stop_generate(generation_state):
+    generation_state['force_stopped_at'] = time.time()
+    cancel_token = generation_state.get('cancel_token')
+    if cancel_token:
+        cancel_token['should_stop'] = True
 
 
 def reload_selections(current_lora_model, current_prompt_template):
@@ -285,6 +362,9 @@ def handle_prompt_template_change(prompt_template, lora_model):
 
 
 def handle_lora_model_change(lora_model, prompt_template):
+    # Start loading the selected model while the user is writing the prompt.
+    prefetch_lora_model(Global.base_model_name, lora_model)
+
     lora_mode_info = get_info_of_available_lora_model(lora_model)
 
     if lora_mode_info and isinstance(lora_mode_info, dict):
@@ -487,6 +567,7 @@ def inference_ui():
                         )
                         stop_btn = gr.Button(
                             "Stop", variant="stop", label="Stop Iterating", elem_id="inference_stop_btn")
+                        generation_state = gr.State({})
 
             with gr.Column(elem_id="inference_output_group_container"):
                 with gr.Column(elem_id="inference_output_group"):
@@ -605,6 +686,7 @@ def inference_ui():
                 max_new_tokens,
                 stream_output,
                 show_raw,
+                generation_state,
             ],
             outputs=[inference_output,
                      inference_raw_output, output_for_flagging],
@@ -612,7 +694,7 @@ def inference_ui():
         )
         stop_btn.click(
             fn=handle_stop_generate,
-            inputs=None,
+            inputs=[generation_state],
             outputs=None,
             cancels=[generate_event]
         )
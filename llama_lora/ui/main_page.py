@@ -1,6 +1,10 @@
 import gradio as gr
 
 from ..globals import Global
+from ..lib.load_profiler import format_load_summary
+from ..lib.generation_scheduler import format_generation_scheduler_stats
+from ..lib.torch_compile import get_compile_stats, format_compile_stats
+from ..utils.model_cache import format_model_cache_stats
 
 from .inference_ui import inference_ui
 from .finetune_ui import finetune_ui
@@ -774,6 +778,17 @@ def get_foot_info():
     info.append(f"Base model: `{Global.base_model_name}`")
     if Global.ui_show_sys_info:
         info.append(f"Data dir: `{Global.data_dir}`")
+        if Global.last_model_load_profile:
+            info.append(
+                f"Last load: `{format_load_summary(Global.last_model_load_profile)}`")
+        info.append(
+            f"Model cache: `{format_model_cache_stats(Global.loaded_models.get_stats())}`")
+        if Global.torch_compile:
+            info.append(
+                f"Compile: `{format_compile_stats(get_compile_stats())}`")
+        if Global.generation_scheduler:
+            info.append(
+                f"Generation scheduler: `{format_generation_scheduler_stats(Global.generation_scheduler.get_stats())}`")
     return f"""\
         <small>{"&nbsp;&nbsp;·&nbsp;&nbsp;".join(info)}</small>
         """
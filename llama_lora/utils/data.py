@@ -4,6 +4,7 @@ import fnmatch
 import json
 
 from ..globals import Global
+from .lora_model_registry import LoraModelRegistry
 
 
 def init_data_dir():
@@ -41,32 +42,28 @@ def get_available_dataset_names():
     return sorted(names)
 
 
-def get_available_lora_model_names():
+def get_lora_model_registry():
     lora_models_directory_path = os.path.join(Global.data_dir, "lora_models")
-    all_items = os.listdir(lora_models_directory_path)
-    names = [item for item in all_items if os.path.isdir(os.path.join(lora_models_directory_path, item))]
-    return sorted(names)
+    registry = Global.lora_model_registry
+    if not registry or registry.models_dir != lora_models_directory_path:
+        registry = Global.lora_model_registry = LoraModelRegistry(
+            lora_models_directory_path)
+    return registry
+
+
+def get_available_lora_model_names():
+    return get_lora_model_registry().get_names()
 
 
 def get_path_of_available_lora_model(name):
-    datasets_directory_path = os.path.join(Global.data_dir, "lora_models")
-    path = os.path.join(datasets_directory_path, name)
-    if os.path.isdir(path):
-        return path
-    return None
+    return get_lora_model_registry().get_path(name)
 
 
 def get_info_of_available_lora_model(name):
     try:
         if "/" in name:
             return None
-        path_of_available_lora_model = get_path_of_available_lora_model(
-            name)
-        if not path_of_available_lora_model:
-            return None
-
-        with open(os.path.join(path_of_available_lora_model, "info.json"), "r") as json_file:
-            return json.load(json_file)
+        return get_lora_model_registry().get_info(name)
 
     except Exception as e:
         return None
@@ -0,0 +1,76 @@
+import threading
+from contextlib import contextmanager
+
+
+class KeyLock:
+    '''
+    Per-key re-entrant locks. Concurrent callers locking the same key wait
+    for each other, while different keys don't block each other.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.waiters = {}
+
+    @contextmanager
+    def __call__(self, key):
+        with self.lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = threading.RLock()
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                self.waiters[key] -= 1
+                if self.waiters[key] <= 0:
+                    del self.waiters[key]
+                    del self.locks[key]
+
+
+class SharedKeyLock:
+    '''
+    Per-key locks that any number of callers can hold at once, as long as
+    they hold it for the same value (e.g. the LoRA model that is active on a
+    base model). Callers asking for another value wait until all holders
+    release the lock, and callers asking for the current value wait behind
+    them, so that switching values is not starved.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.states = {}
+
+    @contextmanager
+    def __call__(self, key, value):
+        with self.condition:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = {
+                    'value': value, 'holders': 0, 'switch_waiters': 0}
+
+            waiting_to_switch = False
+            while state['holders'] > 0:
+                if state['value'] == value and not state['switch_waiters']:
+                    break
+                if state['value'] != value and not waiting_to_switch:
+                    waiting_to_switch = True
+                    state['switch_waiters'] += 1
+                self.condition.wait()
+            if waiting_to_switch:
+                state['switch_waiters'] -= 1
+
+            state['value'] = value
+            state['holders'] += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                # States are kept, since waiters might be holding on to them.
+                state['holders'] -= 1
+                self.condition.notify_all()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+
+METADATA_FILE_NAMES = ["info.json", "finetune_params.json", "finetune_args.json"]
+# Later files take precedence.
+FINETUNE_PARAMS_FILE_NAMES = ["finetune_params.json", "finetune_args.json"]
+
+
+class LoraModelRegistry:
+    '''
+    An in-memory index of the LoRA models in a directory.
+
+    The index is refreshed at most once every `refresh_interval` seconds, on
+    access. A refresh only lists the directory again if its mtime has
+    changed, and only re-reads the files of a model if the mtime of its
+    directory or of its metadata files has changed. Metadata is read on first
+    use.
+    '''
+
+    def __init__(self, models_dir, refresh_interval=2.0):
+        self.models_dir = models_dir
+        self.refresh_interval = refresh_interval
+
+        self.entries = {}
+        self.dir_mtime = None
+        self.last_refresh_time = 0
+        self.lock = threading.RLock()
+
+    def get_names(self):
+        with self.lock:
+            self.refresh()
+            return sorted(self.entries.keys())
+
+    def get_path(self, name):
+        with self.lock:
+            self.refresh()
+            if name not in self.entries:
+                return None
+            return os.path.join(self.models_dir, name)
+
+    def get_info(self, name):
+        return self._get_cached(name, 'info', self._read_info)
+
+    def get_finetune_params(self, name):
+        return self._get_cached(
+            name, 'finetune_params', self._read_finetune_params)
+
+    def get_checkpoint_names(self, name):
+        file_names = self._get_file_names(name) or []
+        return [
+            file_name for file_name in file_names
+            if file_name.startswith("checkpoint-")]
+
+    def has_finetune_params(self, name):
+        file_names = self._get_file_names(name) or []
+        return any(
+            file_name in file_names for file_name in FINETUNE_PARAMS_FILE_NAMES)
+
+    def invalidate(self, name=None):
+        '''
+        Makes the next access re-scan the directory (and re-read model `name`,
+        if given), regardless of the refresh interval.
+        '''
+        with self.lock:
+            self.last_refresh_time = 0
+            self.dir_mtime = None
+            if name:
+                self.entries.pop(name, None)
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_refresh_time < self.refresh_interval:
+                return
+            self.last_refresh_time = now
+
+            try:
+                dir_mtime = os.stat(self.models_dir).st_mtime_ns
+            except FileNotFoundError:
+                self.entries = {}
+                self.dir_mtime = None
+                return
+
+            if dir_mtime != self.dir_mtime:
+                names = set(
+                    item.name for item in os.scandir(self.models_dir)
+                    if item.is_dir())
+                for name in list(self.entries.keys()):
+                    if name not in names:
+                        del self.entries[name]
+                for name in names:
+                    if name not in self.entries:
+                        self.entries[name] = _new_entry()
+                self.dir_mtime = dir_mtime
+
+            for name, entry in self.entries.items():
+                signature = self._get_signature(name)
+                if signature != entry['signature']:
+                    entry.clear()
+                    entry.update(_new_entry())
+                    entry['signature'] = signature
+
+    def _get_cached(self, name, key, read_fn):
+        with self.lock:
+            self.refresh()
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            if key not in entry['cache']:
+                entry['cache'][key] = read_fn(name)
+            return entry['cache'][key]
+
+    def _get_file_names(self, name):
+        return self._get_cached(
+            name, 'file_names',
+            lambda name: os.listdir(os.path.join(self.models_dir, name)))
+
+    def _get_signature(self, name):
+        model_dir = os.path.join(self.models_dir, name)
+        signature = []
+        for path in [model_dir] + [os.path.join(model_dir, file_name) for file_name in METADATA_FILE_NAMES]:
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _read_info(self, name):
+        try:
+            with open(os.path.join(self.models_dir, name, "info.json"), "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _read_finetune_params(self, name):
+        data = {}
+        for file_name in FINETUNE_PARAMS_FILE_NAMES:
+            try:
+                with open(os.path.join(self.models_dir, name, file_name), "r") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                pass
+        return data
+
+
+def _new_entry():
+    return {'signature': None, 'cache': {}}
@@ -1,3 +1,4 @@
+import threading
 from collections import OrderedDict
 
 
@@ -5,27 +6,37 @@ class LRUCache:
     def __init__(self, capacity=5):
         self.cache = OrderedDict()
         self.capacity = capacity
+        self.lock = threading.RLock()
 
     def get(self, key):
-        if key in self.cache:
-            # Move the accessed item to the end of the OrderedDict
-            self.cache.move_to_end(key)
-            return self.cache[key]
-        return None
+        with self.lock:
+            if key in self.cache:
+                # Move the accessed item to the end of the OrderedDict
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            return None
+
+    def contains(self, key):
+        # Unlike `get`, this does not count as an access.
+        with self.lock:
+            return key in self.cache
 
     def set(self, key, value):
-        if key in self.cache:
-            # If the key already exists, update its value
-            self.cache[key] = value
-        else:
-            # If the cache has reached its capacity, remove the least recently used item
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-            self.cache[key] = value
+        with self.lock:
+            if key in self.cache:
+                # If the key already exists, update its value
+                self.cache[key] = value
+            else:
+                # If the cache has reached its capacity, remove the least recently used item
+                if len(self.cache) >= self.capacity:
+                    self.cache.popitem(last=False)
+                self.cache[key] = value
 
     def clear(self):
-        self.cache.clear()
+        with self.lock:
+            self.cache.clear()
 
     def prepare_to_set(self):
-        if len(self.cache) >= self.capacity:
-            self.cache.popitem(last=False)
+        with self.lock:
+            if len(self.cache) >= self.capacity:
+                self.cache.popitem(last=False)
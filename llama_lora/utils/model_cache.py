@@ -0,0 +1,300 @@
+import os
+import hashlib
+import threading
+import itertools
+from collections import OrderedDict
+
+import torch
+
+from ..lib.cpu_quantization import get_packed_params_size_in_bytes
+from ..lib.layer_streaming import is_layer_streamed_model
+from ..lib.torch_compile import compile_model, uncompile_model, is_compiled_model
+
+
+def get_size_in_bytes(value):
+    if not isinstance(value, torch.nn.Module):
+        return 0
+
+    seen_data_ptrs = set()
+    size = 0
+    for tensor in itertools.chain(value.parameters(), value.buffers()):
+        if tensor.device.type == "meta":
+            continue
+        data_ptr = (tensor.device, tensor.data_ptr())
+        if data_ptr in seen_data_ptrs:
+            # Tied weights are only counted once.
+            continue
+        seen_data_ptrs.add(data_ptr)
+        size += tensor.numel() * tensor.element_size()
+
+    # Weights of quantized layers are not parameters or buffers.
+    for module in value.modules():
+        size += get_packed_params_size_in_bytes(module)
+
+    return size
+
+
+def format_model_cache_stats(stats):
+    return (
+        f"{stats['hits']} hits, {stats['cpu_hits']} CPU hits, "
+        f"{stats['disk_hits']} disk hits, {stats['misses']} misses, "
+        f"{stats['evictions']} evictions, "
+        f"{stats['device_bytes'] / (1024 ** 3):.2f} GB on device "
+        f"({len(stats['device_keys'])} entries)")
+
+
+class ModelCache:
+    '''
+    A cache that evicts entries by the bytes they occupy instead of by count.
+
+    Entries live in a "device" tier, bounded by `max_device_bytes` (and
+    optionally `max_device_items`). Entries evicted from it are demoted to a
+    CPU RAM tier (if `max_cpu_bytes` is set and the device is not the CPU),
+    then to an on-disk tier (if `disk_dir` is set), before being dropped.
+    Models loaded in 8-bit can't be moved across devices and are dropped
+    directly.
+    '''
+
+    def __init__(
+            self,
+            device="cpu",
+            max_device_bytes=None,
+            max_device_items=None,
+            max_cpu_bytes=None,
+            disk_dir=None,
+            max_disk_bytes=None):
+        self.device = device
+        self.max_device_bytes = max_device_bytes
+        self.max_device_items = max_device_items
+        self.max_cpu_bytes = max_cpu_bytes if device != "cpu" else None
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.device_entries = OrderedDict()
+        self.cpu_entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.known_sizes = {}
+        self.lock = threading.RLock()
+
+        self.stats = {
+            'hits': 0,
+            'cpu_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'demotions_to_cpu': 0,
+            'demotions_to_disk': 0,
+            'evictions': 0,
+        }
+
+    def get(self, key):
+        with self.lock:
+            if key in self.device_entries:
+                self.device_entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.device_entries[key]['value']
+
+            if key in self.cpu_entries:
+                entry = self.cpu_entries.pop(key)
+                self.stats['cpu_hits'] += 1
+                self._make_room_on_device(entry['size'])
+                entry['value'] = entry['value'].to(self.device)
+                self.device_entries[key] = entry
+                return entry['value']
+
+            if key in self.disk_entries:
+                entry = self.disk_entries.pop(key)
+                self.stats['disk_hits'] += 1
+                self._make_room_on_device(entry['size'])
+                value = torch.load(
+                    entry['path'], map_location="cpu", weights_only=False)
+                os.remove(entry['path'])
+                if entry['compiled']:
+                    value = compile_model(value)
+                self.device_entries[key] = {
+                    'value': value.to(self.device),
+                    'size': entry['size'],
+                }
+                return self.device_entries[key]['value']
+
+            self.stats['misses'] += 1
+            return None
+
+    def peek(self, key):
+        # Returns an entry only if it's on the device, without counting it as
+        # a hit or promoting it from lower tiers.
+        with self.lock:
+            entry = self.device_entries.get(key)
+            if entry:
+                return entry['value']
+            return None
+
+    def set(self, key, value, size=None):
+        with self.lock:
+            self._remove(key)
+
+            if size is None:
+                size = get_size_in_bytes(value)
+            self.known_sizes[key] = size
+
+            self.device_entries[key] = {'value': value, 'size': size}
+            self._enforce_device_budget()
+
+    def has_room_for(self, key, size):
+        '''
+        Returns whether an entry of `size` can be set for `key` without
+        demoting other entries.
+        '''
+        with self.lock:
+            if self.max_device_bytes is None:
+                return True
+            other_entries_size = sum(
+                entry['size'] for k, entry in self.device_entries.items()
+                if k != key)
+            return other_entries_size + size <= self.max_device_bytes
+
+    def get_known_size(self, key):
+        with self.lock:
+            return self.known_sizes.get(key)
+
+    def can_hold(self, sizes):
+        '''
+        Returns whether entries of `sizes` can all be on the device at the
+        same time.
+        '''
+        if self.max_device_items is not None and len(sizes) > self.max_device_items:
+            return False
+        if self.max_device_bytes is not None and sum(sizes) > self.max_device_bytes:
+            return False
+        return True
+
+    def prepare_to_set(self, key=None, estimated_size=None):
+        '''
+        Makes room on the device for an entry that is about to be loaded.
+        The size is taken from a previous load of the entry, or else from
+        `estimated_size`. If neither is known, everything on the device is
+        demoted to be safe. The budget is checked again with the actual size
+        once the entry is set.
+        '''
+        with self.lock:
+            size = self.known_sizes.get(key, estimated_size)
+            if size is None or self.max_device_bytes is None:
+                if self.max_device_items is not None:
+                    while len(self.device_entries) >= self.max_device_items:
+                        self._demote_from_device()
+                elif size is None:
+                    while self.device_entries:
+                        self._demote_from_device()
+                return
+
+            self._make_room_on_device(size)
+
+    def clear(self):
+        with self.lock:
+            for entry in self.disk_entries.values():
+                if os.path.exists(entry['path']):
+                    os.remove(entry['path'])
+            self.device_entries.clear()
+            self.cpu_entries.clear()
+            self.disk_entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                'device_bytes': self._get_tier_size(self.device_entries),
+                'cpu_bytes': self._get_tier_size(self.cpu_entries),
+                'disk_bytes': self._get_tier_size(self.disk_entries),
+                'device_keys': list(self.device_entries.keys()),
+                'cpu_keys': list(self.cpu_entries.keys()),
+                'disk_keys': list(self.disk_entries.keys()),
+            }
+
+    def _remove(self, key):
+        self.device_entries.pop(key, None)
+        self.cpu_entries.pop(key, None)
+        entry = self.disk_entries.pop(key, None)
+        if entry and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+    def _make_room_on_device(self, size):
+        if self.max_device_items is not None:
+            while len(self.device_entries) >= self.max_device_items:
+                self._demote_from_device()
+        if self.max_device_bytes is not None:
+            while self.device_entries and self._get_tier_size(self.device_entries) + size > self.max_device_bytes:
+                self._demote_from_device()
+
+    def _enforce_device_budget(self):
+        # The most recently used entry is always kept, even if it alone
+        # exceeds the budget.
+        if self.max_device_items is not None:
+            while len(self.device_entries) > max(self.max_device_items, 1):
+                self._demote_from_device()
+        if self.max_device_bytes is not None:
+            while len(self.device_entries) > 1 and self._get_tier_size(self.device_entries) > self.max_device_bytes:
+                self._demote_from_device()
+
+    def _demote_from_device(self):
+        key, entry = self.device_entries.popitem(last=False)
+        value = entry['value']
+
+        if not self._is_movable(value):
+            self._evict(key)
+            return
+
+        if self.max_cpu_bytes is not None and entry['size'] <= self.max_cpu_bytes:
+            print(f"Demoting {key} to CPU RAM...")
+            entry['value'] = value.to("cpu")
+            self.cpu_entries[key] = entry
+            self.stats['demotions_to_cpu'] += 1
+            while self._get_tier_size(self.cpu_entries) > self.max_cpu_bytes:
+                self._demote_from_cpu()
+            return
+
+        self._demote_to_disk(key, entry)
+
+    def _demote_from_cpu(self):
+        key, entry = self.cpu_entries.popitem(last=False)
+        self._demote_to_disk(key, entry)
+
+    def _demote_to_disk(self, key, entry):
+        if not self.disk_dir or (self.max_disk_bytes is not None and entry['size'] > self.max_disk_bytes):
+            self._evict(key)
+            return
+
+        print(f"Demoting {key} to disk...")
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = os.path.join(
+            self.disk_dir,
+            hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pt")
+        value = entry['value']
+        # Compiled forwards can't be pickled, save the module without it and
+        # compile it again when it's loaded back.
+        compiled = is_compiled_model(value)
+        torch.save(uncompile_model(value).to("cpu"), path)
+        self.disk_entries[key] = {
+            'path': path, 'size': entry['size'], 'compiled': compiled}
+        self.stats['demotions_to_disk'] += 1
+
+        if self.max_disk_bytes is not None:
+            while self._get_tier_size(self.disk_entries) > self.max_disk_bytes:
+                disk_key, disk_entry = self.disk_entries.popitem(last=False)
+                if os.path.exists(disk_entry['path']):
+                    os.remove(disk_entry['path'])
+                self._evict(disk_key)
+
+    def _evict(self, key):
+        print(f"Evicting {key} from cache...")
+        self.stats['evictions'] += 1
+
+    def _is_movable(self, value):
+        if not isinstance(value, torch.nn.Module):
+            return False
+        if getattr(value, "is_loaded_in_8bit", False):
+            return False
+        if is_layer_streamed_model(value):
+            return False
+        return True
+
+    def _get_tier_size(self, entries):
+        return sum(entry['size'] for entry in entries.values())
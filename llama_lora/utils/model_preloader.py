@@ -0,0 +1,151 @@
+import time
+import threading
+import traceback
+
+from ..globals import Global
+from ..models import (
+    get_tokenizer, is_model_resident, use_model,
+    get_model_cache_key, estimate_model_size)
+from ..lib.load_profiler import format_bytes
+
+
+def parse_model_specs(model_specs):
+    '''
+    Parses specs like `base_model` or `base_model//lora_model` into
+    `(base_model, lora_model)` tuples.
+    '''
+    if isinstance(model_specs, str):
+        model_specs = model_specs.split(',')
+
+    parsed_specs = []
+    for spec in model_specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        base_model_name, _, lora_model_name = spec.partition("//")
+        parsed_specs.append((base_model_name, lora_model_name or None))
+    return parsed_specs
+
+
+def start_preloading(model_specs, tokenizer_names):
+    '''
+    Loads the given tokenizers and models in the background, in the given
+    order. Progress is tracked in `Global.preload_status`.
+    '''
+    Global.preload_status = {
+        'tokenizers': {
+            name: _new_status() for name in tokenizer_names},
+        'models': {
+            _get_model_spec_key(base_model_name, lora_model_name): _new_status()
+            for base_model_name, lora_model_name in model_specs},
+    }
+
+    thread = threading.Thread(
+        target=_preload,
+        args=(model_specs, tokenizer_names),
+        daemon=True)
+    thread.start()
+
+
+def _preload(model_specs, tokenizer_names):
+    for name in tokenizer_names:
+        _load_with_status(
+            Global.preload_status['tokenizers'][name],
+            lambda: get_tokenizer(name))
+
+    # Models that do not fit in the model cache along with the ones before
+    # them are not preloaded, otherwise they would evict each other. The same
+    # goes for LoRA models attached to the same base model.
+    admitted_sizes = {}
+    attached_lora_model_counts = {}
+    for base_model_name, lora_model_name in model_specs:
+        status = Global.preload_status['models'][_get_model_spec_key(
+            base_model_name, lora_model_name)]
+        model_key = get_model_cache_key(base_model_name, lora_model_name)
+        is_attached_lora_model = lora_model_name and model_key == base_model_name
+        if is_attached_lora_model and attached_lora_model_counts.get(model_key, 0) >= Global.max_attached_lora_models:
+            status['status'] = 'skipped'
+            status['error'] = f"More than {Global.max_attached_lora_models} (`max_attached_lora_models`) LoRA models are preloaded on {base_model_name}."
+            print(
+                f"Not preloading {_get_model_spec_key(base_model_name, lora_model_name)}: {status['error']}")
+            continue
+        if model_key not in admitted_sizes:
+            size = estimate_model_size(base_model_name, lora_model_name)
+            sizes = list(admitted_sizes.values()) + [size or 0]
+            if not Global.loaded_models.can_hold(sizes):
+                status['status'] = 'skipped'
+                status['error'] = f"Does not fit in the model cache along with the models before it (estimated size: {format_bytes(size) if size else 'unknown'})."
+                print(f"Not preloading {model_key}: {status['error']}")
+                continue
+            admitted_sizes[model_key] = size or 0
+        if is_attached_lora_model:
+            attached_lora_model_counts[model_key] = \
+                attached_lora_model_counts.get(model_key, 0) + 1
+
+        _load_with_status(
+            status,
+            lambda: _load_model(base_model_name, lora_model_name))
+
+
+def _load_model(base_model_name, lora_model_name):
+    # Waits for generations with other LoRA models on the same base model,
+    # since loading a LoRA model activates it.
+    with use_model(base_model_name, lora_model_name):
+        pass
+
+
+def _load_with_status(status, load_fn):
+    status['status'] = 'loading'
+    start_time = time.time()
+    try:
+        load_fn()
+        status['status'] = 'ready'
+    except Exception as e:
+        traceback.print_exc()
+        status['status'] = 'error'
+        status['error'] = str(e)
+    status['load_time'] = time.time() - start_time
+
+
+def get_readiness():
+    '''
+    Returns whether all of the preloaded models are resident, along with the
+    status of each of them. Models that have been loaded but evicted since
+    then are reported as "evicted". Models that are "skipped" since they
+    don't fit in the model cache will be loaded on demand, and don't block
+    the readiness.
+    '''
+    tokenizers = {}
+    for name, status in Global.preload_status.get('tokenizers', {}).items():
+        status = dict(status)
+        if status['status'] == 'ready' and not Global.loaded_tokenizers.contains(name):
+            status['status'] = 'evicted'
+        tokenizers[name] = status
+
+    models = {}
+    for key, status in Global.preload_status.get('models', {}).items():
+        status = dict(status)
+        base_model_name, _, lora_model_name = key.partition("//")
+        if status['status'] == 'ready' and not is_model_resident(base_model_name, lora_model_name or None):
+            status['status'] = 'evicted'
+        models[key] = status
+
+    ready = all(
+        status['status'] in ['ready', 'skipped']
+        for status in list(tokenizers.values()) + list(models.values()))
+
+    return {
+        'ready': ready or Global.ui_dev_mode,
+        'tokenizers': tokenizers,
+        'models': models,
+    }
+
+
+def _get_model_spec_key(base_model_name, lora_model_name):
+    if lora_model_name:
+        return f"{base_model_name}//{lora_model_name}"
+    return base_model_name
+
+
+def _new_status():
+    return {'status': 'pending', 'error': None, 'load_time': None}
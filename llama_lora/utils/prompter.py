@@ -128,6 +128,32 @@ class Prompter(object):
             print(res)
         return res
 
+    def get_constant_prefix(
+        self,
+        variables: List[Union[None, str]] = [],
+    ) -> str:
+        """
+        Returns the start of the prompt that stays the same when the values
+        of the given variables change (such as the preamble of the template).
+        """
+        if self.template_name == "None":
+            return ""
+
+        def get_prompt_with_placeholders(placeholder):
+            if type(variables) == dict:
+                return self.generate_prompt({
+                    k: f"{placeholder}{i}" if v else v
+                    for i, (k, v) in enumerate(variables.items())})
+            return self.generate_prompt([
+                f"{placeholder}{i}" if v else v
+                for i, v in enumerate(variables)])
+
+        return osp.commonprefix([
+            get_prompt_with_placeholders("\x00"),
+            get_prompt_with_placeholders("\x01"),
+            self.generate_prompt(variables),
+        ])
+
     def get_response(self, output: str) -> str:
         if self.template_name == "None":
             return output
@@ -140,6 +166,11 @@ class Prompter(object):
             splitted_output[1:]
         ).strip()
 
+    def get_streaming_response_extractor(self) -> "StreamingResponseExtractor":
+        if self.template_name == "None":
+            return StreamingResponseExtractor(None)
+        return StreamingResponseExtractor(self.template["response_split"])
+
     def get_variable_names(self) -> List[str]:
         if self.template_name == "None":
             return ["prompt"]
@@ -176,6 +207,57 @@ class Prompter(object):
         return train_data
 
 
+class StreamingResponseExtractor(object):
+    """
+    Extracts the response from a streamed output, given the output as text
+    deltas, with the same result as `Prompter.get_response` on the whole
+    output. `response_split` is searched for only until it is found (also
+    when it spans deltas), and after that each delta is passed through.
+    """
+
+    def __init__(self, response_split: Union[None, str]):
+        self.response_split = response_split
+        # Without a response_split, the output is the response, unstripped.
+        self.found = not response_split
+        # The tail of the output that might be the start of response_split.
+        self.buffer = ""
+        self.started = False
+        self.pending_whitespace = ""
+
+    def feed(self, text: str, final: bool = False) -> str:
+        """
+        Takes the next delta of the output, and returns the next delta of
+        the response.
+        """
+        if not self.response_split:
+            return text
+
+        if not self.found:
+            self.buffer += text
+            index = self.buffer.find(self.response_split)
+            if index < 0:
+                keep_length = len(self.response_split) - 1
+                self.buffer = self.buffer[
+                    max(len(self.buffer) - keep_length, 0):]
+                return ""
+            self.found = True
+            text = self.buffer[index + len(self.response_split):]
+            self.buffer = ""
+
+        # Strip the response like get_response does: drop the leading
+        # whitespace, and hold back trailing whitespace until something
+        # follows it.
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self.started = True
+        text = self.pending_whitespace + text
+        stripped_text = text.rstrip()
+        self.pending_whitespace = "" if final else text[len(stripped_text):]
+        return stripped_text
+
+
 def get_val(arr, index, default=None):
     return arr[index] if -len(arr) <= index < len(arr) else default
 
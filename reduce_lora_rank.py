@@ -0,0 +1,115 @@
+import os
+import json
+
+import fire
+from safetensors.torch import save_file
+
+from llama_lora.globals import Global
+from llama_lora.models import (
+    get_peft_model_name_or_path, load_lora_model_weights,
+    SAFETENSORS_WEIGHTS_NAME)
+from llama_lora.lib.lora_rank_reduction import (
+    reduce_lora_rank, get_lora_params_count, benchmark_lora_layers)
+
+
+def main(
+    lora_model: str = "",
+    data_dir: str = "",
+    target_rank: int = 0,
+    energy_threshold: float = 0,
+    output_name: str = "",
+):
+    '''
+    Reduce the rank of a trained LoRA model with a truncated SVD of each
+    LoRA layer, and save it as a new LoRA model in the data directory. The
+    energy (sum of squared singular values) kept by each layer, and the size
+    and speed gain, are recorded in `rank_reduction_report.json`.
+
+    :param lora_model: (required) The name of the LoRA model in the data directory, or a LoRA model on Hugging Face.
+    :param data_dir: (required) The path to the data directory.
+    :param target_rank: The rank to reduce to.
+    :param energy_threshold: Instead of `target_rank`, reduce to the smallest rank that keeps at least this fraction of the energy of every layer. For example: 0.9.
+    :param output_name: The name of the reduced LoRA model. Defaults to '<lora_model>-r<rank>'.
+    '''
+
+    data_dir = data_dir or os.environ.get("LLAMA_LORA_DATA_DIR", "")
+    assert (
+        lora_model
+    ), "Please specify a --lora_model, e.g. --lora_model='alpaca-lora-7b'"
+    assert (
+        data_dir
+    ), "Please specify a --data_dir, e.g. --data_dir='./data'"
+    assert (
+        target_rank or energy_threshold
+    ), "Please specify either --target_rank or --energy_threshold, e.g. --energy_threshold=0.9"
+
+    Global.data_dir = os.path.abspath(data_dir)
+
+    peft_model_name_or_path = get_peft_model_name_or_path(lora_model)
+    config, weights = load_lora_model_weights(peft_model_name_or_path)
+
+    reduced_weights, rank, layer_stats = reduce_lora_rank(
+        weights, config.r,
+        target_rank=target_rank or None,
+        energy_threshold=energy_threshold or None)
+
+    output_name = output_name or f"{lora_model.rstrip('/').split('/')[-1]}-r{rank}"
+    output_dir = os.path.join(Global.data_dir, "lora_models", output_name)
+    assert (
+        not os.path.exists(output_dir)
+    ), f"The output directory already exists. ({output_dir})"
+    os.makedirs(output_dir)
+
+    original_rank = config.r
+    config.r = rank
+    config.save_pretrained(output_dir)
+    save_file(
+        reduced_weights,
+        os.path.join(output_dir, SAFETENSORS_WEIGHTS_NAME),
+        metadata={'format': 'pt'})
+
+    original_params_count = get_lora_params_count(weights)
+    reduced_params_count = get_lora_params_count(reduced_weights)
+    original_time = benchmark_lora_layers(weights)
+    reduced_time = benchmark_lora_layers(reduced_weights)
+    retained_energies = [
+        stats['retained_energy'] for stats in layer_stats.values()]
+    report = {
+        'lora_model': lora_model,
+        'original_rank': original_rank,
+        'rank': rank,
+        'min_retained_energy': min(retained_energies, default=1.0),
+        'mean_retained_energy': sum(retained_energies) / max(len(retained_energies), 1),
+        'original_params_count': original_params_count,
+        'params_count': reduced_params_count,
+        # The FLOPs of LoRA layers are proportional to their rank.
+        'flops_ratio': rank / original_rank,
+        'original_lora_layers_time': original_time,
+        'lora_layers_time': reduced_time,
+        'layers': layer_stats,
+    }
+
+    source_info_path = os.path.join(
+        Global.data_dir, "lora_models", lora_model, "info.json")
+    info = {}
+    if os.path.isfile(source_info_path):
+        with open(source_info_path, "r") as f:
+            info = json.load(f)
+        # The reduced weights are stored locally.
+        info.pop("load_from_hf", None)
+        info.pop("hf_model_name", None)
+    info['rank_reduced_from'] = lora_model
+    with open(os.path.join(output_dir, "info.json"), "w") as f:
+        json.dump(info, f, indent=2)
+
+    with open(os.path.join(output_dir, "rank_reduction_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    for layer_name, stats in layer_stats.items():
+        print(f"  {layer_name}: retained energy {stats['retained_energy']:.2%}")
+    print(
+        f"Saved {output_name}: rank {original_rank} -> {rank}, params {original_params_count} -> {reduced_params_count}, min retained energy {report['min_retained_energy']:.2%}, LoRA layers time (512 tokens, CPU) {original_time * 1000:.1f}ms -> {reduced_time * 1000:.1f}ms.")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
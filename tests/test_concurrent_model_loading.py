@@ -0,0 +1,136 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from tokenizers import Tokenizer, models as tokenizer_models
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from llama_lora import models
+from llama_lora.globals import Global
+from llama_lora.utils.model_cache import ModelCache
+from llama_lora.utils.lru_cache import LRUCache
+
+THREADS = 16
+LORA_MODEL_NAME = "tiny-lora"
+
+
+@pytest.fixture
+def base_model_dir(tmp_path, monkeypatch):
+    '''
+    Saves a tiny randomly initialized LLaMA model with a word-level
+    tokenizer, and a LoRA model for it under the data dir, and points the app
+    at them.
+    '''
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2)
+    model = LlamaForCausalLM(config)
+    model_dir = tmp_path / "base_model"
+    model.save_pretrained(model_dir)
+
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(
+            tokenizer_models.WordLevel(vocab, unk_token="<unk>")),
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>")
+    tokenizer.save_pretrained(model_dir)
+
+    lora_model = get_peft_model(model, LoraConfig(
+        r=2,
+        lora_alpha=4,
+        target_modules=["q_proj", "v_proj"],
+        task_type="CAUSAL_LM"))
+    lora_model.save_pretrained(tmp_path / "lora_models" / LORA_MODEL_NAME)
+
+    monkeypatch.setattr(Global, "data_dir", str(tmp_path))
+    monkeypatch.setattr(Global, "torch_compile", False)
+    monkeypatch.setattr(Global, "loaded_models", ModelCache(
+        device=models.get_device(), max_device_items=1))
+    monkeypatch.setattr(Global, "loaded_tokenizers", LRUCache(1))
+    monkeypatch.setattr(Global, "attached_lora_models", {})
+    monkeypatch.setattr(Global, "lora_model_load_stats", {})
+    return str(model_dir)
+
+
+def count_calls(monkeypatch, module, name):
+    calls = []
+    lock = threading.Lock()
+    original = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            calls.append(args)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, wrapper)
+    return calls
+
+
+def run_concurrently(fn, args_list):
+    # All threads are released at once to maximize the contention.
+    barrier = threading.Barrier(len(args_list))
+
+    def run(args):
+        barrier.wait()
+        return fn(*args)
+
+    with ThreadPoolExecutor(max_workers=len(args_list)) as executor:
+        # Raises the exception of any failed call.
+        return list(executor.map(run, args_list))
+
+
+def test_concurrent_get_model_loads_base_model_once(base_model_dir, monkeypatch):
+    loads = count_calls(monkeypatch, models, "_load_new_base_model")
+
+    results = run_concurrently(
+        models.get_model, [(base_model_dir,)] * THREADS)
+
+    assert len(loads) == 1
+    assert all(model is results[0] for model in results)
+
+
+def test_concurrent_get_model_loads_lora_model_once(base_model_dir, monkeypatch):
+    base_model_loads = count_calls(
+        monkeypatch, models, "_load_new_base_model")
+    lora_model_loads = count_calls(
+        monkeypatch, models, "load_lora_model_weights")
+
+    results = run_concurrently(
+        models.get_model, [(base_model_dir, LORA_MODEL_NAME)] * THREADS)
+
+    assert len(base_model_loads) == 1
+    assert len(lora_model_loads) == 1
+    assert all(model is results[0] for model in results)
+    assert models.get_loaded_lora_model_names(base_model_dir) == [
+        models.get_lora_adapter_name(LORA_MODEL_NAME)]
+
+
+def test_concurrent_use_model_with_different_lora_models(base_model_dir, monkeypatch):
+    loads = count_calls(monkeypatch, models, "_load_new_base_model")
+    active_lora_models = []
+    lock = threading.Lock()
+
+    def use(peft_model_name):
+        with models.use_model(base_model_dir, peft_model_name) as model:
+            with lock:
+                active_lora_models.append(peft_model_name)
+                assert len(set(active_lora_models)) == 1
+            active_adapter = getattr(model, "active_adapter", None)
+            if peft_model_name:
+                assert active_adapter == models.get_lora_adapter_name(
+                    peft_model_name)
+            with lock:
+                active_lora_models.remove(peft_model_name)
+
+    run_concurrently(
+        use, [(LORA_MODEL_NAME,), (None,)] * (THREADS // 2))
+
+    assert len(loads) == 1